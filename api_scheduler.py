@@ -0,0 +1,365 @@
+# api_scheduler.py
+
+import json
+import time
+import heapq
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import httpx
+from config import (
+    API_INITIAL_CONCURRENCY, API_MIN_CONCURRENCY, API_MAX_CONCURRENCY, API_CONCURRENCY_DECREASE_FACTOR,
+    API_THROTTLE_BACKOFF_SECONDS, API_MAX_PAUSE_SECONDS, API_MAX_QUEUE_WAIT_SECONDS,
+    API_RATE_LIMITS, API_DEFAULT_RATE_LIMIT, API_DEFAULT_COMPLETION_TOKENS
+)
+from metrics import get_metrics
+from prompt_utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+THROTTLE_STATUSES = (429, 503)
+
+# --- Request Context ---
+# The session and priority of the requests made by the current thread (or task). Worker threads
+# start with an empty context, so work submitted to a pool is wrapped in `with_request_context`.
+_request_session = contextvars.ContextVar("api_request_session", default=None)
+_request_priority = contextvars.ContextVar("api_request_priority", default=None)
+
+def set_request_session(session_id):
+    """Attributes the current context's API requests to a session for fair queuing."""
+    _request_session.set(session_id)
+
+@contextmanager
+def request_priority(priority: str):
+    """Runs the enclosed API requests at `priority` (INTERACTIVE or BULK)."""
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+def with_request_context(fn):
+    """Returns `fn` bound to a copy of the caller's request context, for running on a worker thread."""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+# --- Per-Model Lane ---
+class _TokenBucket:
+    """A per-minute budget that refills continuously; a request larger than the budget waits for a full bucket."""
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+
+    def delay(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+class _Ticket:
+    def __init__(self, lane, priority, session, tokens, key):
+        self.lane = lane
+        self.priority = priority
+        self.session = session
+        self.tokens = tokens
+        self.key = key
+        self.enqueued = time.monotonic()
+        self.started = None
+        self.released = False
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+class _Lane:
+    """Scheduling state of one model: the adaptive concurrency limit, budgets and the wait queue."""
+    def __init__(self, model: str, initial: int, requests_per_minute=None, tokens_per_minute=None):
+        self.model = model
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.requests = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.queue = []
+        self.finish_tags = {}
+        self.virtual_time = 0.0
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.stats = {"requests": 0, "throttled": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def enqueue(self, priority, session, tokens) -> _Ticket:
+        # Start-time fair queuing: each session's next request is tagged one step after its
+        # previous one (or at the current virtual time if it has been idle), so within a priority
+        # sessions take turns instead of the session with the most queued requests going first.
+        start = max(self.virtual_time, self.finish_tags.get(session, 0.0))
+        self.finish_tags[session] = start + 1.0
+        self.sequence += 1
+        ticket = _Ticket(self, priority, session, tokens, (PRIORITIES.index(priority), start, self.sequence))
+        heapq.heappush(self.queue, ticket)
+        return ticket
+
+    def dispatch_delay(self, ticket, now):
+        """Seconds until the queue head may start, or None while the concurrency limit is reached."""
+        if self.in_flight >= max(1, int(self.limit)):
+            return None
+        delay = self.paused_until - now
+        if self.requests is not None:
+            delay = max(delay, self.requests.delay(1, now))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.delay(ticket.tokens, now))
+        return max(0.0, delay)
+
+    def start(self, ticket, now):
+        heapq.heappop(self.queue)
+        self.in_flight += 1
+        ticket.started = now
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(ticket.tokens)
+        self.virtual_time = max(self.virtual_time, ticket.key[1])
+        if len(self.finish_tags) > 1024:
+            self.finish_tags = {s: tag for s, tag in self.finish_tags.items() if tag > self.virtual_time}
+        wait = now - ticket.enqueued
+        self.stats["requests"] += 1
+        self.stats["wait_seconds"] += wait
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait)
+        return wait
+
+    def remove(self, ticket):
+        self.queue.remove(ticket)
+        heapq.heapify(self.queue)
+
+    def finish(self, ticket, status, pause, now):
+        """Applies AIMD: additive increase on success, multiplicative decrease on throttling."""
+        self.in_flight -= 1
+        if status in THROTTLE_STATUSES:
+            self.stats["throttled"] += 1
+            # Requests sent before the last decrease were admitted under the old limit; their
+            # 429s report the same overload and must neither shrink the limit nor pause it again.
+            if ticket.started >= self.last_decrease:
+                self.limit = max(API_MIN_CONCURRENCY, self.limit * API_CONCURRENCY_DECREASE_FACTOR)
+                self.last_decrease = now
+                self.paused_until = max(self.paused_until, now + pause)
+        elif status is not None and status < 400:
+            self.limit = min(API_MAX_CONCURRENCY, self.limit + 1.0 / self.limit)
+
+    def queued(self):
+        counts = dict.fromkeys(PRIORITIES, 0)
+        for ticket in self.queue:
+            counts[ticket.priority] += 1
+        return counts
+
+# --- Scheduler ---
+def retry_after_seconds(headers, default: float = API_THROTTLE_BACKOFF_SECONDS) -> float:
+    """Reads `retry-after-ms` or `retry-after` (seconds or an HTTP date), capped at API_MAX_PAUSE_SECONDS."""
+    seconds = default
+    try:
+        if headers.get("retry-after-ms"):
+            seconds = float(headers["retry-after-ms"]) / 1000.0
+        elif headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                seconds = float(value)
+            except ValueError:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        pass
+    return min(max(seconds, 0.0), API_MAX_PAUSE_SECONDS)
+
+class ApiScheduler:
+    """Admits API requests per model under an adaptive concurrency limit and optional budgets.
+
+    Every session of the process sends its embedding and chat requests through one scheduler,
+    so a burst from one session slows everyone down gracefully instead of turning into 429s:
+    throttled responses halve the model's concurrency and pause it for `Retry-After`, and each
+    success adds back a fraction of a slot (AIMD). Queued requests start interactive first, then
+    in turn across sessions. Queue depth, in-flight requests and the limit are published as
+    gauges; each request's queue wait is recorded as the stage `api_queue_<priority>`.
+    """
+    def __init__(self, initial_concurrency: int = API_INITIAL_CONCURRENCY, rate_limits=None,
+                 max_wait: float = API_MAX_QUEUE_WAIT_SECONDS):
+        self.initial_concurrency = initial_concurrency
+        self.rate_limits = API_RATE_LIMITS if rate_limits is None else rate_limits
+        self.max_wait = max_wait
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def lane(self, model: str) -> _Lane:
+        with self._lock:
+            lane = self._lanes.get(model)
+            if lane is None:
+                requests_per_minute, tokens_per_minute = self.rate_limits.get(model, API_DEFAULT_RATE_LIMIT)
+                lane = _Lane(model, self.initial_concurrency, requests_per_minute, tokens_per_minute)
+                self._lanes[model] = lane
+            return lane
+
+    def acquire(self, model: str, tokens: int = 0, priority: str = None, session=None) -> _Ticket:
+        """Waits until a request for `model` may be sent; pass the ticket to `release` afterwards.
+
+        `priority` and `session` default to the current request context. Raises
+        `httpx.PoolTimeout` if the request is still queued after `max_wait` seconds.
+        """
+        priority = priority or _request_priority.get() or INTERACTIVE
+        session = _request_session.get() if session is None else session
+        lane = self.lane(model)
+        deadline = time.monotonic() + self.max_wait
+        with lane.condition:
+            ticket = lane.enqueue(priority, session, tokens)
+            self._publish(lane)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = lane.dispatch_delay(ticket, now) if lane.queue[0] is ticket else None
+                    if delay == 0:
+                        wait = lane.start(ticket, now)
+                        break
+                    if now >= deadline:
+                        raise httpx.PoolTimeout(f"Request to {model} waited {self.max_wait:.0f}s in the API queue")
+                    lane.condition.wait(min(delay, deadline - now) if delay is not None else deadline - now)
+            except BaseException:
+                lane.remove(ticket)
+                lane.condition.notify_all()
+                self._publish(lane)
+                raise
+            # The next request in line may also fit under the limit.
+            lane.condition.notify_all()
+            self._publish(lane)
+        metrics = get_metrics()
+        metrics.increment("proposal_api_requests_total", model=model, priority=priority)
+        if tokens:
+            metrics.increment("proposal_api_estimated_tokens_total", tokens, model=model)
+        metrics.record(f"api_queue_{priority}", wait, model=model)
+        return ticket
+
+    def release(self, ticket: _Ticket, status: int = None, headers=None):
+        """Frees the ticket's slot and adapts the limit from the response status (None for no response)."""
+        lane = ticket.lane
+        with lane.condition:
+            if ticket.released:
+                return
+            ticket.released = True
+            pause = retry_after_seconds(headers or {}) if status in THROTTLE_STATUSES else 0.0
+            lane.finish(ticket, status, pause, time.monotonic())
+            lane.condition.notify_all()
+            self._publish(lane)
+        if status in THROTTLE_STATUSES:
+            logger.info(f"{lane.model} throttled ({status}); concurrency limit {lane.limit:.1f}, pausing {pause:.1f}s")
+            get_metrics().increment("proposal_api_throttled_total", model=lane.model, status=status)
+
+    def stats(self):
+        """Returns one row per model: limit, in-flight and queued requests, throttles and waits."""
+        with self._lock:
+            lanes = list(self._lanes.values())
+        rows = []
+        for lane in lanes:
+            with lane.condition:
+                queued = lane.queued()
+                requests = lane.stats["requests"]
+                rows.append({
+                    "model": lane.model,
+                    "limit": round(lane.limit, 1),
+                    "in_flight": lane.in_flight,
+                    **{f"queued_{priority}": count for priority, count in queued.items()},
+                    "paused_s": round(max(0.0, lane.paused_until - time.monotonic()), 1),
+                    "requests": requests,
+                    "throttled": lane.stats["throttled"],
+                    "avg_wait_s": round(lane.stats["wait_seconds"] / requests, 3) if requests else 0.0,
+                    "max_wait_s": round(lane.stats["max_wait_seconds"], 3),
+                })
+        return rows
+
+    def _publish(self, lane):
+        metrics = get_metrics()
+        for priority, count in lane.queued().items():
+            metrics.set_gauge("proposal_api_queue_depth", count, model=lane.model, priority=priority)
+        metrics.set_gauge("proposal_api_in_flight", lane.in_flight, model=lane.model)
+        metrics.set_gauge("proposal_api_concurrency_limit", lane.limit, model=lane.model)
+
+# --- HTTP Transport ---
+def estimate_request_tokens(path: str, body: dict) -> int:
+    """Estimates the tokens an embeddings or chat completions request will be charged for."""
+    model = body.get("model")
+    if path.endswith("/embeddings"):
+        inputs = body.get("input") or []
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return sum(count_tokens(text, model) if isinstance(text, str) else len(text) for text in inputs)
+    tokens = 0
+    for message in body.get("messages") or []:
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        tokens += count_tokens(content, model)
+    completion = body.get("max_completion_tokens") or body.get("max_tokens") or API_DEFAULT_COMPLETION_TOKENS
+    return tokens + completion
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """A response body that releases its scheduler slot once the body has been read or closed."""
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+class ScheduledTransport(httpx.BaseTransport):
+    """An httpx transport that sends model requests (JSON bodies with a `model`) through a scheduler.
+
+    The slot is held until the response body is closed, so a streamed completion counts
+    against the limit for as long as the server is generating it.
+    """
+    def __init__(self, transport: httpx.BaseTransport, scheduler: ApiScheduler):
+        self.transport = transport
+        self.scheduler = scheduler
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = None
+        if request.method == "POST" and "json" in request.headers.get("content-type", ""):
+            try:
+                body = json.loads(request.content)
+            except (httpx.RequestNotRead, ValueError):
+                body = None
+        if not isinstance(body, dict) or not body.get("model"):
+            return self.transport.handle_request(request)
+
+        path = request.url.path
+        # Embedding requests are bulk work unless the caller runs them as interactive.
+        priority = _request_priority.get() or (BULK if path.endswith("/embeddings") else INTERACTIVE)
+        ticket = self.scheduler.acquire(body["model"], estimate_request_tokens(path, body), priority)
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            self.scheduler.release(ticket)
+            raise
+        release = functools.partial(self.scheduler.release, ticket, response.status_code, response.headers)
+        return httpx.Response(
+            status_code=response.status_code, headers=response.headers,
+            stream=_ReleasingStream(response.stream, release), extensions=response.extensions
+        )
+
+    def close(self):
+        self.transport.close()
+
+_default_scheduler = None
+
+def get_api_scheduler() -> ApiScheduler:
+    """Returns the process-wide API scheduler."""
+    global _default_scheduler
+    if _default_scheduler is None:
+        _default_scheduler = ApiScheduler()
+    return _default_scheduler
@@ -2,19 +2,26 @@
 
 import streamlit as st
 import os
-import tempfile
-from langchain_openai import ChatOpenAI
+import uuid
+from concurrent.futures import wait
 from config import (
     DEFAULT_PROPOSAL_TEMPLATE, EMBEDDING_MODEL_OPTIONS, 
-    TEXT_MODEL_OPTIONS, IMAGE_DIR
-)
-from file_utils import (
-    extract_text_from_file, convert_md_to_docx, convert_md_to_pdf
+    TEXT_MODEL_OPTIONS, NEBIUS_BASE_URL, GENERATION_MAX_CONCURRENCY, EXPORT_UI_WAIT_SECONDS, RETRIEVAL_USE_MMR,
+    METRICS_PORT, KB_INDEX_FACTORY, KB_INDEX_OPTIONS, RETRIEVAL_MODE, RETRIEVAL_MODES
 )
+from file_utils import extract_file, extract_files, add_image_refs
 from llm_utils import (
-    create_kb_from_texts, parse_template_sections, 
-    generate_section_content, get_complete_proposal
+    create_kb_from_documents, get_complete_proposal,
+    get_embedding_cache, get_llm_response_cache, knowledge_base_id, load_knowledge_base, with_query_embeddings,
+    retrieve_context, stream_section_content
 )
+from section_state import SectionGenerationState, section_inputs, generate_pending_sections
+from image_store import get_image_store
+from export_service import get_export_service
+from metrics import get_metrics, start_metrics_server
+from client_registry import get_client_registry
+from kb_registry import get_kb_registry
+from api_scheduler import get_api_scheduler, set_request_session
 
 # --- 页面与会话状态设置 ---
 st.set_page_config(page_title="AI 智能提案生成器", layout="wide")
@@ -64,18 +71,17 @@ div[data-testid="stSelectbox"]:hover {
 # 初始化会话状态
 def init_session_state():
     defaults = {
+        # 会话只保存知识库的语料标识和文件哈希；索引在进程内按语料共享，文件内容按哈希存放在图片存储的 sources 中
         "knowledge_base": None,
         "knowledge_files": [],
         "extracted_images": [],
+        "image_session_id": None,
         "proposal_template": DEFAULT_PROPOSAL_TEMPLATE,
         "requirements": "",
         "generated_proposal": "",
         "template_option": "使用默认模板",
-        "section_generation": {
-            "current_section": 0,
-            "sections": [],
-            "generated_sections": []
-        }
+        # 每个章节记录其生成时依赖的输入哈希，输入变化时只需重新生成受影响的章节
+        "section_generation": SectionGenerationState(DEFAULT_PROPOSAL_TEMPLATE)
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -83,9 +89,58 @@ def init_session_state():
 
 init_session_state()
 
-# 如果图片目录不存在，则创建
-if not os.path.exists(IMAGE_DIR):
-    os.makedirs(IMAGE_DIR)
+def record_extraction(result):
+    """记录提取结果中的图片引用，并显示提取过程中的警告。"""
+    add_image_refs(st.session_state.extracted_images, result["images"])
+    for warning in result["warnings"]:
+        st.warning(warning)
+    return result
+
+def extract_file_bytes(file_name, data):
+    """提取文件的文本与分页内容，记录其图片引用，并显示提取过程中的警告。"""
+    return record_extraction(extract_file(file_name, data))
+
+def extract_uploaded_file(uploaded_file):
+    return extract_file_bytes(uploaded_file.name, bytes(uploaded_file.getbuffer()))
+
+def drop_missing_knowledge_files():
+    """移除源文件已被过期清理的知识库文件，并提示用户重新上传。"""
+    store = get_image_store()
+    files = []
+    for file in st.session_state.knowledge_files:
+        if store.has_sources([file]):
+            files.append(file)
+        else:
+            st.warning(f"文件 {file['name']} 已过期被清理，已从知识库文件中移除，请重新上传。")
+    st.session_state.knowledge_files = files
+
+def knowledge_documents(on_extracted=None):
+    """按提取完成的顺序逐个产出知识库文档：项目需求在前，文件在多个进程中并行提取。
+
+    文件内容从图片存储的 sources 中读取；每提取完一个文件就调用 on_extracted(已完成数, 文件名)。
+    """
+    if st.session_state.requirements:
+        yield {"name": "项目需求", "text": st.session_state.requirements}
+    files = st.session_state.knowledge_files
+    sources = [(file["name"], get_image_store().read_source(file["source"])) for file in files]
+    for done, (i, result) in enumerate(extract_files(sources), start=1):
+        record_extraction(result)
+        if on_extracted:
+            on_extracted(done, files[i]["name"])
+        yield {"name": files[i]["name"], "text": result["text"], "pages": result["pages"]}
+
+# 每个会话拥有独立的图片目录；新会话开始时顺带清理过期的会话目录
+if not st.session_state.image_session_id:
+    st.session_state.image_session_id = uuid.uuid4().hex
+    get_image_store().collect_garbage()
+# 本次运行发出的 API 请求计入当前会话，调度器据此在各会话间轮流排队
+set_request_session(st.session_state.image_session_id)
+# 当前会话仍引用的源文件在每次运行时刷新使用时间，避免被其他会话的过期清理删除
+get_image_store().touch_sources(file["source"] for file in st.session_state.knowledge_files)
+
+# 可选：在独立端口上以 Prometheus 格式暴露各阶段指标（每个进程只启动一次）
+if METRICS_PORT:
+    start_metrics_server(METRICS_PORT)
 
 # --- 侧边栏配置 ---
 with st.sidebar:
@@ -97,6 +152,17 @@ with st.sidebar:
 
     selected_embedding_model = st.selectbox("选择向量化模型", EMBEDDING_MODEL_OPTIONS, index=0)
     selected_llm_model = st.selectbox("选择语言模型", TEXT_MODEL_OPTIONS, index=0)
+    generation_concurrency = st.slider("一键生成的并发章节数", 1, 8, GENERATION_MAX_CONCURRENCY)
+    use_mmr = st.checkbox("检索结果去重 (MMR)", value=RETRIEVAL_USE_MMR, help="避免几乎相同的文本块占满上下文")
+    retrieval_mode_labels = {"hybrid": "混合（关键词 + 向量）", "dense": "仅向量", "lexical": "仅关键词（最快，无需 API 调用）"}
+    retrieval_mode = st.selectbox(
+        "检索模式", RETRIEVAL_MODES, index=RETRIEVAL_MODES.index(RETRIEVAL_MODE), format_func=retrieval_mode_labels.get,
+        help="关键词检索 (BM25) 能准确命中产品名称、条款编号等专有词；混合模式将两种检索结果按排名融合"
+    )
+    index_factory = st.selectbox(
+        "向量索引类型", KB_INDEX_OPTIONS, index=KB_INDEX_OPTIONS.index(KB_INDEX_FACTORY),
+        help="Flat 为精确检索；SQ/IVF/PQ 以少量召回率换取更小的内存和更快的检索，文本块较少时自动使用 Flat"
+    )
 
     st.title("使用帮助")
     # 更新帮助说明，移除Emoji
@@ -111,6 +177,67 @@ with st.sidebar:
     8.  全部生成后，即可 **下载** 完整的提案文档。
     """)
 
+    with st.expander("性能指标"):
+        metric_rows = get_metrics().summary()
+        if metric_rows:
+            st.dataframe(metric_rows, hide_index=True, use_container_width=True)
+            for model, cost in get_metrics().estimated_cost().items():
+                st.caption(f"{model} 估算费用: ${cost:.4f}")
+            llm_cache_stats = get_llm_response_cache().stats()
+            st.caption(f"生成缓存: 命中 {llm_cache_stats['hits']} / 未命中 {llm_cache_stats['misses']}，共 {llm_cache_stats['entries']} 条")
+            kb_stats = get_kb_registry().stats()
+            st.caption(f"共享知识库: {kb_stats['entries']} 个，约 {kb_stats['bytes'] / 2**20:.1f} / {kb_stats['max_bytes'] / 2**20:.0f} MB，"
+                       f"{kb_stats['sessions']} 个会话在用，复用 {kb_stats['hits']} 次")
+            for lane in get_api_scheduler().stats():
+                st.caption(f"{lane['model']}: 并发上限 {lane['limit']}，进行中 {lane['in_flight']}，"
+                           f"排队 {lane['queued_interactive']} 交互 / {lane['queued_bulk']} 批量，"
+                           f"平均等待 {lane['avg_wait_s']}s，限流 {lane['throttled']} 次")
+        else:
+            st.caption("尚无数据：提取文件、创建知识库或生成章节后将在此显示各阶段耗时与用量。")
+
+def current_knowledge_base():
+    """返回当前会话的知识库：索引由进程内所有会话共享，查询向量使用本会话的 API 密钥计算。"""
+    handle = st.session_state.knowledge_base
+    if not handle:
+        return None
+    try:
+        shared = get_kb_registry().acquire(
+            handle["corpus"], st.session_state.image_session_id,
+            lambda: load_knowledge_base(handle["corpus"], handle["embedding_model"], nebius_api_key, NEBIUS_BASE_URL)
+        )
+    except (OSError, RuntimeError):
+        # 磁盘上的索引已被清理（超出 KB_STORE_MAX_CORPORA）
+        st.session_state.knowledge_base = None
+        st.warning("知识库已失效，请重新创建。")
+        return None
+    return with_query_embeddings(shared, handle["embedding_model"], nebius_api_key, NEBIUS_BASE_URL)
+
+def requirement_embeddings():
+    """用于判断各章节依赖哪些需求段落的向量模型；优先复用知识库的向量模型。"""
+    knowledge_base = current_knowledge_base()
+    if knowledge_base:
+        return knowledge_base.embedding_function
+    from nebius_embeddings import NebiusEmbeddings  # 按需导入，避免拖慢首屏加载
+    return NebiusEmbeddings(model=selected_embedding_model, api_key=nebius_api_key, base_url=NEBIUS_BASE_URL)
+
+def stream_section_to_state(index, llm, use_cache=True):
+    """检索上下文并流式生成一个章节，实时显示在页面上，连同其输入哈希记录到生成状态中，返回最终内容。"""
+    section = st.session_state.section_generation.sections[index]
+    live_preview = st.empty()
+    # 旋转提示只持续到第一个可见字符出现，之后实时渲染正在生成的章节
+    with st.spinner(f"AI正在为您生成 '{section['title']}' 章节..."):
+        context = retrieve_context(current_knowledge_base(), section, st.session_state.requirements, use_mmr=use_mmr,
+                                   model=selected_llm_model, mode=retrieval_mode)
+        section_stream = stream_section_content(section, st.session_state.requirements, context, llm, use_cache=use_cache)
+        section_content = next(section_stream)
+    live_preview.markdown(section_content)
+    for section_content in section_stream:
+        live_preview.markdown(section_content)
+    inputs = section_inputs([section], st.session_state.requirements, llm, requirement_embeddings(),
+                            current_knowledge_base(), retrieval_mode, use_mmr)[0]
+    st.session_state.section_generation.record(index, section_content, inputs)
+    return section_content
+
 # --- 主界面 ---
 st.title("AI 智能提案生成器")
 st.markdown("---") 
@@ -130,7 +257,7 @@ with col1:
             if uploaded_file:
                 try:
                     with st.spinner(f"正在提取 '{uploaded_file.name}'..."):
-                        st.session_state.requirements = extract_text_from_file(uploaded_file)
+                        st.session_state.requirements = extract_uploaded_file(uploaded_file)["text"]
                     st.success(f"已成功提取 '{uploaded_file.name}' 中的需求")
                 except Exception as e:
                     st.error(f"提取需求时出错: {e}")
@@ -139,35 +266,73 @@ with col1:
         st.header("2. 知识库")
         kb_files = st.file_uploader("上传知识库文档 (可多选)", type=["pdf", "docx"], accept_multiple_files=True, key="kb_files")
         if kb_files:
-            st.session_state.knowledge_files.extend([f for f in kb_files if f.name not in [kf.name for kf in st.session_state.knowledge_files]])
+            known_files = {kf["name"] for kf in st.session_state.knowledge_files}
+            for f in kb_files:
+                if f.name not in known_files:
+                    source = get_image_store().add_source(bytes(f.getbuffer()), os.path.splitext(f.name)[1])
+                    st.session_state.knowledge_files.append({"name": f.name, "source": source})
 
         if st.session_state.knowledge_files:
             st.write("知识库文件列表:")
-            for file in st.session_state.knowledge_files: st.write(f"📄 {file.name}")
+            for file in st.session_state.knowledge_files: st.write(f"📄 {file['name']}")
             if st.button("清空知识库"):
+                get_kb_registry().release(st.session_state.image_session_id)
                 st.session_state.knowledge_files, st.session_state.knowledge_base, st.session_state.extracted_images = [], None, []
-                if os.path.exists(IMAGE_DIR):
-                    for f in os.listdir(IMAGE_DIR): os.unlink(os.path.join(IMAGE_DIR, f))
+                get_image_store().clear_session(st.session_state.image_session_id)
                 st.success("知识库已清空。")
                 st.rerun()
 
         if st.button("创建知识库"):
+            drop_missing_knowledge_files()
             if not nebius_api_key: st.warning("请输入您的 Nebius API 密钥。")
             elif not st.session_state.knowledge_files and not st.session_state.requirements: st.warning("请输入项目需求或上传知识库文件。")
             else:
-                with st.spinner("正在利用AI构建知识库，请稍候..."):
+                with st.status("正在利用AI构建知识库，请稍候...", expanded=True) as build_status:
                     try:
-                        kb_texts = [st.session_state.requirements] if st.session_state.requirements else []
-                        for file in st.session_state.knowledge_files:
-                            kb_texts.append(extract_text_from_file(file))
-                        
-                        st.session_state.knowledge_base = create_kb_from_texts(
-                            texts=kb_texts, embedding_model_name=selected_embedding_model,
-                            api_key=nebius_api_key, base_url="https://api.studio.nebius.com/v1/"
+                        # 流水线构建：文件在多个进程中并行提取，每提取完一个文件就逐页切分、分批向量化，
+                        # 向量返回后立即写入索引；文本块会记录来源文件、页码和偏移量
+                        file_count = len(st.session_state.knowledge_files)
+                        extraction_bar = st.progress(0.0, text=f"提取文件: 0/{file_count}") if file_count else None
+                        embedding_bar = st.progress(0.0, text="向量化: 等待文本块...")
+
+                        def show_extracted(done, name):
+                            extraction_bar.progress(done / file_count, text=f"提取文件: {done}/{file_count}（{name}）")
+
+                        def show_build_progress(event):
+                            if event["event"] == "document":
+                                st.write(f"📄 {event['name']}: " + ("已在其他知识库中向量化，直接复用" if event["reused"] else f"{event['chunks']} 个文本块"))
+                            else:
+                                embedding_bar.progress(event["embedded"] / event["queued"],
+                                                       text=f"向量化: {event['embedded']}/{event['queued']} 个文本块（{event['name']}）")
+
+                        kb_documents = []
+                        def collected(documents):
+                            for doc in documents:
+                                kb_documents.append(doc)
+                                yield doc
+
+                        kb_registry = get_kb_registry()
+                        kb_registry.release(st.session_state.image_session_id)
+                        knowledge_base = create_kb_from_documents(
+                            collected(knowledge_documents(show_extracted)), embedding_model_name=selected_embedding_model,
+                            api_key=nebius_api_key, base_url=NEBIUS_BASE_URL, index_factory=index_factory,
+                            progress=show_build_progress
                         )
-                        if st.session_state.knowledge_base: st.success("知识库已成功创建！")
-                        else: st.warning("未能创建知识库（输入可能为空）。")
-                    except Exception as e: st.error(f"创建知识库时出错: {e}")
+                        # 其他会话已加载相同语料时共享同一份索引，本次加载的副本随即释放
+                        corpus = knowledge_base and knowledge_base_id(kb_documents, selected_embedding_model, index_factory)
+                        knowledge_base = corpus and kb_registry.acquire(corpus, st.session_state.image_session_id, lambda: knowledge_base)
+                        st.session_state.knowledge_base = {"corpus": corpus, "embedding_model": selected_embedding_model} if knowledge_base else None
+                        if st.session_state.knowledge_base:
+                            build_status.update(label="知识库已成功创建！", state="complete", expanded=False)
+                            st.success("知识库已成功创建！")
+                            cache_stats = get_embedding_cache().stats()
+                            st.caption(f"向量缓存: 命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']}，共 {cache_stats['entries']} 条")
+                        else:
+                            build_status.update(label="未能创建知识库", state="error")
+                            st.warning("未能创建知识库（输入可能为空）。")
+                    except Exception as e:
+                        build_status.update(label="创建知识库时出错", state="error")
+                        st.error(f"创建知识库时出错: {e}")
 
 
 # --- 第 2 列: 模板与生成 ---
@@ -178,8 +343,9 @@ with col2:
         template_option = st.radio("模板来源:", ["使用默认模板", "编辑在线模板", "上传本地模板"], horizontal=True, key="template_method")
 
         def reset_section_generation(template_content):
+            # 只丢弃模板中已不存在的章节；保留下来的章节在模板正文变化时会被标记为过期
             st.session_state.proposal_template = template_content
-            st.session_state.section_generation = {"current_section": 0, "sections": parse_template_sections(template_content), "generated_sections": []}
+            st.session_state.section_generation.set_template(template_content)
 
         if template_option == "编辑在线模板":
             new_template = st.text_area("编辑模板内容:", value=st.session_state.proposal_template, height=200) # 调整高度以适应新布局
@@ -188,7 +354,7 @@ with col2:
             uploaded_template = st.file_uploader("上传模板文件", type=["docx", "pdf"], key="template_file")
             if uploaded_template:
                 try:
-                    content = extract_text_from_file(uploaded_template)
+                    content = extract_uploaded_file(uploaded_template)["text"]
                     reset_section_generation(content)
                 except Exception as e: st.error(f"提取模板时出错: {e}")
         else: # 使用默认模板
@@ -200,12 +366,13 @@ with col2:
     with st.container(border=True):
         st.header("4. 生成与编辑")
         
-        if not st.session_state.section_generation["sections"] and st.session_state.proposal_template:
-            st.session_state.section_generation["sections"] = parse_template_sections(st.session_state.proposal_template)
-
-        sections = st.session_state.section_generation["sections"]
-        current_idx = st.session_state.section_generation["current_section"]
+        generation_state = st.session_state.section_generation
+        sections = generation_state.sections
+        current_idx = generation_state.current_index
         total_sections = len(sections)
+        # 编辑区显示最近生成的章节
+        last_record = generation_state.record_for(current_idx - 1) if current_idx > 0 else None
+        st.session_state.generated_proposal = last_record["content"] if last_record else ""
 
         if total_sections > 0:
             if current_idx < total_sections:
@@ -220,32 +387,59 @@ with col2:
             elif current_idx >= total_sections: st.warning("所有章节已经生成完毕！")
             else:
                 current_section = sections[current_idx]
-                with st.spinner(f"AI正在为您生成 '{current_section['title']}' 章节..."):
-                    try:
-                        llm = ChatOpenAI(model=selected_llm_model, temperature=0.2, api_key=nebius_api_key, base_url="https://api.studio.nebius.com/v1/")
-                        context = ""
-                        if st.session_state.knowledge_base:
-                            retriever = st.session_state.knowledge_base.as_retriever(search_kwargs={"k": 5})
-                            section_query = f"{current_section['title']} {st.session_state.requirements}"
-                            context_docs = retriever.get_relevant_documents(section_query)
-                            context = "\n\n".join([doc.page_content for doc in context_docs])
-                        
-                        section_content = generate_section_content(current_section, st.session_state.requirements, context, llm)
-                        st.session_state.section_generation["generated_sections"].append(section_content)
-                        st.session_state.section_generation["current_section"] += 1
-                        st.session_state.generated_proposal = section_content
-                        st.success(f"章节 '{current_section['title']}' 已生成！")
+                try:
+                    llm = get_client_registry().chat_model(selected_llm_model, nebius_api_key, NEBIUS_BASE_URL, temperature=0.2, stream_usage=True)
+                    stream_section_to_state(current_idx, llm)
+                    st.success(f"章节 '{current_section['title']}' 已生成！")
+                    
+                    if generation_state.current_index == total_sections:
+                        st.balloons()
                         
-                        if st.session_state.section_generation["current_section"] == total_sections:
-                            st.balloons()
-                            
+                    st.rerun()
+                except Exception as e: st.error(f"生成章节时出错: {e}")
+
+        gen_col1, gen_col2 = st.columns(2)
+        generate_all = gen_col1.button("一键生成全部章节", use_container_width=True)
+        # 只重新生成输入（模板正文、相关需求段落、知识库及检索设置或模型）发生变化的章节，并补齐未生成的章节
+        refresh_stale = gen_col2.button("更新过期章节", use_container_width=True, disabled=not generation_state.records)
+        if generate_all or refresh_stale:
+            if not nebius_api_key: st.warning("请输入您的 Nebius API 密钥。")
+            elif not st.session_state.requirements: st.warning("请输入项目需求。")
+            elif generate_all and not generation_state.pending_indices(): st.warning("所有章节已经生成完毕！")
+            else:
+                with st.spinner("AI正在检查并并发生成需要更新的章节..." if refresh_stale else "AI正在并发生成剩余的章节..."):
+                    llm = get_client_registry().chat_model(selected_llm_model, nebius_api_key, NEBIUS_BASE_URL, temperature=0.2, stream_usage=True)
+                    outcome = generate_pending_sections(
+                        generation_state, st.session_state.requirements, llm,
+                        knowledge_base=current_knowledge_base(), embeddings=requirement_embeddings(),
+                        refresh_stale=refresh_stale, max_workers=generation_concurrency, use_mmr=use_mmr,
+                        retrieval_mode=retrieval_mode
+                    )
+                for i in outcome["kept_edits"]:
+                    st.warning(f"章节 '{sections[i]['title']}' 的输入已变化，但包含您的手动修改，因此未重新生成。")
+                for i, e in outcome["errors"].items():
+                    st.error(f"生成章节 '{sections[i]['title']}' 时出错: {e}")
+                if not outcome["errors"] and not outcome["kept_edits"]:
+                    if not outcome["generated"]:
+                        st.info("所有章节均为最新，无需重新生成。")
+                    else:
+                        st.success(f"已生成 {len(outcome['generated'])} 个章节。")
+                        st.balloons()
                         st.rerun()
-                    except Exception as e: st.error(f"生成章节时出错: {e}")
 
         if total_sections > 0:
             st.progress(min(1.0, current_idx / total_sections), text=f"生成进度: {current_idx}/{total_sections}")
+            # 重新生成会绕过生成缓存，只为上一章节调用一次模型
+            if current_idx > 0 and st.button("重新生成上一章节"):
+                if not nebius_api_key: st.warning("请输入您的 Nebius API 密钥。")
+                else:
+                    try:
+                        llm = get_client_registry().chat_model(selected_llm_model, nebius_api_key, NEBIUS_BASE_URL, temperature=0.2, stream_usage=True)
+                        stream_section_to_state(current_idx - 1, llm, use_cache=False)
+                        st.rerun()
+                    except Exception as e: st.error(f"重新生成章节时出错: {e}")
             if current_idx > 0 and st.button("重新开始"):
-                st.session_state.section_generation.update({"current_section": 0, "generated_sections": []})
+                generation_state.reset()
                 st.session_state.generated_proposal = ""
                 st.success("章节生成已重置，您可以重新开始。")
                 st.rerun()
@@ -254,30 +448,31 @@ with col2:
             st.subheader("编辑当前章节")
             edited_section = st.text_area("编辑区 (您可以在此修改AI生成的内容):", value=st.session_state.generated_proposal, height=250)
             if edited_section != st.session_state.generated_proposal:
-                if current_idx > 0:
-                    st.session_state.section_generation["generated_sections"][current_idx - 1] = edited_section
+                generation_state.edit(current_idx - 1, edited_section)
                 st.session_state.generated_proposal = edited_section
 
             with st.expander("预览完整提案", expanded=True):
-                complete_proposal = get_complete_proposal()
+                complete_proposal = get_complete_proposal(generation_state.generated_sections())
                 st.markdown(complete_proposal)
 
             if complete_proposal:
                 st.subheader("下载提案")
                 try:
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        docx_path = os.path.join(temp_dir, "generated_proposal.docx")
-                        pdf_path = os.path.join(temp_dir, "generated_proposal.pdf")
-
-                        convert_md_to_docx(complete_proposal, docx_path, st.session_state.extracted_images)
-                        convert_md_to_pdf(complete_proposal, pdf_path, st.session_state.extracted_images)
-
-                        dl_col1, dl_col2 = st.columns(2)
-                        with dl_col1:
-                            with open(docx_path, "rb") as f:
-                                st.download_button("下载为 DOCX", f, "proposal_final.docx", use_container_width=True)
-                        with dl_col2:
-                            with open(pdf_path, "rb") as f:
-                                st.download_button("下载为 PDF", f, "proposal_final.pdf", use_container_width=True)
+                    # 导出只用到前两张图片，仅在此时才把它们写入磁盘
+                    export_images = get_image_store().materialize(st.session_state.extracted_images[:2], st.session_state.image_session_id)
+                    # 渲染在后台线程中进行，并按内容缓存；内容未变化的重跑不会重新渲染
+                    exports = get_export_service().submit(complete_proposal, export_images, owner=st.session_state.image_session_id)
+                    wait(exports.values(), timeout=EXPORT_UI_WAIT_SECONDS)
+
+                    dl_col1, dl_col2 = st.columns(2)
+                    for dl_col, fmt, label in ((dl_col1, "docx", "下载为 DOCX"), (dl_col2, "pdf", "下载为 PDF")):
+                        with dl_col:
+                            export = exports[fmt]
+                            if not export.done():
+                                st.button(f"{fmt.upper()} 正在后台生成，点击刷新", key=f"refresh_{fmt}", use_container_width=True)
+                            elif export.exception():
+                                st.error(f"生成 {fmt.upper()} 时出错: {export.exception()}")
+                            else:
+                                st.download_button(label, export.result(), f"proposal_final.{fmt}", use_container_width=True)
                 except Exception as e:
-                    st.error(f"准备下载文件时出错: {str(e)}")
\ No newline at end of file
+                    st.error(f"准备下载文件时出错: {str(e)}")
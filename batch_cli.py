@@ -0,0 +1,162 @@
+# batch_cli.py
+
+import os
+import sys
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import (
+    DEFAULT_PROPOSAL_TEMPLATE, EMBEDDING_MODEL_OPTIONS, TEXT_MODEL_OPTIONS,
+    NEBIUS_BASE_URL, GENERATION_MAX_CONCURRENCY, KB_INDEX_FACTORY, RETRIEVAL_MODE, RETRIEVAL_MODES
+)
+from file_utils import extract_file, extract_files, convert_md_to_docx, convert_md_to_pdf
+from llm_utils import create_kb_from_documents, parse_template_sections, generate_all_sections, get_complete_proposal
+from image_store import get_image_store
+from metrics import get_metrics
+from client_registry import get_client_registry
+from api_scheduler import set_request_session
+
+logger = logging.getLogger("batch_cli")
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx")
+CONVERTERS = {"docx": convert_md_to_docx, "pdf": convert_md_to_pdf}
+
+def list_documents(directory):
+    """Returns the PDF/DOCX files directly inside `directory`, sorted by name."""
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith("~$")
+    )
+
+def extract_path(path):
+    with open(path, "rb") as f:
+        result = extract_file(os.path.basename(path), f.read())
+    for warning in result["warnings"]:
+        logger.warning("%s: %s", path, warning)
+    return result
+
+def load_template(path):
+    """Reads a proposal template from a Markdown/text file or extracts it from a PDF/DOCX."""
+    if not path:
+        return DEFAULT_PROPOSAL_TEMPLATE
+    if path.lower().endswith(SUPPORTED_EXTENSIONS):
+        return extract_path(path)["text"]
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+def build_knowledge_base(kb_dir, args):
+    """Builds (or reuses from the persistent store) one knowledge base shared by every proposal.
+
+    Files are extracted in parallel and each one is embedded as soon as it is extracted.
+    """
+    paths = list_documents(kb_dir) if kb_dir else []
+    if not paths:
+        return None
+
+    def documents():
+        sources = []
+        for path in paths:
+            with open(path, "rb") as f:
+                sources.append((os.path.basename(path), f.read()))
+        for i, result in extract_files(sources):
+            for warning in result["warnings"]:
+                logger.warning("%s: %s", paths[i], warning)
+            yield {"name": os.path.basename(paths[i]), "text": result["text"], "pages": result["pages"]}
+
+    def log_progress(event):
+        if event["event"] == "document":
+            logger.info("knowledge base: %s %s", event["name"],
+                        "reused from a persisted corpus" if event["reused"] else f"queued ({event['chunks']} chunks)")
+
+    return create_kb_from_documents(documents(), args.embedding_model, args.api_key, args.base_url,
+                                    index_factory=args.index, progress=log_progress)
+
+def generate_proposal(path, sections, knowledge_base, args):
+    """Generates and writes the proposal for one requirements file; returns the written paths."""
+    # The extension stays in the name so that "rfp.pdf" and "rfp.docx" write "rfp.pdf.docx" and "rfp.docx.docx".
+    name = os.path.basename(path)
+    # Each requirements file queues its API requests as its own session, so files take turns.
+    set_request_session(f"batch-{name}")
+    result = extract_path(path)
+    if not result["text"].strip():
+        raise ValueError("no text could be extracted from the requirements file")
+
+    llm = get_client_registry().chat_model(args.llm_model, args.api_key, args.base_url, temperature=args.temperature)
+    contents, errors = generate_all_sections(
+        sections, result["text"], llm, knowledge_base=knowledge_base, max_workers=args.section_workers,
+        use_cache=not args.regenerate, retrieval_mode=args.retrieval
+    )
+    for i, e in errors.items():
+        logger.error("%s: section '%s' failed (%s); template text kept", path, sections[i]["title"], e)
+    proposal = get_complete_proposal(contents)
+
+    images = get_image_store().materialize(result["images"][:2], f"batch-{name}")
+    written = []
+    for fmt in args.formats:
+        output_path = os.path.join(args.output_dir, f"{name}.{fmt}")
+        CONVERTERS[fmt](proposal, output_path, images)
+        written.append(output_path)
+    if args.markdown:
+        output_path = os.path.join(args.output_dir, f"{name}.md")
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(proposal)
+        written.append(output_path)
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate proposals for a directory of requirement files without the Streamlit UI.")
+    parser.add_argument("requirements_dir", help="Directory of requirement PDF/DOCX files, one proposal per file.")
+    parser.add_argument("output_dir", help="Directory to write the generated proposals to.")
+    parser.add_argument("--kb-dir", help="Directory of PDF/DOCX files for the shared knowledge base.")
+    parser.add_argument("--template", help="Proposal template (.md/.txt, or a PDF/DOCX to extract).")
+    parser.add_argument("--formats", nargs="+", choices=sorted(CONVERTERS), default=["docx", "pdf"])
+    parser.add_argument("--markdown", action="store_true", help="Also write the Markdown source of each proposal.")
+    parser.add_argument("--regenerate", action="store_true", help="Bypass the LLM response cache (results still refresh it).")
+    parser.add_argument("--workers", type=int, default=4, help="Proposals generated in parallel.")
+    parser.add_argument("--section-workers", type=int, default=GENERATION_MAX_CONCURRENCY, help="Sections generated in parallel per proposal.")
+    parser.add_argument("--embedding-model", default=EMBEDDING_MODEL_OPTIONS[0], choices=EMBEDDING_MODEL_OPTIONS)
+    parser.add_argument("--index", default=KB_INDEX_FACTORY, help="faiss index_factory description for the knowledge base, e.g. SQ8 or 'IVF{nlist},PQ{pq_m}x4fs'.")
+    parser.add_argument("--retrieval", default=RETRIEVAL_MODE, choices=RETRIEVAL_MODES,
+                        help="Knowledge-base search: BM25 and vector results fused (hybrid), vectors only, or BM25 only (lexical).")
+    parser.add_argument("--llm-model", default=TEXT_MODEL_OPTIONS[0])
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--base-url", default=NEBIUS_BASE_URL)
+    parser.add_argument("--api-key", default=os.environ.get("NEBIUS_API_KEY"), help="Defaults to $NEBIUS_API_KEY.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or NEBIUS_API_KEY)")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    requirement_paths = list_documents(args.requirements_dir)
+    if not requirement_paths:
+        parser.error(f"no PDF/DOCX files found in {args.requirements_dir}")
+    sections = parse_template_sections(load_template(args.template))
+    if not sections:
+        parser.error("the template has no '## ' sections")
+
+    logger.info("Building the knowledge base from %s", args.kb_dir or "(none)")
+    knowledge_base = build_knowledge_base(args.kb_dir, args)
+
+    logger.info("Generating %d proposals with %d workers", len(requirement_paths), args.workers)
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(generate_proposal, path, sections, knowledge_base, args): path for path in requirement_paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                logger.info("%s -> %s", path, ", ".join(future.result()))
+            except Exception as e:
+                failures += 1
+                logger.error("%s failed: %s", path, e)
+
+    for row in get_metrics().summary():
+        logger.info("stage %(stage)s: %(calls)d calls, avg %(avg_s).3fs, p95 %(p95_s).3fs, "
+                    "%(prompt_tokens)d prompt / %(completion_tokens)d completion tokens, %(retries)d retries", row)
+    get_metrics().dump()
+    logger.info("Done: %d succeeded, %d failed", len(requirement_paths) - failures, failures)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
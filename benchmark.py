@@ -0,0 +1,784 @@
+# benchmark.py
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import base64
+import hashlib
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import statistics
+from collections import defaultdict
+import numpy as np
+import regex as re
+import faiss
+import fitz  # PyMuPDF
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from docx import Document
+from langchain_community.document_loaders import PyPDFLoader
+from config import (
+    IMAGE_DIR, CACHE_DIR, DEFAULT_PROPOSAL_TEMPLATE, KB_INDEX_OPTIONS, KB_INDEX_NPROBE,
+    KB_INDEX_MAX_TRAIN_POINTS, RETRIEVAL_MODES, RETRIEVAL_K
+)
+from pdf_extraction import extract_pdf_pages
+
+# --- Synthetic Inputs ---
+def make_synthetic_pdf(path, pages, images_per_page=1, seed=0):
+    """Writes a PDF with `pages` pages of text and a repeated logo image, like a typical tender pack.
+
+    A non-zero `seed` numbers the clauses differently, so several files do not share their text.
+    """
+    logo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 64, 64), False)
+    logo.clear_with(200)
+    logo_png = logo.tobytes("png")
+    with fitz.open() as pdf_document:
+        for page_no in range(pages):
+            page = pdf_document.new_page()
+            prefix = f"{seed}." if seed else ""
+            body = "\n".join(f"Clause {prefix}{page_no + 1}.{line}: the supplier shall provide the service." for line in range(40))
+            page.insert_textbox(fitz.Rect(50, 50, 550, 800), body, fontsize=8)
+            for i in range(images_per_page):
+                page.insert_image(fitz.Rect(450 - 60 * i, 20, 500 - 60 * i, 70), stream=logo_png)
+        pdf_document.save(path)
+    return path
+
+VOCABULARY = (
+    "supplier service delivery milestone payment security cloud migration data platform training "
+    "support warranty license integration testing acceptance deadline budget risk compliance audit "
+    "供应商 服务 交付 里程碑 付款 安全 云 迁移 数据 平台 培训 支持 质保 许可 集成 测试 验收 预算 风险 合规"
+).split()
+
+def synthetic_paragraphs(count, seed=0, words=60):
+    """Returns `count` pseudo-random paragraphs over a small bilingual tender vocabulary."""
+    rng = random.Random(seed)
+    return [
+        f"Clause {seed}.{i}: " + " ".join(rng.choice(VOCABULARY) for _ in range(words))
+        for i in range(count)
+    ]
+
+def make_synthetic_docx(paragraphs):
+    doc = Document()
+    for paragraph in paragraphs:
+        doc.add_paragraph(paragraph)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+# --- Fake OpenAI-Compatible Server ---
+def hashed_embedding(text, dim):
+    """Deterministic bag-of-words feature-hashing vector, so similar texts get similar embeddings."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in re.findall(r"\p{Han}|[\p{L}\p{N}]+", text.lower()):
+        h = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[h % dim] += 1.0 if (h >> 7) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class FakeOpenAIServer:
+    """A local stand-in for the OpenAI-compatible `/embeddings` and `/chat/completions` endpoints.
+
+    `embedding_latency` and `chat_latency` are added per request (seconds); chat completions then
+    emit `completion_tokens` tokens at `token_rate` tokens/s, streamed when the client asks for it.
+    With `rate_limit`, each model accepts that many requests per second (in bursts of up to one
+    second's worth) and answers the excess with 429 and `Retry-After`, like a per-minute quota.
+    """
+    def __init__(self, dim=256, embedding_latency=0.05, chat_latency=0.2, token_rate=200.0, completion_tokens=200,
+                 rate_limit=None, retry_after=1):
+        self.dim = dim
+        self.embedding_latency = embedding_latency
+        self.chat_latency = chat_latency
+        self.token_rate = token_rate
+        self.completion_tokens = completion_tokens
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.requests = {"embeddings": 0, "chat": 0, "throttled": 0}
+        self._allowance = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate writes; with Nagle's algorithm each response would
+            # wait ~40 ms for the client's delayed ACK and inflate every measured request.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not server.admit(body.get("model")):
+                    self._send_json({"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}}, 429,
+                                    {"Retry-After": str(server.retry_after)})
+                elif self.path.endswith("/embeddings"):
+                    server.requests["embeddings"] += 1
+                    self._send_json(server.embeddings_response(body))
+                elif self.path.endswith("/chat/completions"):
+                    server.requests["chat"] += 1
+                    if body.get("stream"):
+                        self._stream_chat(body)
+                    else:
+                        self._send_json(server.chat_response(body))
+                else:
+                    self.send_error(404)
+
+            def _send_json(self, payload, status=200, headers=None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream_chat(self, body):
+                time.sleep(server.chat_latency)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for token in server.completion_words():
+                    time.sleep(1.0 / server.token_rate)
+                    chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                             "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage = server.chat_response_usage(body)
+                    chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                             "choices": [], "usage": usage}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self._httpd.server_address[1]}/v1"
+
+    def admit(self, model):
+        """Takes one request from the model's per-second allowance; False (counted as throttled) if it is spent."""
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            allowance, updated = self._allowance.get(model, (self.rate_limit, now))
+            allowance = min(self.rate_limit, allowance + (now - updated) * self.rate_limit)
+            admitted = allowance >= 1
+            self._allowance[model] = (allowance - 1 if admitted else allowance, now)
+            if not admitted:
+                self.requests["throttled"] += 1
+            return admitted
+
+    def embeddings_response(self, body):
+        time.sleep(self.embedding_latency)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for i, text in enumerate(inputs):
+            vector = hashed_embedding(text, self.dim)
+            embedding = base64.b64encode(vector.tobytes()).decode() if body.get("encoding_format") == "base64" else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(text) // 4 + 1 for text in inputs)
+        return {"object": "list", "data": data, "model": body.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def completion_words(self):
+        return [f"{VOCABULARY[i % len(VOCABULARY)]} " for i in range(self.completion_tokens)]
+
+    def chat_response_usage(self, body):
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 + 1 for m in body.get("messages", []))
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": self.completion_tokens,
+                "total_tokens": prompt_tokens + self.completion_tokens}
+
+    def chat_response(self, body):
+        time.sleep(self.chat_latency + self.completion_tokens / self.token_rate)
+        return {"id": "bench", "object": "chat.completion", "created": 0, "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(self.completion_words())}, "finish_reason": "stop"}],
+                "usage": self.chat_response_usage(body)}
+
+    def __enter__(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+# --- PDF Extraction ---
+def legacy_two_pass_pdf_extract(file_path, image_dir):
+    """The previous extraction path: PyPDFLoader for text, then a second PyMuPDF pass for images."""
+    docs = PyPDFLoader(file_path).load()
+    extracted_text = "\n\n".join([doc.page_content for doc in docs])
+    image_paths = []
+    pdf_document = fitz.Document(file_path)
+    for page in pdf_document:
+        for img in page.get_images(full=True):
+            base_image = pdf_document.extract_image(img[0])
+            image_filename = os.path.join(image_dir, f"pdf_image_{len(image_paths)}.png")
+            with open(image_filename, "wb") as img_file:
+                img_file.write(base_image["image"])
+            image_paths.append(image_filename)
+    pdf_document.close()
+    return extracted_text, image_paths
+
+def single_pass_pdf_extract(file_path, workers):
+    pages = extract_pdf_pages(file_path, max_workers=workers)
+    return "\n\n".join(page["text"] for page in pages), [path for page in pages for path in page["images"]]
+
+def time_call(fn, repeat):
+    """Runs `fn` `repeat` times and returns the wall times in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def report(name, timings, units=None, unit_name="pages"):
+    median = statistics.median(timings)
+    line = f"{name:<32} median {median * 1000:9.1f} ms   min {min(timings) * 1000:9.1f} ms"
+    if units:
+        line += f"   {units / median:9.1f} {unit_name}/s"
+    print(line)
+
+def bench_pdf_extraction(args):
+    file_path = os.path.abspath(args.file) if args.file else None
+    work_dir = tempfile.mkdtemp(prefix="bench_pdf_")
+    cwd = os.getcwd()
+    # Extracted images land under IMAGE_DIR relative to the working directory, so run inside the scratch dir.
+    os.chdir(work_dir)
+    try:
+        file_path = file_path or make_synthetic_pdf(os.path.join(work_dir, "synthetic.pdf"), args.pages)
+        with fitz.open(file_path) as pdf_document:
+            pages = pdf_document.page_count
+        image_dir = os.path.join(work_dir, "images")
+        os.makedirs(image_dir)
+        os.makedirs(IMAGE_DIR)
+        print(f"{file_path}: {pages} pages, {args.repeat} runs each")
+
+        report("two-pass (PyPDFLoader + fitz)", time_call(lambda: legacy_two_pass_pdf_extract(file_path, image_dir), args.repeat), pages)
+        report("single-pass, 1 process", time_call(lambda: single_pass_pdf_extract(file_path, 1), args.repeat), pages)
+        if args.workers > 1:
+            single_pass_pdf_extract(file_path, args.workers)  # warm up the process pool
+            report(f"single-pass, {args.workers} processes", time_call(lambda: single_pass_pdf_extract(file_path, args.workers), args.repeat), pages)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Pipeline Stages ---
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageReport:
+    """Collects per-stage latency samples and prints throughput, p50/p95 latency and peak RSS."""
+    def __init__(self):
+        self.rows = []
+
+    def measure(self, stage, size, units, unit_name, fn, repeat, setup=None):
+        timings, result = [], None
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            result = fn()
+            timings.append(time.perf_counter() - start)
+        self.rows.append({
+            "stage": stage, "size": size, "runs": repeat,
+            "p50_ms": percentile(timings, 50) * 1000, "p95_ms": percentile(timings, 95) * 1000,
+            "throughput": units / statistics.median(timings) if units else 0.0, "unit": unit_name,
+            "peak_rss_mb": peak_rss_mb(),
+        })
+        return result
+
+    def print(self):
+        print(f"{'stage':<34}{'size':>6}{'runs':>6}{'p50 ms':>11}{'p95 ms':>11}{'throughput':>24}{'peak RSS MB':>13}")
+        for row in self.rows:
+            throughput = f"{row['throughput']:.1f} {row['unit']}/s"
+            print(f"{row['stage']:<34}{row['size']:>6}{row['runs']:>6}{row['p50_ms']:>11.1f}{row['p95_ms']:>11.1f}"
+                  f"{throughput:>24}{row['peak_rss_mb']:>13.1f}")
+
+def reset_persistent_caches():
+    """Drops the on-disk and process-wide caches so the next stage run starts cold."""
+    import llm_utils, kb_store, file_utils, prompt_utils
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    llm_utils._default_embedding_cache = None
+    llm_utils._default_llm_cache = None
+    kb_store._default_store = None
+    file_utils._default_extraction_cache = None
+    prompt_utils._default_digester = None
+
+def bench_pipeline(args):
+    from client_registry import get_client_registry
+    from file_utils import _extract_text_and_images, convert_md_to_docx, convert_md_to_pdf
+    from llm_utils import (
+        create_kb_from_texts, parse_template_sections, retrieve_section_contexts, generate_section_content
+    )
+
+    work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    report = StageReport()
+    sections = parse_template_sections(DEFAULT_PROPOSAL_TEMPLATE)
+    try:
+        with FakeOpenAIServer(dim=args.dim, embedding_latency=args.embedding_latency, chat_latency=args.chat_latency,
+                              token_rate=args.token_rate, completion_tokens=args.completion_tokens) as server:
+            print(f"fake OpenAI endpoint at {server.base_url}, dim={args.dim}")
+            for size in args.sizes:
+                pdf_path = make_synthetic_pdf(os.path.join(work_dir, f"corpus_{size}.pdf"), size)
+                with open(pdf_path, "rb") as f:
+                    pdf_bytes = f.read()
+                docx_bytes = make_synthetic_docx(synthetic_paragraphs(size * 10, seed=size))
+
+                # Extraction bypasses the extraction cache so every run parses the file.
+                extracted = report.measure("extract_text_from_file (pdf)", size, size, "pages",
+                                           lambda: _extract_text_and_images("corpus.pdf", pdf_bytes), args.repeat)
+                docx_extracted = report.measure("extract_text_from_file (docx)", size, size * 10, "paragraphs",
+                                                lambda: _extract_text_and_images("corpus.docx", docx_bytes), args.repeat)
+
+                texts = [extracted["text"], docx_extracted["text"]]
+                chars = sum(len(text) for text in texts)
+                build_kb = lambda: create_kb_from_texts(texts, args.embedding_model, "bench-key", server.base_url,
+                                                        names=["corpus.pdf", "corpus.docx"])
+                report.measure("create_kb_from_texts (cold)", size, chars / 1000, "kchars", build_kb, args.repeat,
+                               setup=reset_persistent_caches)
+                knowledge_base = report.measure("create_kb_from_texts (warm)", size, chars / 1000, "kchars", build_kb, args.repeat)
+
+                requirements = "\n".join(synthetic_paragraphs(20, seed=size + 1))
+                contexts = report.measure("retrieval (all sections)", size, len(sections), "sections",
+                                          lambda: retrieve_section_contexts(knowledge_base, sections, requirements), args.repeat)
+
+                llm = get_client_registry().chat_model(args.llm_model, "bench-key", server.base_url, temperature=0.2)
+                # The response cache is bypassed so every run measures a model call.
+                content = report.measure("generate_section_content", size, 1, "sections",
+                                         lambda: generate_section_content(sections[0], requirements, contexts[0], llm, use_cache=False),
+                                         args.repeat)
+
+                proposal = "# Proposal\n\n" + "\n\n".join([content] * size)
+                output_docx = os.path.join(work_dir, "proposal.docx")
+                output_pdf = os.path.join(work_dir, "proposal.pdf")
+                report.measure("convert_md_to_docx", size, len(proposal) / 1000, "kchars",
+                               lambda: convert_md_to_docx(proposal, output_docx), args.repeat)
+                report.measure("convert_md_to_pdf", size, len(proposal) / 1000, "kchars",
+                               lambda: convert_md_to_pdf(proposal, output_pdf), args.repeat)
+            print(f"requests served: {server.requests}")
+        report.print()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Knowledge-Base Build ---
+def bench_kb_build(args):
+    import kb_store
+    from file_utils import extract_file, extract_files
+    from llm_utils import create_kb_from_documents
+
+    work_dir = tempfile.mkdtemp(prefix="bench_kb_build_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        files = []
+        for i in range(args.files):
+            path = make_synthetic_pdf(os.path.join(work_dir, f"file_{i}.pdf"), args.pages, images_per_page=0, seed=i + 1)
+            with open(path, "rb") as f:
+                files.append((f"file_{i}.pdf", f.read()))
+        # Spawns the extraction worker processes before timing anything.
+        list(extract_files(files[:1]))
+
+        def sequential():
+            # The previous build: every file extracted in turn, then one embedding batch at a time.
+            kb_store._default_store = kb_store.KnowledgeBaseStore(embed_workers=1, max_pending_batches=1)
+            documents = []
+            for name, data in files:
+                result = extract_file(name, data)
+                documents.append({"name": name, "text": result["text"], "pages": result["pages"]})
+            return create_kb_from_documents(documents, args.embedding_model, "bench-key", server.base_url)
+
+        def pipelined():
+            documents = ({"name": files[i][0], "text": result["text"], "pages": result["pages"]}
+                         for i, result in extract_files(files))
+            return create_kb_from_documents(documents, args.embedding_model, "bench-key", server.base_url)
+
+        with FakeOpenAIServer(dim=args.dim, embedding_latency=args.embedding_latency) as server:
+            print(f"{args.files} PDFs of {args.pages} pages, {args.embedding_latency * 1000:.0f} ms per embedding request, cold caches")
+            for name, build in [("sequential", sequential), ("pipelined", pipelined)]:
+                timings = []
+                for _ in range(args.repeat):
+                    reset_persistent_caches()
+                    start = time.perf_counter()
+                    knowledge_base = build()
+                    timings.append(time.perf_counter() - start)
+                print(f"{name:<12} median {statistics.median(timings):8.2f} s   min {min(timings):8.2f} s   "
+                      f"{knowledge_base.index.ntotal} chunks")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Index Backends ---
+def clustered_vectors(count, dim, clusters, seed=0):
+    """Unit vectors scattered around random centres; closer to real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, count)] + rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def bench_index(args):
+    from kb_store import reindex, configure_index
+
+    for count in args.vectors:
+        vectors = clustered_vectors(count + args.queries, args.dim, args.clusters)
+        corpus, queries = vectors[:count], vectors[count:]
+        flat = faiss.IndexFlatL2(args.dim)
+        flat.add(corpus)
+        flat_bytes = faiss.serialize_index(flat).nbytes
+        _, truth = flat.search(queries, args.k)
+        print(f"{count} vectors, dim={args.dim}, {args.queries} held-out queries, recall@{args.k} against Flat")
+
+        print(f"{'index':<24}{'built as':<24}{'build s':>9}{'size MB':>10}{'smaller':>9}{'search ms/q':>13}{f'recall@{args.k}':>11}")
+        for factory in args.factories:
+            start = time.perf_counter()
+            index, description = (flat, "Flat") if factory == "Flat" else reindex(flat, factory, max_train_points=args.train_points)
+            build_seconds = time.perf_counter() - start
+            configure_index(index, args.nprobe)
+            size = faiss.serialize_index(index).nbytes
+            timings = time_call(lambda: index.search(queries, args.k), args.repeat)
+            _, found = index.search(queries, args.k)
+            recall = np.mean([len(set(row) & set(expected)) / args.k for row, expected in zip(found, truth)])
+            print(f"{factory:<24}{description:<24}{build_seconds:>9.2f}{size / 2**20:>10.1f}{flat_bytes / size:>8.1f}x"
+                  f"{statistics.median(timings) / args.queries * 1000:>13.3f}{recall:>11.3f}")
+        print()
+
+# --- Retrieval Modes ---
+PRODUCT_NAME_CHARACTERS = "天河星海云图智联数安瑞泽宏远恒信达通明德华盛嘉和"
+
+def exact_term_corpus(documents, paragraphs, seed=0, words=60):
+    """Returns (texts, paragraphs): synthetic documents in which every paragraph names one unique exact term.
+
+    `paragraphs` lists (term, topic words of the paragraph) for building queries.
+    Terms cycle through product codes ("XQ-00042"), clause numbers ("3.12.7") and Chinese
+    product names ("星海智联平台"), the identifiers requirement documents quote verbatim.
+    """
+    rng = random.Random(seed)
+    texts, terms, paragraphs_by_term, seen = [], [], [], set()
+    for d in range(documents):
+        body = []
+        for p in range(paragraphs):
+            kind = len(terms) % 3
+            if kind == 0:
+                term = f"XQ-{len(terms):05d}"
+            elif kind == 1:
+                term = f"{d + 1}.{p + 1}.7"
+            else:
+                term = "".join(rng.sample(PRODUCT_NAME_CHARACTERS, 4)) + "平台"
+                while term in seen:
+                    term = "".join(rng.sample(PRODUCT_NAME_CHARACTERS, 4)) + "平台"
+            seen.add(term)
+            terms.append(term)
+            topic = [rng.choice(VOCABULARY) for _ in range(words)]
+            paragraphs_by_term.append((term, topic))
+            body.append(" ".join(topic[:words // 2] + [term] + topic[words // 2:]))
+        texts.append("\n\n".join(body))
+    return texts, paragraphs_by_term
+
+def bench_retrieval(args):
+    from llm_utils import EmbeddingCache, create_kb_from_texts, retrieve_section_contexts
+
+    work_dir = tempfile.mkdtemp(prefix="bench_retrieval_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        reset_persistent_caches()
+        texts, paragraphs = exact_term_corpus(args.documents, args.paragraphs)
+        rng = random.Random(1)
+        # Queries have the shape the app sends: each template section names the exact term in its
+        # title among a few topic words of the paragraph it comes from, and every section shares
+        # one requirements text, as sections of one proposal do.
+        sampled = rng.sample(paragraphs, min(args.queries, len(paragraphs)))
+        targets = [term for term, _ in sampled]
+        queries = []
+        for term, topic in sampled:
+            title = " ".join(rng.sample(topic, args.query_words)) + f" {term}"
+            queries.append({"title": title, "content": f"## {title}\n[描述{term}的交付方式和验收标准。]\n"})
+        requirements = "\n\n".join(synthetic_paragraphs(args.requirement_paragraphs, seed=2))
+        with FakeOpenAIServer(dim=args.dim, embedding_latency=0) as server:
+            knowledge_base = create_kb_from_texts(texts, args.embedding_model, "bench-key", server.base_url)
+            chunks = knowledge_base.index.ntotal
+            print(f"{chunks} chunks in {args.documents} documents, dim={args.dim}, {len(queries)} exact-term sections "
+                  f"sharing {args.requirement_paragraphs} requirement paragraphs, recall@{args.k}, "
+                  f"{args.embedding_latency * 1000:.0f} ms per embedding request")
+            print(f"{'mode':<10}{f'recall@{args.k}':>11}{'p50 ms':>10}{'p95 ms':>10}{'embedding calls':>17}{'distinct contexts':>19}")
+            server.embedding_latency = args.embedding_latency
+            for mode in args.modes:
+                # A fresh embedding cache per mode, so every query pays its embedding call as a new query would.
+                knowledge_base.embedding_function.cache = EmbeddingCache(os.path.join(work_dir, f"queries-{mode}.sqlite3"))
+                requests_before = server.requests["embeddings"]
+                timings, hits = [], 0
+                contexts = set()
+                for section, term in zip(queries, targets):
+                    start = time.perf_counter()
+                    context = retrieve_section_contexts(knowledge_base, [section], requirements, k=args.k,
+                                                        use_mmr=False, max_tokens=10 ** 6, mode=mode)[0]
+                    timings.append(time.perf_counter() - start)
+                    hits += term in context
+                    contexts.add(context)
+                calls = server.requests["embeddings"] - requests_before
+                print(f"{mode:<10}{hits / len(queries):>11.3f}{percentile(timings, 50) * 1000:>10.2f}"
+                      f"{percentile(timings, 95) * 1000:>10.2f}{calls:>17}{len(contexts):>19}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- API Scheduler ---
+def bench_scheduler(args):
+    import api_scheduler
+    import client_registry
+    from api_scheduler import INTERACTIVE, request_priority, set_request_session
+    from nebius_embeddings import NebiusEmbeddings
+    from llm_utils import parse_template_sections, generate_section_content
+
+    sections = parse_template_sections(DEFAULT_PROPOSAL_TEMPLATE)[:args.sections]
+    requirements = "\n".join(synthetic_paragraphs(5, seed=99))
+    corpora = [synthetic_paragraphs(args.chunks, seed=i + 1) for i in range(args.bulk_sessions)]
+
+    def run(scheduled, base_url):
+        api_scheduler._default_scheduler = None
+        client_registry._default_registry = client_registry.ClientRegistry(use_scheduler=scheduled)
+        samples = defaultdict(list)
+        failures = defaultdict(int)
+        lock = threading.Lock()
+
+        def timed(kind, fn):
+            start = time.perf_counter()
+            try:
+                fn()
+            except Exception:
+                with lock:
+                    failures[kind] += 1
+            with lock:
+                samples[kind].append(time.perf_counter() - start)
+
+        def bulk_session(i):
+            # A knowledge-base build: many batches at once on the embedding model.
+            set_request_session(f"bulk-{i}")
+            embeddings = NebiusEmbeddings(args.embedding_model, "bench-key", base_url, cache=False,
+                                          max_workers=args.bulk_workers)
+            timed("kb build", lambda: embeddings.embed_documents(corpora[i]))
+
+        def query_session(i):
+            # Retrieval for a user waiting on a section: one small batch on the same model.
+            set_request_session(f"query-{i}")
+            embeddings = NebiusEmbeddings(args.embedding_model, "bench-key", base_url, cache=False)
+            for j in range(args.queries):
+                with request_priority(INTERACTIVE):
+                    timed("query embedding", lambda: embeddings.embed_documents([f"{requirements} {i} {j}"]))
+
+        def section_session(i):
+            set_request_session(f"section-{i}")
+            llm = client_registry.get_client_registry().chat_model(args.llm_model, "bench-key", base_url)
+            for section in sections:
+                timed("section", lambda: generate_section_content(section, requirements, "", llm, use_cache=False))
+
+        threads = [threading.Thread(target=bulk_session, args=(i,)) for i in range(args.bulk_sessions)]
+        threads += [threading.Thread(target=query_session, args=(i,)) for i in range(args.query_sessions)]
+        threads += [threading.Thread(target=section_session, args=(i,)) for i in range(args.section_sessions)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client_registry._default_registry.close()
+        return samples, failures, time.perf_counter() - start
+
+    work_dir = tempfile.mkdtemp(prefix="bench_scheduler_")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        print(f"{args.bulk_sessions} KB builds of {args.chunks} chunks, {args.query_sessions} x {args.queries} query embeddings, "
+              f"{args.section_sessions} x {len(sections)} sections; {args.rate_limit} requests/s per model, "
+              f"Retry-After {args.retry_after}s")
+        print(f"{'mode':<12}{'requests':<18}{'calls':>7}{'failed':>8}{'p50 s':>9}{'p95 s':>9}{'429s':>7}{'wall s':>9}")
+        for name, scheduled in [("direct", False), ("scheduled", True)]:
+            with FakeOpenAIServer(dim=args.dim, embedding_latency=args.embedding_latency, chat_latency=args.chat_latency,
+                                  completion_tokens=args.completion_tokens, token_rate=args.token_rate,
+                                  rate_limit=args.rate_limit, retry_after=args.retry_after) as server:
+                samples, failures, wall = run(scheduled, server.base_url)
+                for i, kind in enumerate(("query embedding", "section", "kb build")):
+                    timings = samples[kind]
+                    throttled = f"{server.requests['throttled']:>7}{wall:>9.2f}" if i == 0 else ""
+                    print(f"{name if i == 0 else '':<12}{kind:<18}{len(timings):>7}{failures[kind]:>8}"
+                          f"{percentile(timings, 50):>9.2f}{percentile(timings, 95):>9.2f}{throttled}")
+    finally:
+        client_registry._default_registry = None
+        api_scheduler._default_scheduler = None
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Startup ---
+# Modules the first page render must not import; each is deferred to the code path that needs it.
+DEFERRED_MODULES = (
+    "weasyprint", "fitz", "docx", "markdown", "faiss", "openai", "langchain_openai",
+    "langchain_core", "langchain_community", "langchain_text_splitters",
+)
+
+# Renders the app once (like a new browser session on a fresh pod) and reports what it imported.
+STARTUP_PROBE = """
+import sys, json, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file(sys.argv[1], default_timeout=300).run()
+seconds = time.perf_counter() - start
+print(json.dumps({
+    "seconds": seconds,
+    "errors": [str(e.value) for e in app.exception],
+    "modules": sorted(m for m in sys.argv[2:] if m in sys.modules),
+}))
+"""
+
+def run_startup_probe(app_path, work_dir, importtime=False):
+    """Runs the probe in a fresh interpreter; returns its result and the `-X importtime` log."""
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", STARTUP_PROBE, app_path, *DEFERRED_MODULES]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(app_path), os.environ.get("PYTHONPATH")])))
+    completed = subprocess.run(command, capture_output=True, text=True, cwd=work_dir, env=env, timeout=600)
+    if completed.returncode != 0:
+        raise RuntimeError(f"startup probe failed:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+def import_profile(importtime_log):
+    """Sums the `-X importtime` self time per top-level package, in seconds."""
+    totals = defaultdict(float)
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, _, name = (part.strip() for part in re.split(r"[:|]", line, maxsplit=3))
+        totals[name.split(".")[0]] += int(self_us) / 1e6
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+def bench_startup(args):
+    app_path = os.path.abspath(args.app)
+    work_dir = tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        # Cold runs: each in a new interpreter, as on a freshly scheduled pod.
+        runs = [run_startup_probe(app_path, work_dir)[0] for _ in range(args.repeat)]
+        profiled, importtime_log = run_startup_probe(app_path, work_dir, importtime=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    timings = [run["seconds"] for run in runs]
+    median = statistics.median(timings)
+    print(f"first render of {os.path.basename(app_path)}: median {median:.2f} s, min {min(timings):.2f} s "
+          f"over {args.repeat} cold starts (budget {args.budget:.2f} s)")
+    print(f"\nimport profile (self time per package, -X importtime, top {args.top}):")
+    for package, seconds in import_profile(importtime_log)[:args.top]:
+        print(f"  {package:<32}{seconds * 1000:9.1f} ms")
+
+    failures = []
+    if median > args.budget:
+        failures.append(f"cold start {median:.2f} s exceeds the {args.budget:.2f} s budget")
+    if profiled["modules"]:
+        failures.append(f"deferred modules imported at startup: {', '.join(profiled['modules'])}")
+    if profiled["errors"]:
+        failures.append(f"the app raised: {profiled['errors'][0]}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the proposal generator pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pdf_parser = subparsers.add_parser("pdf", help="Compare the two-pass and single-pass PDF extractors.")
+    pdf_parser.add_argument("--file", help="PDF to extract (default: a synthetic document).")
+    pdf_parser.add_argument("--pages", type=int, default=300, help="Page count of the synthetic PDF.")
+    pdf_parser.add_argument("--workers", type=int, default=4, help="Worker processes for the single-pass extractor.")
+    pdf_parser.add_argument("--repeat", type=int, default=3)
+    pdf_parser.set_defaults(func=bench_pdf_extraction)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Time every pipeline stage against a local fake OpenAI endpoint.")
+    pipeline_parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="Synthetic corpus sizes, in PDF pages.")
+    pipeline_parser.add_argument("--repeat", type=int, default=3)
+    pipeline_parser.add_argument("--dim", type=int, default=256, help="Embedding dimension served by the fake endpoint.")
+    pipeline_parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds added to each embeddings request.")
+    pipeline_parser.add_argument("--chat-latency", type=float, default=0.2, help="Seconds before the first completion token.")
+    pipeline_parser.add_argument("--token-rate", type=float, default=200.0, help="Completion tokens per second.")
+    pipeline_parser.add_argument("--completion-tokens", type=int, default=200)
+    pipeline_parser.add_argument("--embedding-model", default="bench/embedding")
+    pipeline_parser.add_argument("--llm-model", default="bench/chat")
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    build_parser = subparsers.add_parser("kb-build", help="Compare extracting every file before embedding with the pipelined knowledge-base build.")
+    build_parser.add_argument("--files", type=int, default=8)
+    build_parser.add_argument("--pages", type=int, default=40, help="Pages per synthetic PDF.")
+    build_parser.add_argument("--repeat", type=int, default=3)
+    build_parser.add_argument("--dim", type=int, default=256, help="Embedding dimension served by the fake endpoint.")
+    build_parser.add_argument("--embedding-latency", type=float, default=0.2, help="Seconds added to each embeddings request.")
+    build_parser.add_argument("--embedding-model", default="bench/embedding")
+    build_parser.set_defaults(func=bench_kb_build)
+
+    index_parser = subparsers.add_parser("index", help="Compare knowledge-base index backends: size, search time and recall against Flat.")
+    index_parser.add_argument("--factories", nargs="+", default=KB_INDEX_OPTIONS, help="faiss index_factory descriptions (see KB_INDEX_FACTORY).")
+    index_parser.add_argument("--vectors", type=int, nargs="+", default=[1_500, 20_000],
+                              help="Corpus sizes; small corpora fall back to indexes that need fewer training points.")
+    index_parser.add_argument("--queries", type=int, default=500, help="Held-out queries drawn from the corpus distribution.")
+    index_parser.add_argument("--dim", type=int, default=3584, help="Vector dimension (3584 for BAAI/bge-multilingual-gemma2).")
+    index_parser.add_argument("--clusters", type=int, default=200, help="Topic clusters in the synthetic corpus.")
+    index_parser.add_argument("--k", type=int, default=5, help="Neighbours compared for recall (RETRIEVAL_K).")
+    index_parser.add_argument("--nprobe", type=int, default=KB_INDEX_NPROBE)
+    index_parser.add_argument("--train-points", type=int, default=KB_INDEX_MAX_TRAIN_POINTS)
+    index_parser.add_argument("--repeat", type=int, default=3)
+    index_parser.set_defaults(func=bench_index)
+
+    retrieval_parser = subparsers.add_parser("retrieval", help="Compare dense, hybrid and lexical retrieval: exact-term recall and query latency.")
+    retrieval_parser.add_argument("--modes", nargs="+", default=RETRIEVAL_MODES, choices=RETRIEVAL_MODES)
+    retrieval_parser.add_argument("--documents", type=int, default=20)
+    retrieval_parser.add_argument("--paragraphs", type=int, default=100, help="Paragraphs per document, each naming one exact term.")
+    retrieval_parser.add_argument("--queries", type=int, default=200)
+    retrieval_parser.add_argument("--query-words", type=int, default=6, help="Topic words of the target paragraph in each section title.")
+    retrieval_parser.add_argument("--requirement-paragraphs", type=int, default=20, help="Paragraphs of the requirements text shared by all sections.")
+    retrieval_parser.add_argument("--k", type=int, default=RETRIEVAL_K)
+    retrieval_parser.add_argument("--dim", type=int, default=256, help="Embedding dimension served by the fake endpoint.")
+    retrieval_parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds added to each embeddings request.")
+    retrieval_parser.add_argument("--embedding-model", default="bench/embedding")
+    retrieval_parser.set_defaults(func=bench_retrieval)
+
+    scheduler_parser = subparsers.add_parser("scheduler", help="Compare direct API calls with the shared API scheduler against a rate-limited endpoint.")
+    scheduler_parser.add_argument("--rate-limit", type=float, default=10, help="Requests per second each model accepts before answering 429.")
+    scheduler_parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with each 429.")
+    scheduler_parser.add_argument("--bulk-sessions", type=int, default=2, help="Concurrent knowledge-base builds.")
+    scheduler_parser.add_argument("--chunks", type=int, default=1500, help="Chunks embedded per knowledge-base build.")
+    scheduler_parser.add_argument("--bulk-workers", type=int, default=8, help="Embedding requests each build keeps in flight.")
+    scheduler_parser.add_argument("--query-sessions", type=int, default=2)
+    scheduler_parser.add_argument("--queries", type=int, default=10, help="Query embeddings per query session, one after another.")
+    scheduler_parser.add_argument("--section-sessions", type=int, default=6)
+    scheduler_parser.add_argument("--sections", type=int, default=2, help="Sections generated per section session.")
+    scheduler_parser.add_argument("--dim", type=int, default=256, help="Embedding dimension served by the fake endpoint.")
+    scheduler_parser.add_argument("--embedding-latency", type=float, default=0.2, help="Seconds added to each embeddings request.")
+    scheduler_parser.add_argument("--chat-latency", type=float, default=0.3, help="Seconds before the first completion token.")
+    scheduler_parser.add_argument("--token-rate", type=float, default=500.0, help="Completion tokens per second.")
+    scheduler_parser.add_argument("--completion-tokens", type=int, default=100)
+    scheduler_parser.add_argument("--embedding-model", default="bench/embedding")
+    scheduler_parser.add_argument("--llm-model", default="bench/chat")
+    scheduler_parser.set_defaults(func=bench_scheduler)
+
+    startup_parser = subparsers.add_parser("startup", help="Measure the app's cold start and import profile; fail past a budget.")
+    startup_parser.add_argument("--app", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_cn.py"))
+    startup_parser.add_argument("--budget", type=float, default=3.0, help="Maximum median seconds to the first render.")
+    startup_parser.add_argument("--repeat", type=int, default=3)
+    startup_parser.add_argument("--top", type=int, default=15, help="Packages shown in the import profile.")
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# cache_utils.py
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import regex as re
+
+def normalize_text(text: str) -> str:
+    """Normalizes text so that formatting-only differences map to the same cache key."""
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def content_hash(*parts) -> str:
+    """Returns a stable SHA-256 hex digest over the given str/bytes parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+class SQLiteCache:
+    """A thread-safe, size-bounded key/value cache persisted in a SQLite file.
+
+    Entries are evicted least-recently-used first once `max_entries` is exceeded,
+    and entries older than `ttl_seconds` (if set) are treated as misses.
+    """
+    def __init__(self, path: str, max_entries: int = 100_000, ttl_seconds: float = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+
+    def get_many(self, keys):
+        """Returns a dict of the cached values for whichever of `keys` are present."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, value, created FROM cache WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, value, created in rows:
+                    if self.ttl_seconds is not None and now - created > self.ttl_seconds:
+                        continue
+                    found[key] = value
+            if found:
+                self._conn.executemany(
+                    "UPDATE cache SET accessed = ? WHERE key = ?", [(now, key) for key in found]
+                )
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items):
+        """Stores an iterable of (key, bytes) pairs, then evicts down to `max_entries`."""
+        now = time.time()
+        rows = [(key, value, now, now) for key, value in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)", rows
+                )
+                self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _evict(self):
+        if self.ttl_seconds is not None:
+            self._conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl_seconds,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        """Returns hit/miss counters and the current entry count."""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,122 @@
+# client_registry.py
+
+import logging
+import threading
+from collections import OrderedDict
+import httpx
+from config import (
+    HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS, HTTP_USE_HTTP2, HTTP_MAX_CACHED_CLIENTS
+)
+from cache_utils import content_hash
+from api_scheduler import ScheduledTransport, get_api_scheduler
+
+logger = logging.getLogger(__name__)
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401  (httpx needs the optional `h2` package for HTTP/2)
+        return True
+    except ImportError:
+        return False
+
+class ClientRegistry:
+    """Process-wide API clients that share pooled keep-alive HTTP connections.
+
+    One `httpx.Client` per base URL holds the connection pool; OpenAI clients are cached per
+    (base_url, api_key) and chat models per (base_url, api_key, model, settings), so reruns and
+    sessions reuse open connections instead of paying a new TCP/TLS handshake per client.
+    Both caches key on a hash of the API key and keep the `max_cached_clients` most recently
+    used entries; evicted clients share the pooled connections, so dropping them closes nothing.
+    Model requests on these connections pass through the process-wide API scheduler, which
+    shares each model's request budget fairly across sessions (see api_scheduler.py).
+    """
+    def __init__(self, max_connections: int = HTTP_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY_SECONDS,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout: float = HTTP_READ_TIMEOUT_SECONDS, http2: bool = HTTP_USE_HTTP2, use_scheduler: bool = True,
+                 max_cached_clients: int = HTTP_MAX_CACHED_CLIENTS):
+        self.limits = httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.http2 = http2 and _http2_available()
+        if http2 and not self.http2:
+            logger.warning("HTTP/2 requested but the 'h2' package is not installed; using HTTP/1.1 keep-alive.")
+        self.scheduler = get_api_scheduler() if use_scheduler else None
+        self.max_cached_clients = max_cached_clients
+        self._http_clients = {}
+        self._openai_clients = OrderedDict()
+        self._chat_models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def http_client(self, base_url: str) -> httpx.Client:
+        """Returns the pooled HTTP client for a base URL."""
+        with self._lock:
+            return self._http_client(base_url)
+
+    def openai_client(self, base_url: str, api_key: str, max_retries: int = 0):
+        """Returns a cached OpenAI client; retries default to 0 because callers retry per batch."""
+        from openai import OpenAI  # the SDK is slow to import; defer it until a client is needed
+        key = (base_url, content_hash(api_key), max_retries)
+        return self._cached(self._openai_clients, key, base_url, lambda http_client: OpenAI(
+            base_url=base_url, api_key=api_key, max_retries=max_retries, timeout=self.timeout, http_client=http_client
+        ))
+
+    def chat_model(self, model: str, api_key: str, base_url: str, temperature: float = 0.2, **kwargs):
+        """Returns a cached ChatOpenAI for (base_url, api_key, model) and the given settings."""
+        from langchain_openai import ChatOpenAI
+        key = (base_url, content_hash(api_key), model, temperature, tuple(sorted(kwargs.items())))
+        return self._cached(self._chat_models, key, base_url, lambda http_client: ChatOpenAI(
+            model=model, temperature=temperature, api_key=api_key, base_url=base_url,
+            timeout=self.timeout, http_client=http_client, **kwargs
+        ))
+
+    def _http_client(self, base_url: str) -> httpx.Client:
+        # Callers hold self._lock, so concurrent sessions never create two pools for one base URL.
+        client = self._http_clients.get(base_url)
+        if client is None:
+            transport = httpx.HTTPTransport(limits=self.limits, http2=self.http2)
+            if self.scheduler is not None:
+                transport = ScheduledTransport(transport, self.scheduler)
+            client = httpx.Client(transport=transport, timeout=self.timeout)
+            self._http_clients[base_url] = client
+        return client
+
+    def _cached(self, cache: OrderedDict, key, base_url: str, create):
+        """Returns cache[key], creating it on the base URL's pool if missing and evicting the least
+        recently used entries; lookup, insert and eviction happen under one lock."""
+        with self._lock:
+            value = cache.get(key)
+            if value is None:
+                value = cache[key] = create(self._http_client(base_url))
+                while len(cache) > self.max_cached_clients:
+                    cache.popitem(last=False)
+            else:
+                cache.move_to_end(key)
+            return value
+
+    def close(self):
+        """Drops all cached clients, then closes the connection pools once no longer reachable from the registry."""
+        with self._lock:
+            http_clients = list(self._http_clients.values())
+            self._http_clients.clear()
+            self._openai_clients.clear()
+            self._chat_models.clear()
+        for client in http_clients:
+            client.close()
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+def get_client_registry() -> ClientRegistry:
+    """Returns the process-wide client registry."""
+    global _default_registry
+    if _default_registry is None:
+        # Sessions start concurrently; a second registry would open its own connection pools.
+        with _default_registry_lock:
+            if _default_registry is None:
+                _default_registry = ClientRegistry()
+    return _default_registry
@@ -1,5 +1,7 @@
 # config.py
 
+import os
+
 # Default proposal template in markdown format
 DEFAULT_PROPOSAL_TEMPLATE = """
 # 提案
@@ -29,6 +31,9 @@ DEFAULT_PROPOSAL_TEMPLATE = """
 [简要介绍提案实体，重点介绍相关项目、优势或领域专业知识。]
 """
 
+# OpenAI-compatible Nebius AI Studio endpoint used for embeddings and chat completions
+NEBIUS_BASE_URL = "https://api.studio.nebius.com/v1/"
+
 # Available embedding models for selection
 EMBEDDING_MODEL_OPTIONS = [
     "BAAI/bge-multilingual-gemma2",
@@ -43,5 +48,186 @@ TEXT_MODEL_OPTIONS = [
     "meta-llama/Llama-3.3-70B-Instruct",
 ]
 
-# Directory for storing extracted images
-IMAGE_DIR = "extracted_images"
\ No newline at end of file
+# Directory for storing extracted images (shared source documents plus per-session image folders)
+IMAGE_DIR = "extracted_images"
+
+# Per-session image folders and unused source documents are removed after this many seconds
+IMAGE_SESSION_TTL_SECONDS = 24 * 60 * 60
+
+# Directory for persistent on-disk caches
+CACHE_DIR = ".cache"
+
+# Embedding cache: keyed by (embedding model, normalized chunk hash), LRU-evicted past the entry cap
+EMBEDDING_CACHE_PATH = f"{CACHE_DIR}/embeddings.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = 200_000
+
+# Embedding request batching: max chunks and estimated tokens per request, parallel requests,
+# and retries (exponential backoff starting at the base delay in seconds) on 429/5xx
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_BATCH_MAX_TOKENS = 8000
+EMBEDDING_MAX_WORKERS = 4
+EMBEDDING_MAX_RETRIES = 5
+EMBEDDING_RETRY_BASE_DELAY = 1.0
+
+# Persisted FAISS knowledge bases (one directory per corpus) and chunking parameters
+KB_STORE_DIR = f"{CACHE_DIR}/knowledge_bases"
+KB_STORE_MAX_CORPORA = 50
+KB_CHUNK_SIZE = 1000
+KB_CHUNK_OVERLAP = 100
+# Chunks generated and embedded per step while building; bounds the build's peak memory
+KB_ADD_BATCH_SIZE = 256
+# Pipelined build: batches embedded concurrently while later documents are still being extracted
+# and chunked, with at most KB_MAX_PENDING_BATCHES batches queued or in flight
+KB_EMBED_WORKERS = 4
+KB_MAX_PENDING_BATCHES = 8
+
+# Vector index backend, as a faiss.index_factory description:
+#   "Flat"                  exact search over float32 vectors
+#   "SQfp16" / "SQ8"        float16 / int8 scalar quantization (2x / 4x smaller)
+#   "IVF{nlist},SQ8"        clustered, searching only KB_INDEX_NPROBE clusters per query
+#   "IVF{nlist},PQ{pq_m}x4fs" clustered with 4-bit fast-scan product quantization (16x smaller)
+#   "PCA{dim},..." prefix   reduces the vector dimension first, e.g. "PCA1024,SQ8"
+# {nlist} and {pq_m} are derived from the corpus size and vector dimension. Indexes that need
+# training fall back to "Flat" below KB_INDEX_MIN_TRAIN_POINTS chunks, and to "SQ8" below the
+# 39 training points per k-means centroid faiss needs (e.g. 256 * 39 for 8-bit "PQ{m}").
+# Compare recall against "Flat" with `python benchmark.py index`.
+KB_INDEX_FACTORY = "Flat"
+KB_INDEX_OPTIONS = ["Flat", "SQfp16", "SQ8", "IVF{nlist},SQ8", "IVF{nlist},PQ{pq_m}x4fs", "PCA1024,SQ8"]
+KB_INDEX_MIN_TRAIN_POINTS = 1000
+# Chunks sampled (evenly across the corpus) to train an index
+KB_INDEX_MAX_TRAIN_POINTS = 20_000
+KB_INDEX_NPROBE = 16
+
+# Knowledge bases loaded in memory, shared by all sessions of the process (keyed by corpus).
+# Entries no session references are evicted least-recently-used first above the memory cap;
+# a session's reference lapses after it has been idle for the TTL.
+KB_REGISTRY_MAX_BYTES = 2 * 1024 ** 3
+KB_REGISTRY_SESSION_TTL_SECONDS = 2 * 60 * 60
+
+# Number of sections generated concurrently in "generate all" mode
+GENERATION_MAX_CONCURRENCY = 4
+
+# Number of knowledge-base chunks retrieved as context for each section
+RETRIEVAL_K = 5
+
+# Extraction cache for uploaded files: entries kept on disk and in memory
+EXTRACTION_CACHE_PATH = f"{CACHE_DIR}/extractions.sqlite3"
+EXTRACTION_CACHE_MAX_ENTRIES = 1000
+EXTRACTION_MEMORY_CACHE_MAX_ENTRIES = 32
+
+# PDF extraction: documents longer than one task's page range are split across worker processes
+PDF_EXTRACTION_MAX_WORKERS = 4
+PDF_PAGES_PER_TASK = 50
+# Files extracted at once while building a knowledge base; their PDF page ranges share the worker processes
+EXTRACTION_MAX_CONCURRENT_FILES = 4
+
+# Background DOCX/PDF export: render threads, cached renders, and how long a rerun waits for a render
+EXPORT_MAX_WORKERS = 2
+EXPORT_CACHE_MAX_ENTRIES = 64
+EXPORT_UI_WAIT_SECONDS = 0.5
+
+# Optional MMR re-ranking of retrieved chunks: candidates fetched per section and the
+# relevance/diversity trade-off (1.0 = pure relevance)
+RETRIEVAL_USE_MMR = False
+RETRIEVAL_MMR_FETCH_K = 20
+RETRIEVAL_MMR_LAMBDA = 0.5
+
+# Retrieval mode: "dense" searches the vector index (each new query costs an embedding call),
+# "lexical" ranks chunks with the local BM25 index only (no API call, milliseconds), and
+# "hybrid" runs both over RETRIEVAL_FUSION_FETCH_K candidates each and merges the rankings by
+# reciprocal-rank fusion with constant RETRIEVAL_RRF_K. Compare them with `python benchmark.py retrieval`.
+RETRIEVAL_MODE = "hybrid"
+RETRIEVAL_MODES = ["hybrid", "dense", "lexical"]
+RETRIEVAL_FUSION_FETCH_K = 20
+RETRIEVAL_RRF_K = 60
+
+# BM25 parameters of the lexical index built with every knowledge base: term-frequency
+# saturation (k1) and document-length normalization (b)
+LEXICAL_BM25_K1 = 1.2
+LEXICAL_BM25_B = 0.75
+
+# BM25 query of each section (lexical and hybrid modes): section-title terms weigh the title
+# weight, template-body terms 1, and the requirements, shared by all sections, only add their
+# RETRIEVAL_LEXICAL_REQUIREMENT_TERMS rarest terms at the requirement weight
+RETRIEVAL_LEXICAL_TITLE_WEIGHT = 3.0
+RETRIEVAL_LEXICAL_REQUIREMENT_TERMS = 16
+RETRIEVAL_LEXICAL_REQUIREMENT_WEIGHT = 0.5
+
+# Pipeline metrics: Prometheus text dump (rewritten at most once per interval), an optional
+# HTTP `/metrics` server (port 0 = disabled; overridable with $PROPOSAL_METRICS_PORT, and bound to
+# localhost unless $PROPOSAL_METRICS_HOST says otherwise), and per-model prices in USD per million
+# (prompt, completion) tokens for cost estimates (Nebius AI Studio base-tier list prices;
+# embedding models only bill input tokens). Update them when the price list changes.
+METRICS_DUMP_PATH = f"{CACHE_DIR}/metrics.prom"
+METRICS_DUMP_INTERVAL_SECONDS = 10
+METRICS_PORT = int(os.environ.get("PROPOSAL_METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("PROPOSAL_METRICS_HOST", "127.0.0.1")
+MODEL_PRICES_PER_MILLION_TOKENS = {
+    "deepseek-ai/DeepSeek-R1-0528": (0.80, 2.40),
+    "Qwen/Qwen3-32B": (0.10, 0.30),
+    "meta-llama/Llama-3.3-70B-Instruct": (0.13, 0.40),
+    "BAAI/bge-multilingual-gemma2": (0.01, 0.0),
+    "BAAI/bge-en-icl": (0.01, 0.0),
+    "intfloat/e5-mistral-7b-instruct": (0.01, 0.0),
+}
+
+# Prompt assembly: per-model context windows and heuristic token rates (tokens per CJK character,
+# characters per token for other text), used to fit prompts without loading each model's tokenizer
+TEXT_MODEL_PROFILES = {
+    "deepseek-ai/DeepSeek-R1-0528": {"context_window": 131072, "tokens_per_cjk_char": 0.6, "chars_per_token": 3.8},
+    "Qwen/Qwen3-32B": {"context_window": 32768, "tokens_per_cjk_char": 0.7, "chars_per_token": 4.0},
+    "meta-llama/Llama-3.3-70B-Instruct": {"context_window": 131072, "tokens_per_cjk_char": 1.0, "chars_per_token": 4.0},
+}
+DEFAULT_TEXT_MODEL_PROFILE = {"context_window": 32768, "tokens_per_cjk_char": 1.0, "chars_per_token": 3.5}
+
+# Token budgets per section prompt: requirements longer than their budget are replaced by a
+# cached LLM digest; retrieved chunks are packed by relevance into the context budget.
+# The reserve covers the prompt template and the completion (including reasoning tokens).
+PROMPT_REQUIREMENTS_TOKEN_BUDGET = 2000
+PROMPT_CONTEXT_TOKEN_BUDGET = 3000
+PROMPT_RESERVED_TOKENS = 8192
+DIGEST_CACHE_PATH = f"{CACHE_DIR}/digests.sqlite3"
+DIGEST_CACHE_MAX_ENTRIES = 500
+
+# Cache of generated section and workflow texts, keyed by model, temperature and prompt;
+# entries expire after the TTL or when the cache is full (least recently used first)
+LLM_CACHE_PATH = f"{CACHE_DIR}/llm_responses.sqlite3"
+LLM_CACHE_MAX_ENTRIES = 5000
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Incremental regeneration: each section depends on this many of the most similar requirement
+# paragraphs, so editing one paragraph only marks the sections it is relevant to as stale
+SECTION_REQUIREMENT_DEPENDENCIES = 3
+
+# Shared HTTP connection pools for the API clients: pool limits, idle keep-alive, timeouts
+# (the read timeout covers long reasoning-model responses) and optional HTTP/2 (needs `h2`)
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 60
+HTTP_CONNECT_TIMEOUT_SECONDS = 10
+HTTP_READ_TIMEOUT_SECONDS = 600
+HTTP_USE_HTTP2 = False
+# OpenAI clients and chat models cached per (API key, settings); least recently used ones beyond
+# this are dropped (they share the pooled connections, so re-creating one is cheap)
+HTTP_MAX_CACHED_CLIENTS = 64
+
+# Process-wide scheduler in front of every API request (see api_scheduler.py). Each model gets an
+# adaptive concurrency limit: it grows by one per limit's worth of successful requests, is cut by
+# the decrease factor on a 429/503 (once per round of in-flight requests), and the model is paused
+# for the response's Retry-After (or the backoff, at most the max pause). Waiting requests are
+# served interactive (section generation, retrieval queries) before bulk (knowledge-base
+# embedding), and in turn across sessions within a priority. A request still queued after the
+# max wait fails with a timeout, which callers retry like any other.
+API_INITIAL_CONCURRENCY = 16
+API_MIN_CONCURRENCY = 1
+API_MAX_CONCURRENCY = 64
+API_CONCURRENCY_DECREASE_FACTOR = 0.5
+API_THROTTLE_BACKOFF_SECONDS = 1.0
+API_MAX_PAUSE_SECONDS = 60
+API_MAX_QUEUE_WAIT_SECONDS = 600
+# Optional per-model budgets as (requests per minute, tokens per minute); None = unlimited.
+# Tokens are estimated from the request; chat requests without max_tokens reserve the default
+# completion tokens. e.g. {"Qwen/Qwen3-32B": (600, 400_000)}
+API_RATE_LIMITS = {}
+API_DEFAULT_RATE_LIMIT = (None, None)
+API_DEFAULT_COMPLETION_TOKENS = 1024
@@ -0,0 +1,97 @@
+# export_service.py
+
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from config import EXPORT_MAX_WORKERS, EXPORT_CACHE_MAX_ENTRIES
+from cache_utils import content_hash
+from file_utils import convert_md_to_docx, convert_md_to_pdf
+
+EXPORT_FORMATS = {
+    "docx": convert_md_to_docx,
+    "pdf": convert_md_to_pdf,
+}
+
+class ExportService:
+    """Renders proposals to DOCX/PDF on a background pool and caches the bytes.
+
+    Results are keyed by (proposal hash, image set, format), so a Streamlit rerun with unchanged
+    content never re-renders. When an owner (a session) submits new content, its pending renders
+    of older content are cancelled.
+    """
+    def __init__(self, max_workers: int = EXPORT_MAX_WORKERS, max_entries: int = EXPORT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self._results = OrderedDict()
+        self._pending = {}
+        # Per owner, the keys of its latest submission still rendering; emptied as renders finish.
+        self._latest = {}
+        # Re-entrant: done-callbacks run inline when a future finishes or is cancelled under the lock.
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(md_text, images, fmt) -> str:
+        return content_hash(fmt, md_text, *[os.path.basename(path) for path in images or []])
+
+    def submit(self, md_text, images=None, formats=tuple(EXPORT_FORMATS), owner=None):
+        """Returns {format: Future[bytes]}, starting background renders only for uncached content."""
+        futures = {}
+        with self._lock:
+            for fmt in formats:
+                key = self.key(md_text, images, fmt)
+                if key in self._results:
+                    self._results.move_to_end(key)
+                    future = Future()
+                    future.set_result(self._results[key])
+                elif key in self._pending:
+                    future = self._pending[key]
+                else:
+                    future = self._executor.submit(self._render, md_text, images, fmt)
+                    self._pending[key] = future
+                    future.add_done_callback(lambda f, key=key: self._finish(key, f))
+                futures[fmt] = future
+
+            if owner is not None:
+                keys = {self.key(md_text, images, fmt) for fmt in formats}
+                stale_keys = self._latest.pop(owner, set()) - keys
+                pending_keys = {key for key in keys if key in self._pending}
+                if pending_keys:
+                    self._latest[owner] = pending_keys
+                still_wanted = set().union(*self._latest.values())
+                for stale_key in stale_keys - still_wanted:
+                    stale = self._pending.get(stale_key)
+                    if stale is not None:
+                        stale.cancel()
+        return futures
+
+    def _finish(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            for owner, keys in list(self._latest.items()):
+                keys.discard(key)
+                if not keys:
+                    del self._latest[owner]
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._results[key] = future.result()
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    @staticmethod
+    def _render(md_text, images, fmt) -> bytes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, f"generated_proposal.{fmt}")
+            EXPORT_FORMATS[fmt](md_text, output_path, images)
+            with open(output_path, "rb") as f:
+                return f.read()
+
+_default_export_service = None
+
+def get_export_service() -> ExportService:
+    """Returns the process-wide export service."""
+    global _default_export_service
+    if _default_export_service is None:
+        _default_export_service = ExportService()
+    return _default_export_service
@@ -1,83 +1,220 @@
 # file_utils.py
 
 import os
+import json
+import logging
 import tempfile
 import base64
-import uuid
-import markdown
-import fitz  # PyMuPDF
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import regex as re
-import streamlit as st
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
-from docx import Document
-from weasyprint import HTML
-from config import IMAGE_DIR
-
-def extract_text_and_images_from_pdf(file_path):
-    """Extract text using PyPDFLoader and images using PyMuPDF."""
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    extracted_text = "\n\n".join([doc.page_content for doc in docs])
-    
-    image_paths = []
-    try:
-        pdf_document = fitz.Document(file_path)
-        for page in pdf_document:
-            for img in page.get_images(full=True):
-                xref = img[0]
-                base_image = pdf_document.extract_image(xref)
-                image_bytes = base_image["image"]
-                image_filename = f"{IMAGE_DIR}/pdf_image_{uuid.uuid4().hex}.png"
-                with open(image_filename, "wb") as img_file:
-                    img_file.write(image_bytes)
-                image_paths.append(image_filename)
-        pdf_document.close()
-    except Exception as e:
-        st.warning(f"Image extraction from PDF failed: {str(e)}. Only text will be extracted.")
-    return extracted_text, image_paths
+from config import (
+    EXTRACTION_CACHE_PATH, EXTRACTION_CACHE_MAX_ENTRIES, EXTRACTION_MEMORY_CACHE_MAX_ENTRIES,
+    EXTRACTION_MAX_CONCURRENT_FILES
+)
+from cache_utils import SQLiteCache, content_hash
+from image_store import get_image_store
+from metrics import get_metrics, instrumented
+# PyMuPDF, python-docx, WeasyPrint, markdown and the LangChain loaders are imported inside the
+# functions that need them: most app reruns never extract or export, so startup does not pay for them.
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever extraction output changes so stale cache entries are ignored
+EXTRACTION_PARSER_VERSION = "4"
+
+# --- Extraction Cache ---
+class ExtractionCache:
+    """Caches extraction results by the uploaded bytes' content hash and the parser version.
+
+    Recent results are kept in an in-memory LRU in front of a size-bounded SQLite store.
+    An entry whose image source document has since been garbage-collected counts as a miss.
+    """
+    def __init__(self, path: str = EXTRACTION_CACHE_PATH, max_entries: int = EXTRACTION_CACHE_MAX_ENTRIES,
+                 max_memory_entries: int = EXTRACTION_MEMORY_CACHE_MAX_ENTRIES):
+        self.store = SQLiteCache(path, max_entries=max_entries)
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(file_name: str, data: bytes) -> str:
+        extension = os.path.splitext(file_name)[1].lower()
+        return content_hash(EXTRACTION_PARSER_VERSION, extension, data)
+
+    def get(self, key: str):
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+        if result is None:
+            value = self.store.get(key)
+            result = json.loads(value) if value is not None else None
+        if result is None or not get_image_store().has_sources(result["images"]):
+            return None
+        self._remember(key, result)
+        return result
+
+    def set(self, key: str, result):
+        self.store.set(key, json.dumps(result, ensure_ascii=False).encode("utf-8"))
+        self._remember(key, result)
+
+    def _remember(self, key: str, result):
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+_default_extraction_cache = None
+
+def get_extraction_cache() -> ExtractionCache:
+    """Returns the process-wide extraction cache shared by all sessions."""
+    global _default_extraction_cache
+    if _default_extraction_cache is None:
+        _default_extraction_cache = ExtractionCache()
+    return _default_extraction_cache
+
+def _warn(message, warnings=None):
+    """Logs an extraction warning and, if a list is given, collects it for the caller to display."""
+    logger.warning(message)
+    if warnings is not None:
+        warnings.append(message)
 
-def extract_text_and_images_from_docx(file_path):
-    """Extract text using Docx2txtLoader and images using python-docx."""
+def extract_text_and_images_from_pdf(file_path, warnings=None):
+    """Extract text and image references with PyMuPDF in a single pass over the document."""
+    pages = _extract_pdf_pages(file_path, warnings)
+    extracted_text = "\n\n".join(page["text"] for page in pages)
+    return extracted_text, _collect_image_refs(file_path, pages)
+
+def _extract_pdf_pages(file_path, warnings=None, min_pool_tasks=2):
+    from pdf_extraction import extract_pdf_pages  # PyMuPDF
+    pages = extract_pdf_pages(file_path, min_pool_tasks=min_pool_tasks)
+    errors = [error for page in pages for error in page.pop("errors")]
+    if errors:
+        _warn(f"Image extraction from PDF failed for {len(errors)} image(s): {errors[0]}. Only text will be extracted for them.", warnings)
+    return pages
+
+def _collect_image_refs(file_path, pages):
+    """Pops the per-page image references, de-duplicated by content, and ties them to the stored source."""
+    image_refs, seen = [], set()
+    for page in pages:
+        for ref in page.pop("images"):
+            if ref["digest"] not in seen:
+                seen.add(ref["digest"])
+                image_refs.append(ref)
+    return _attach_source(file_path, image_refs)
+
+def _attach_source(file_path, image_refs):
+    if image_refs:
+        with open(file_path, "rb") as f:
+            source = get_image_store().add_source(f.read(), os.path.splitext(file_path)[1])
+        for ref in image_refs:
+            ref["source"] = source
+    return image_refs
+
+def extract_text_and_images_from_docx(file_path, warnings=None):
+    """Extract text using Docx2txtLoader and image references using python-docx."""
+    from langchain_community.document_loaders import Docx2txtLoader
+    from docx import Document
     loader = Docx2txtLoader(file_path)
     docs = loader.load()
     extracted_text = "\n\n".join([doc.page_content for doc in docs])
 
-    image_paths = []
+    image_refs, seen = [], set()
     try:
         doc = Document(file_path)
         for rel in doc.part.rels.values():
-            if "image" in rel.target_ref:
-                image_filename = f"{IMAGE_DIR}/docx_image_{uuid.uuid4().hex}.png"
-                with open(image_filename, "wb") as img_file:
-                    img_file.write(rel.target_part.blob)
-                image_paths.append(image_filename)
+            if "image" in rel.target_ref and not rel.is_external:
+                part = rel.target_part
+                digest = content_hash(part.blob)
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                image_refs.append({
+                    "digest": digest,
+                    "ext": os.path.splitext(str(part.partname))[1][1:] or "png",
+                    "part": str(part.partname),
+                })
     except Exception as e:
-        st.warning(f"Image extraction from DOCX failed: {str(e)}. Only text will be extracted.")
-    return extracted_text, image_paths
+        _warn(f"Image extraction from DOCX failed: {str(e)}. Only text will be extracted.", warnings)
+    return extracted_text, _attach_source(file_path, image_refs)
+
+def extract_file(file_name, data, min_pool_tasks=2):
+    """Extract text, per-page text and image references from a PDF or DOCX file's bytes.
+
+    Returns {"text", "pages", "images", "warnings"}. Results are cached by file content,
+    so unchanged files are not re-parsed. `min_pool_tasks` is passed to `extract_pdf_pages`.
+    """
+    with get_metrics().stage("extract") as info:
+        info["bytes"] = len(data)
+        cache = get_extraction_cache()
+        cache_key = cache.key(file_name, data)
+        result = cache.get(cache_key)
+        if result is None:
+            info["cache_misses"] = 1
+            result = _extract_text_and_images(file_name, data, min_pool_tasks)
+            cache.set(cache_key, result)
+        else:
+            info["cache_hits"] = 1
+        info["chunks"] = len(result["pages"])
+    return result
 
-def extract_text_from_file(uploaded_file):
-    """Extract text and images from an uploaded file based on its type."""
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-        tmp_file.write(uploaded_file.getbuffer())
+def extract_files(files, max_workers=EXTRACTION_MAX_CONCURRENT_FILES):
+    """Extracts several (file_name, data) files at once, yielding (index, result) as each one finishes.
+
+    Cached files come back first. Every PDF is sent to the extraction process pool, so files
+    parse in parallel while the caller already processes the finished ones.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="extract")
+    try:
+        futures = {executor.submit(extract_file, name, data, 1): i for i, (name, data) in enumerate(files)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # Stops queued files if the caller gives up early (e.g. on an error in a later stage).
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def extract_text_from_file(uploaded_file, images=None):
+    """Extract text from an uploaded file; its image references are appended to `images` if given."""
+    result = extract_file(uploaded_file.name, bytes(uploaded_file.getbuffer()))
+    if images is not None:
+        add_image_refs(images, result["images"])
+    return result["text"]
+
+def add_image_refs(images, new_refs):
+    """Appends image references to a list, skipping images already present."""
+    known_images = {ref["digest"] for ref in images}
+    images.extend(ref for ref in new_refs if ref["digest"] not in known_images)
+
+def _extract_text_and_images(file_name, data, min_pool_tasks=2):
+    """Writes the bytes to a temp file and runs the PDF or DOCX extractor over it."""
+    # Extensions are matched case-insensitively, like batch_cli's file discovery ("RFP.PDF").
+    extension = os.path.splitext(file_name)[1].lower()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as tmp_file:
+        tmp_file.write(data)
         file_path = tmp_file.name
 
+    warnings = []
     try:
-        if file_path.endswith(".pdf"):
-            extracted_text, image_paths = extract_text_and_images_from_pdf(file_path)
-        elif file_path.endswith(".docx"):
-            extracted_text, image_paths = extract_text_and_images_from_docx(file_path)
+        if extension == ".pdf":
+            pages = _extract_pdf_pages(file_path, warnings, min_pool_tasks)
+            extracted_text = "\n\n".join(page["text"] for page in pages)
+            image_refs = _collect_image_refs(file_path, pages)
+        elif extension == ".docx":
+            extracted_text, image_refs = extract_text_and_images_from_docx(file_path, warnings)
+            pages = [{"page": None, "text": extracted_text}]
         else:
             raise ValueError("Only PDF and DOCX files are supported.")
-        
-        st.session_state.extracted_images.extend(image_paths)
-        os.unlink(file_path)
-        return extracted_text
-    except Exception as e:
+        return {"text": extracted_text, "pages": pages, "images": image_refs, "warnings": warnings}
+    finally:
         os.unlink(file_path)
-        raise e
 
+@instrumented("export_docx")
 def convert_md_to_docx(md_text, output_filename, images=None):
-    """Convert markdown text to a DOCX document, including images."""
+    """Convert markdown text to a DOCX document, including images (file paths, see ImageStore.materialize)."""
+    from docx import Document
     doc = Document()
     if images:
         for img_path in images[:2]:  # Limit to first 2 images
@@ -108,8 +245,11 @@ def convert_md_to_docx(md_text, output_filename, images=None):
     doc.save(output_filename)
     return output_filename
 
+@instrumented("export_pdf")
 def convert_md_to_pdf(md_text, output_filename, images=None):
-    """Convert markdown text to a PDF document, including images."""
+    """Convert markdown text to a PDF document, including images (file paths, see ImageStore.materialize)."""
+    import markdown
+    from weasyprint import HTML
     html_content = markdown.markdown(md_text, extensions=['extra', 'codehilite'])
     
     image_tags = ""
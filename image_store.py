@@ -0,0 +1,119 @@
+# image_store.py
+
+import os
+import time
+import shutil
+import zipfile
+import threading
+from config import IMAGE_DIR, IMAGE_SESSION_TTL_SECONDS
+from cache_utils import content_hash
+
+class ImageStore:
+    """A content-addressed image store that writes image bytes only when an export needs them.
+
+    Extraction records lightweight image references instead of files:
+        {"digest", "ext", "source", "xref" (PDF) or "part" (DOCX), "width", "height"}
+    Each source document is kept once under `sources/`, keyed by its content hash.
+    `materialize` writes the referenced images into a per-session directory.
+    Session directories and unused sources expire after `ttl_seconds`.
+    """
+    def __init__(self, root: str = IMAGE_DIR, ttl_seconds: float = IMAGE_SESSION_TTL_SECONDS):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.sources_dir = os.path.join(root, "sources")
+        self.sessions_dir = os.path.join(root, "sessions")
+        self._lock = threading.Lock()
+        os.makedirs(self.sources_dir, exist_ok=True)
+        os.makedirs(self.sessions_dir, exist_ok=True)
+
+    def add_source(self, data: bytes, extension: str) -> str:
+        """Stores a source document once and returns its name within the store."""
+        name = f"{content_hash(data)}{extension.lower()}"
+        path = self.source_path(name)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            self._write(path, data)
+        return name
+
+    def source_path(self, name: str) -> str:
+        return os.path.join(self.sources_dir, name)
+
+    def read_source(self, name: str) -> bytes:
+        """Returns a stored source document's bytes and marks it as recently used."""
+        path = self.source_path(name)
+        os.utime(path)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def touch_sources(self, names):
+        """Marks source documents still referenced by a live session as recently used."""
+        for name in names:
+            try:
+                os.utime(self.source_path(name))
+            except FileNotFoundError:
+                pass
+
+    def has_sources(self, refs) -> bool:
+        return all(os.path.exists(self.source_path(ref["source"])) for ref in refs)
+
+    def session_dir(self, session_id: str) -> str:
+        return os.path.join(self.sessions_dir, session_id)
+
+    def materialize(self, refs, session_id: str):
+        """Writes the referenced images into the session directory and returns their paths."""
+        directory = self.session_dir(session_id)
+        os.makedirs(directory, exist_ok=True)
+        os.utime(directory)
+        paths = []
+        for ref in refs:
+            path = os.path.join(directory, f"{ref['digest']}.{ref['ext']}")
+            try:
+                if not os.path.exists(path):
+                    self._write(path, self._read_image(ref))
+                paths.append(path)
+            except Exception:
+                continue
+        return paths
+
+    def _read_image(self, ref) -> bytes:
+        source = self.source_path(ref["source"])
+        os.utime(source)
+        if "xref" in ref:
+            import fitz  # PyMuPDF
+            with fitz.open(source) as pdf_document:
+                return pdf_document.extract_image(ref["xref"])["image"]
+        with zipfile.ZipFile(source) as docx_archive:
+            return docx_archive.read(ref["part"].lstrip("/"))
+
+    def clear_session(self, session_id: str):
+        shutil.rmtree(self.session_dir(session_id), ignore_errors=True)
+
+    def collect_garbage(self):
+        """Removes session directories and source documents unused for longer than the TTL."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            for directory, remove in ((self.sessions_dir, shutil.rmtree), (self.sources_dir, os.unlink)):
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            remove(path)
+                    except OSError:
+                        pass
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+_default_image_store = None
+
+def get_image_store() -> ImageStore:
+    """Returns the process-wide image store."""
+    global _default_image_store
+    if _default_image_store is None:
+        _default_image_store = ImageStore()
+    return _default_image_store
@@ -0,0 +1,139 @@
+# kb_registry.py
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from config import KB_REGISTRY_MAX_BYTES, KB_REGISTRY_SESSION_TTL_SECONDS
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+def estimate_bytes(knowledge_base) -> int:
+    """Approximate memory held by a FAISS store: the index codes, the chunk texts and the lexical index."""
+    import faiss
+    index = knowledge_base.index
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        # Codes plus one id and one direct-map entry per vector.
+        index_bytes = index.ntotal * (ivf.code_size + 16)
+    except RuntimeError:
+        code_size = getattr(faiss.downcast_index(index), "code_size", 0) or index.d * 4
+        index_bytes = index.ntotal * code_size
+    text_bytes = sum(len(doc.page_content.encode("utf-8")) for doc in knowledge_base.docstore._dict.values())
+    lexical_index = getattr(knowledge_base, "lexical_index", None)
+    return index_bytes + text_bytes + (lexical_index.nbytes if lexical_index is not None else 0)
+
+class KnowledgeBaseRegistry:
+    """Loaded knowledge bases shared by every session of the process, keyed by corpus id.
+
+    Sessions keep only the corpus id and hold a reference while they use it; ten sessions
+    uploading the same documents share one index in memory. Entries that no session
+    references stay loaded in LRU order until the estimated total exceeds `max_bytes`.
+    A session's reference lapses after `session_ttl` seconds without access, since sessions
+    that close their browser tab never release it.
+    """
+    def __init__(self, max_bytes: int = KB_REGISTRY_MAX_BYTES, session_ttl: float = KB_REGISTRY_SESSION_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.session_ttl = session_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, corpus: str, session_id: str, load):
+        """Returns the knowledge base of `corpus`, calling `load()` only if it is not loaded yet.
+
+        The session holds a reference until `release` or until it stays idle past the TTL.
+        Concurrent acquires of the same corpus wait for a single load.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(corpus, threading.Lock())
+        try:
+            with key_lock:
+                with self._lock:
+                    entry = self._entries.get(corpus)
+                    if entry is not None:
+                        self.hits += 1
+                        self._entries.move_to_end(corpus)
+                        entry["sessions"][session_id] = time.time()
+                        return entry["knowledge_base"]
+                    self.misses += 1
+                knowledge_base = load()
+                if knowledge_base is None:
+                    return None
+                entry = {"knowledge_base": knowledge_base, "bytes": estimate_bytes(knowledge_base),
+                         "sessions": {session_id: time.time()}}
+                with self._lock:
+                    self._entries[corpus] = entry
+        finally:
+            with self._lock:
+                self._key_locks.pop(corpus, None)
+        self._evict()
+        return knowledge_base
+
+    def get(self, corpus: str, session_id: str = None):
+        """Returns the loaded knowledge base of `corpus`, or None; refreshes the session's reference."""
+        with self._lock:
+            entry = self._entries.get(corpus)
+            if entry is None:
+                return None
+            self._entries.move_to_end(corpus)
+            if session_id is not None:
+                entry["sessions"][session_id] = time.time()
+            return entry["knowledge_base"]
+
+    def release(self, session_id: str, corpus: str = None):
+        """Drops the session's reference to `corpus` (or to every corpus)."""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if corpus is None or key == corpus:
+                    entry["sessions"].pop(session_id, None)
+        self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(entry["bytes"] for entry in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "sessions": len({s for entry in self._entries.values() for s in entry["sessions"]}),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        """Expires idle session references, then evicts unreferenced entries LRU-first above the cap."""
+        cutoff = time.time() - self.session_ttl
+        with self._lock:
+            for entry in self._entries.values():
+                for session_id in [s for s, seen in entry["sessions"].items() if seen < cutoff]:
+                    del entry["sessions"][session_id]
+            total = sum(entry["bytes"] for entry in self._entries.values())
+            for corpus in list(self._entries):
+                if total <= self.max_bytes:
+                    break
+                if not self._entries[corpus]["sessions"]:
+                    total -= self._entries.pop(corpus)["bytes"]
+                    self.evictions += 1
+                    get_metrics().increment("proposal_kb_registry_evictions_total")
+            if total > self.max_bytes:
+                logger.warning(f"Knowledge bases in use take {total} bytes, above the {self.max_bytes}-byte cap.")
+            get_metrics().set_gauge("proposal_kb_registry_bytes", total)
+            get_metrics().set_gauge("proposal_kb_registry_entries", len(self._entries))
+
+_default_registry = None
+
+def get_kb_registry() -> KnowledgeBaseRegistry:
+    """Returns the process-wide knowledge-base registry.
+
+    Module state outlives Streamlit reruns and is shared by all sessions of the server
+    process, like `st.cache_resource`, without tying the registry to Streamlit.
+    """
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = KnowledgeBaseRegistry()
+    return _default_registry
@@ -0,0 +1,485 @@
+# kb_store.py
+
+import os
+import json
+import shutil
+import pickle
+import math
+import logging
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import faiss
+import numpy as np
+import regex as re
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from config import (
+    KB_STORE_DIR, KB_STORE_MAX_CORPORA, KB_CHUNK_SIZE, KB_CHUNK_OVERLAP, KB_ADD_BATCH_SIZE,
+    KB_EMBED_WORKERS, KB_MAX_PENDING_BATCHES,
+    KB_INDEX_FACTORY, KB_INDEX_MIN_TRAIN_POINTS, KB_INDEX_MAX_TRAIN_POINTS, KB_INDEX_NPROBE
+)
+from cache_utils import content_hash
+from lexical_index import LexicalIndex, chunk_texts
+from api_scheduler import with_request_context
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+# Version 2: documents are chunked page by page, and chunks carry page and offset metadata.
+# Version 3: the index backend is part of the corpus id and recorded in the manifest.
+MANIFEST_VERSION = 3
+# Separator between page texts in an extracted document's full text (see file_utils).
+PAGE_SEPARATOR = "\n\n"
+
+# --- Index Backends ---
+def resolve_index_factory(factory: str, dim: int, train_points: int) -> str:
+    """Fills the {nlist} and {pq_m} placeholders of an index description for the given corpus."""
+    reduced = re.match(r"PCAR?(\d+)", factory)
+    reduced_dim = int(reduced.group(1)) if reduced else dim
+    # About 4 * sqrt(n) clusters, with at least 39 training points per cluster as faiss recommends.
+    nlist = max(1, min(int(4 * math.sqrt(train_points)), train_points // 39))
+    # 4-bit fast-scan codes for every 2 dimensions ("PQ{pq_m}x4fs"): 16x smaller than float32,
+    # with 16 centroids per sub-quantizer instead of 256, so far fewer training points are needed.
+    pq_m = max(m for m in range(1, max(1, reduced_dim // 2) + 1) if reduced_dim % m == 0)
+    return factory.format(nlist=nlist, pq_m=pq_m)
+
+def required_train_points(description: str) -> int:
+    """Training vectors an index description needs: 39 per centroid of its largest k-means step.
+
+    IVF needs 39 per cluster, PQ 39 per centroid of each sub-quantizer (2**nbits, 8 bits unless
+    given as "PQ{m}x{nbits}") and PCA at least as many vectors as output dimensions.
+    """
+    needed = 1
+    for nlist in re.findall(r"IVF(\d+)", description):
+        needed = max(needed, int(nlist) * 39)
+    for nbits in re.findall(r"PQ\d+(?:x(\d+))?", description):
+        needed = max(needed, 2 ** int(nbits or 8) * 39)
+    for reduced_dim in re.findall(r"PCAR?(\d+)", description):
+        needed = max(needed, int(reduced_dim))
+    return needed
+
+def configure_index(index, nprobe: int = KB_INDEX_NPROBE):
+    """Sets the clusters searched per query of an IVF index and enables `reconstruct` (used by MMR)
+    where the index supports it (see `supports_reconstruct`)."""
+    ivf = _ivf(index)
+    if ivf is not None:
+        ivf.nprobe = nprobe
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+    return index
+
+def supports_reconstruct(index) -> bool:
+    """Fast-scan PQ codes are packed in blocks that `reconstruct` cannot decode (faiss crashes)."""
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return not isinstance(index, (faiss.IndexIVFFastScan, faiss.IndexFastScan))
+
+def supports_removal(index) -> bool:
+    """IVF indexes with a direct map cannot delete vectors; their corpora are rebuilt instead."""
+    return _ivf(index) is None
+
+def create_index(factory: str, train_vectors, min_train_points: int = KB_INDEX_MIN_TRAIN_POINTS,
+                 nprobe: int = KB_INDEX_NPROBE):
+    """Creates an empty index from `factory`, trained on `train_vectors` if it needs training.
+
+    Returns (index, description). When there are fewer vectors than the description needs
+    (see `required_train_points`), its product quantizer is replaced by "SQ8", then the whole
+    index by "SQ8". Indexes that need training fall back to an exact "Flat" index when there
+    are fewer than `min_train_points` vectors or training fails.
+    """
+    train_vectors = np.ascontiguousarray(train_vectors, dtype=np.float32)
+    count, dim = train_vectors.shape
+    description = resolve_index_factory(factory, dim, count)
+    index = faiss.index_factory(dim, description)
+    if not index.is_trained:
+        if count < min_train_points:
+            return faiss.IndexFlatL2(dim), "Flat"
+        needed = required_train_points(description)
+        if count < needed:
+            fallback = re.sub(r"PQ\d+(?:x\d+)?(?:fs)?", "SQ8", description)
+            if count < required_train_points(fallback):
+                fallback = "SQ8"
+            logger.warning(f"A '{description}' index needs {needed} training vectors, got {count}. Using '{fallback}'.")
+            description = fallback
+            index = faiss.index_factory(dim, description)
+        try:
+            index.train(train_vectors)
+        except RuntimeError as e:
+            logger.warning(f"Could not train a '{description}' index on {count} vectors: {e}. Using 'Flat'.")
+            return faiss.IndexFlatL2(dim), "Flat"
+    return configure_index(index, nprobe), description
+
+def reindex(flat_index, factory: str, max_train_points: int = KB_INDEX_MAX_TRAIN_POINTS,
+            min_train_points: int = KB_INDEX_MIN_TRAIN_POINTS, batch_size: int = 16_384):
+    """Copies the vectors of an exact index into a new `factory` index, keeping their order.
+
+    The training sample is spread evenly over the corpus rather than taken from its first
+    documents. Returns (index, description); the input index itself if it falls back to "Flat".
+    """
+    total = flat_index.ntotal
+    keys = np.unique(np.linspace(0, total - 1, min(total, max_train_points)).astype(np.int64)) if total else []
+    sample = flat_index.reconstruct_batch(keys) if total else np.zeros((0, flat_index.d), dtype=np.float32)
+    index, description = create_index(factory, sample, min_train_points=min_train_points)
+    if description == "Flat":
+        return flat_index, "Flat"
+    for start in range(0, total, batch_size):
+        index.add(flat_index.reconstruct_n(start, min(batch_size, total - start)))
+    return index, description
+
+def _ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+class KnowledgeBaseStore:
+    """Keeps one persisted FAISS index per corpus on disk, with a manifest of per-document hashes.
+
+    A corpus is identified by the embedding model, the chunking parameters and the set of
+    document content hashes, so sessions that upload the same documents share one index.
+    A new corpus is derived from the closest existing one: only documents that were added
+    are chunked and embedded, and only the chunks of removed documents are deleted.
+
+    Chunks are generated lazily, one document and page at a time, and embedded in batches of
+    `add_batch_size` on `embed_workers` threads while the next documents are still being
+    extracted and chunked. At most `max_pending_batches` batches wait for the network, so peak
+    memory during a build is bounded by the pending batches rather than the corpus.
+
+    The index backend is a faiss.index_factory description (see KB_INDEX_FACTORY). Chunks are
+    first added to an exact index, which is then converted once into the configured backend;
+    corpora whose index cannot delete vectors (IVF) are rebuilt when documents are removed,
+    with the vectors served from the embedding cache.
+
+    Every corpus also persists a BM25 index of its chunks (see `lexical_index`), attached to the
+    returned store as `lexical_index`, for retrieval without a query-embedding call.
+    """
+    def __init__(self, root: str = KB_STORE_DIR, max_corpora: int = KB_STORE_MAX_CORPORA,
+                 chunk_size: int = KB_CHUNK_SIZE, chunk_overlap: int = KB_CHUNK_OVERLAP,
+                 add_batch_size: int = KB_ADD_BATCH_SIZE, index_factory: str = KB_INDEX_FACTORY,
+                 embed_workers: int = KB_EMBED_WORKERS, max_pending_batches: int = KB_MAX_PENDING_BATCHES):
+        self.root = root
+        self.max_corpora = max_corpora
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.add_batch_size = add_batch_size
+        self.index_factory = index_factory
+        self.embed_workers = embed_workers
+        self.max_pending_batches = max_pending_batches
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def corpus_id(self, embedding_model: str, doc_hashes, index_factory: str = None) -> str:
+        return content_hash(
+            str(MANIFEST_VERSION), embedding_model, str(self.chunk_size), str(self.chunk_overlap),
+            index_factory or self.index_factory, *sorted(set(doc_hashes))
+        )[:32]
+
+    def build(self, documents, embeddings, index_factory: str = None, progress=None):
+        """Returns a FAISS store for `documents`, reusing persisted work.
+
+        Each document is a {"name", "text"} dict, optionally with the extractor's "pages"
+        ([{"page", "text"}], see `file_utils.extract_file`) to record page numbers.
+        `documents` may be a generator yielding documents as their extraction finishes: each
+        new document is chunked and embedded while the next ones are produced. Documents that
+        are already in a persisted corpus are not embedded; they are taken from the closest
+        corpus once the whole set is known. `progress`, if given, is called in the calling
+        thread with {"event": "document" | "batch", ...} dicts (see `_BatchEmbedder`).
+        `index_factory` overrides the store's index backend for this corpus.
+        """
+        index_factory = index_factory or self.index_factory
+        known = {h for _, manifest in self._compatible_manifests(embeddings.model, index_factory) for h in manifest["documents"]}
+        docs = {}
+        staging = self._embedder(embeddings, progress=progress)
+        try:
+            for doc in documents:
+                if not (doc["text"] and doc["text"].strip()):
+                    continue
+                doc_hash = content_hash(doc["text"])
+                if doc_hash in docs:
+                    continue
+                docs[doc_hash] = doc
+                if doc_hash in known:
+                    _notify(progress, {"event": "document", "name": doc["name"], "chunks": None, "reused": True})
+                else:
+                    staging.add_document(doc_hash, doc, self.iter_chunks(doc, doc_hash), self.add_batch_size)
+            staging.finish()
+        finally:
+            staging.close()
+        if not docs:
+            return None
+
+        corpus = self.corpus_id(embeddings.model, docs, index_factory)
+        with self._lock_for(corpus):
+            path = os.path.join(self.root, corpus)
+            if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+                return self.load(corpus, embeddings)
+
+            base = self._closest_corpus(embeddings.model, docs, index_factory)
+            if base:
+                vectorstore = self.load(base["id"], embeddings, mmap=False)
+                entries = dict(base["manifest"]["documents"])
+                description = base["manifest"]["index"]
+            else:
+                vectorstore, entries, description = None, {}, "Flat"
+
+            removed = [h for h in entries if h not in docs]
+            stale_ids = [chunk_id for h in removed for chunk_id in entries.pop(h)["chunk_ids"]]
+            if stale_ids and len(stale_ids) < len(vectorstore.index_to_docstore_id) and supports_removal(vectorstore.index):
+                vectorstore.delete(stale_ids)
+            elif stale_ids:
+                # Everything was removed, or the index cannot delete: rebuild (embeddings come from the cache).
+                vectorstore, entries, description = None, {}, "Flat"
+
+            # Documents embedded while streaming come from the staging store; the others (known
+            # from a corpus other than the base, or dropped by a rebuild) are embedded now,
+            # normally straight from the embedding cache.
+            if vectorstore is None and staging.vectorstore is not None:
+                vectorstore = staging.vectorstore
+                entries.update(staging.entries)
+            else:
+                vectorstore = _copy_documents(staging, vectorstore, embeddings)
+                entries.update(staging.entries)
+            rest = self._embedder(embeddings, vectorstore, progress=progress)
+            try:
+                for doc_hash, doc in docs.items():
+                    if doc_hash not in entries:
+                        rest.add_document(doc_hash, doc, self.iter_chunks(doc, doc_hash), self.add_batch_size)
+                vectorstore = rest.finish()
+            finally:
+                rest.close()
+            entries.update(rest.entries)
+
+            if vectorstore is None:
+                return None
+            if description == "Flat" and index_factory != "Flat":
+                vectorstore.index, description = reindex(vectorstore.index, index_factory)
+            self._save(corpus, vectorstore, {
+                "version": MANIFEST_VERSION,
+                "embedding_model": embeddings.model,
+                "chunk_size": self.chunk_size,
+                "chunk_overlap": self.chunk_overlap,
+                "index_factory": index_factory,
+                "index": description,
+                "documents": entries,
+            })
+            return vectorstore
+
+    def _embedder(self, embeddings, vectorstore=None, progress=None):
+        return _BatchEmbedder(embeddings, vectorstore, workers=self.embed_workers,
+                              max_pending=self.max_pending_batches, progress=progress)
+
+    def corpus_for(self, documents, embedding_model: str, index_factory: str = None):
+        """Returns the corpus id `build` would use for `documents` (None if they are all empty)."""
+        docs = self._documents_by_hash(documents)
+        return self.corpus_id(embedding_model, docs, index_factory) if docs else None
+
+    @staticmethod
+    def _documents_by_hash(documents):
+        docs = {}
+        for doc in documents:
+            if doc["text"] and doc["text"].strip():
+                docs.setdefault(content_hash(doc["text"]), doc)
+        return docs
+
+    def split(self, text: str):
+        return [chunk.page_content for chunk in self._splitter().create_documents([text])]
+
+    def iter_chunks(self, doc, doc_hash: str = None):
+        """Yields (text, metadata) chunks of one document, page by page.
+
+        Metadata holds the source name, the document hash, the page number (None when the
+        document has no pages, e.g. DOCX) and the chunk's character offset in the document text.
+        """
+        doc_hash = doc_hash or content_hash(doc["text"])
+        pages = doc.get("pages")
+        if not pages or sum(len(page["text"]) for page in pages) + len(PAGE_SEPARATOR) * (len(pages) - 1) != len(doc["text"]):
+            # Pages that do not add up to the text cannot give correct offsets; chunk the text as one page.
+            pages = [{"page": None, "text": doc["text"]}]
+        splitter = self._splitter()
+        page_offset = 0
+        for page in pages:
+            for chunk in splitter.create_documents([page["text"]]):
+                yield chunk.page_content, {
+                    "source": doc["name"],
+                    "doc_hash": doc_hash,
+                    "page": page["page"],
+                    "offset": page_offset + chunk.metadata["start_index"],
+                }
+            page_offset += len(page["text"]) + len(PAGE_SEPARATOR)
+
+    def _splitter(self):
+        return RecursiveCharacterTextSplitter(
+            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap, add_start_index=True
+        )
+
+    def load(self, corpus: str, embeddings, mmap: bool = True):
+        """Loads a persisted corpus; with `mmap` the index is memory-mapped read-only instead of copied into RAM."""
+        path = os.path.join(self.root, corpus)
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        index = configure_index(faiss.read_index(os.path.join(path, "index.faiss"), flags))
+        with open(os.path.join(path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        os.utime(path)
+        vectorstore = FAISS(embeddings, index, docstore, index_to_docstore_id)
+        # Corpora persisted before the lexical index existed get one built on first lexical search.
+        vectorstore.lexical_index = LexicalIndex.load(path)
+        return vectorstore
+
+    def manifest(self, corpus: str):
+        try:
+            with open(os.path.join(self.root, corpus, MANIFEST_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _compatible_manifests(self, embedding_model: str, index_factory: str):
+        """Yields (corpus, manifest) for persisted corpora built with the same model, chunking and index backend."""
+        for corpus in os.listdir(self.root):
+            manifest = self.manifest(corpus)
+            if not manifest or manifest.get("version") != MANIFEST_VERSION:
+                continue
+            if (manifest["embedding_model"], manifest["chunk_size"], manifest["chunk_overlap"], manifest["index_factory"]) == \
+                    (embedding_model, self.chunk_size, self.chunk_overlap, index_factory):
+                yield corpus, manifest
+
+    def _closest_corpus(self, embedding_model: str, docs, index_factory: str):
+        """Finds the persisted corpus sharing the most documents (then needing the fewest deletions)."""
+        best, best_score = None, (0, 0)
+        for corpus, manifest in self._compatible_manifests(embedding_model, index_factory):
+            shared = sum(1 for h in manifest["documents"] if h in docs)
+            score = (shared, -(len(manifest["documents"]) - shared))
+            if shared and score > best_score:
+                best, best_score = {"id": corpus, "manifest": manifest}, score
+        return best
+
+    def _save(self, corpus: str, vectorstore, manifest):
+        path = os.path.join(self.root, corpus)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        vectorstore.save_local(tmp_path)
+        # BM25 weights depend on the whole corpus, so the lexical index is rebuilt from the chunk texts.
+        vectorstore.lexical_index = LexicalIndex.from_texts(chunk_texts(vectorstore))
+        vectorstore.lexical_index.save(tmp_path)
+        with open(os.path.join(tmp_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process persisted the same corpus first; its copy is equivalent.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self._prune()
+
+    def _prune(self):
+        """Drops the least recently used corpora beyond `max_corpora`."""
+        corpora = [
+            os.path.join(self.root, name) for name in os.listdir(self.root)
+            if ".tmp-" not in name and os.path.isdir(os.path.join(self.root, name))
+        ]
+        corpora.sort(key=os.path.getmtime, reverse=True)
+        for path in corpora[self.max_corpora:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _lock_for(self, corpus: str):
+        with self._locks_guard:
+            return self._locks.setdefault(corpus, threading.Lock())
+
+# --- Pipelined Embedding ---
+def _notify(progress, event):
+    if progress is not None:
+        progress(event)
+
+class _BatchEmbedder:
+    """Embeds chunk batches on worker threads and adds the vectors to a FAISS store as they return.
+
+    At most `max_pending` batches are queued or being embedded: `add_document` adds finished
+    batches and waits once the window is full, which bounds the memory held by pending chunks
+    while letting the producer (extraction and chunking) run ahead of the network.
+    The store is only modified in the calling thread, which also receives the progress events
+        {"event": "document", "name", "chunks", "reused"}   when a document's batches are queued
+        {"event": "batch", "name", "chunks", "embedded", "queued"}   when a batch has been added
+    """
+    def __init__(self, embeddings, vectorstore=None, workers: int = KB_EMBED_WORKERS,
+                 max_pending: int = KB_MAX_PENDING_BATCHES, progress=None):
+        self.embeddings = embeddings
+        self.vectorstore = vectorstore
+        self.max_pending = max(1, max_pending)
+        self.progress = progress
+        self.entries = {}
+        self.queued = 0
+        self.embedded = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-embed")
+        self._pending = {}
+
+    def add_document(self, doc_hash: str, doc, chunks, batch_size: int):
+        ids = []
+        while True:
+            batch = list(islice(chunks, batch_size))
+            if not batch:
+                break
+            texts = [text for text, _ in batch]
+            metadatas = [metadata for _, metadata in batch]
+            batch_ids = [f"{doc_hash}:{len(ids) + i}" for i in range(len(batch))]
+            ids.extend(batch_ids)
+            while len(self._pending) >= self.max_pending:
+                self._add_finished(FIRST_COMPLETED)
+            future = self._executor.submit(with_request_context(self.embeddings.embed_documents), texts)
+            self._pending[future] = (doc["name"], texts, metadatas, batch_ids)
+            self.queued += len(batch)
+        self.entries[doc_hash] = {"name": doc["name"], "chunk_ids": ids}
+        _notify(self.progress, {"event": "document", "name": doc["name"], "chunks": len(ids), "reused": False})
+        self._add_finished(None)
+
+    def finish(self):
+        """Waits for the remaining batches and returns the store (None if nothing was added)."""
+        while self._pending:
+            self._add_finished(FIRST_COMPLETED)
+        return self.vectorstore
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _add_finished(self, return_when):
+        """Adds finished batches; waits for at least one with FIRST_COMPLETED, not at all with None."""
+        if return_when is None:
+            done = [future for future in self._pending if future.done()]
+        else:
+            done, _ = wait(self._pending, return_when=return_when)
+        for future in done:
+            name, texts, metadatas, ids = self._pending.pop(future)
+            text_embeddings = list(zip(texts, future.result()))
+            if self.vectorstore is None:
+                self.vectorstore = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas, ids=ids)
+            else:
+                self.vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+            self.embedded += len(texts)
+            _notify(self.progress, {"event": "batch", "name": name, "chunks": len(texts),
+                                    "embedded": self.embedded, "queued": self.queued})
+
+def _copy_documents(source: _BatchEmbedder, vectorstore, embeddings):
+    """Adds the documents embedded by `source` to `vectorstore` (or a new store), reusing their vectors."""
+    if source.vectorstore is None:
+        return vectorstore
+    positions = {doc_id: i for i, doc_id in source.vectorstore.index_to_docstore_id.items()}
+    for entry in source.entries.values():
+        ids = entry["chunk_ids"]
+        if not ids:
+            continue
+        vectors = source.vectorstore.index.reconstruct_batch(np.array([positions[i] for i in ids], dtype=np.int64))
+        chunks = [source.vectorstore.docstore.search(i) for i in ids]
+        text_embeddings = list(zip([chunk.page_content for chunk in chunks], vectors))
+        metadatas = [chunk.metadata for chunk in chunks]
+        if vectorstore is None:
+            vectorstore = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+        else:
+            vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+    return vectorstore
+
+_default_store = None
+
+def get_kb_store() -> KnowledgeBaseStore:
+    """Returns the process-wide knowledge-base store."""
+    global _default_store
+    if _default_store is None:
+        _default_store = KnowledgeBaseStore()
+    return _default_store
@@ -0,0 +1,186 @@
+# lexical_index.py
+
+import os
+import math
+import pickle
+import logging
+import unicodedata
+from collections import Counter
+import numpy as np
+import regex as re
+from config import (
+    LEXICAL_BM25_K1, LEXICAL_BM25_B, RETRIEVAL_RRF_K, RETRIEVAL_LEXICAL_TITLE_WEIGHT,
+    RETRIEVAL_LEXICAL_REQUIREMENT_TERMS, RETRIEVAL_LEXICAL_REQUIREMENT_WEIGHT
+)
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_FILE = "lexical.pkl"
+# Bumped whenever the tokenizer or the stored weights change; older files are rebuilt on load.
+LEXICAL_INDEX_VERSION = 1
+
+# CJK runs, clause numbers such as "3.2.1" or "5-2", and other words (letters and digits).
+TOKEN_PATTERN = re.compile(
+    r"([\p{Han}\p{Hiragana}\p{Katakana}\p{Hangul}]+)"
+    r"|\d+(?:[.\-]\d+)+"
+    r"|[^\W_\p{Han}\p{Hiragana}\p{Katakana}\p{Hangul}]+"
+)
+
+# --- Tokenization ---
+def tokenize(text: str):
+    """Splits text into BM25 terms: lowercase words and numbers, and overlapping CJK character bigrams.
+
+    Chinese has no word boundaries, so each run of CJK characters is indexed by its character
+    pairs ("供应商" -> "供应", "应商"); a single character on its own is kept as is. Matching
+    bigrams needs no segmentation dictionary and still ranks exact domain terms first.
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).casefold()):
+        run = match.group(1)
+        if run is None:
+            tokens.append(match.group())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+# --- BM25 Index ---
+class LexicalIndex:
+    """A BM25 index over the chunks of a knowledge base, searched locally without an API call.
+
+    Documents are identified by their position, which matches the FAISS index positions of
+    the knowledge base. BM25 weights do not depend on the query, so each term's postings
+    store (position, weight) pairs and a search only sums the postings of the query terms.
+    """
+    def __init__(self, terms, offsets, positions, weights, size: int):
+        self.terms = terms
+        self.offsets = offsets
+        self.positions = positions
+        self.weights = weights
+        self.size = size
+
+    @classmethod
+    def from_texts(cls, texts, k1: float = LEXICAL_BM25_K1, b: float = LEXICAL_BM25_B):
+        postings = {}
+        lengths = []
+        for position, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((position, tf))
+        size = len(lengths)
+        lengths = np.array(lengths, dtype=np.float32)
+        average_length = float(lengths.mean()) if size and lengths.mean() > 0 else 1.0
+
+        terms, offsets, all_positions, all_weights = {}, [0], [], []
+        for row, (term, entries) in enumerate(postings.items()):
+            terms[term] = row
+            idf = math.log(1.0 + (size - len(entries) + 0.5) / (len(entries) + 0.5))
+            positions = np.array([p for p, _ in entries], dtype=np.int32)
+            tf = np.array([t for _, t in entries], dtype=np.float32)
+            norm = k1 * (1.0 - b + b * lengths[positions] / average_length)
+            all_positions.append(positions)
+            all_weights.append((idf * tf * (k1 + 1.0) / (tf + norm)).astype(np.float32))
+            offsets.append(offsets[-1] + len(entries))
+        return cls(
+            terms, np.array(offsets, dtype=np.int64),
+            np.concatenate(all_positions) if all_positions else np.zeros(0, dtype=np.int32),
+            np.concatenate(all_weights) if all_weights else np.zeros(0, dtype=np.float32),
+            size,
+        )
+
+    @property
+    def nbytes(self) -> int:
+        term_bytes = sum(len(term.encode("utf-8")) + 64 for term in self.terms)
+        return term_bytes + self.offsets.nbytes + self.positions.nbytes + self.weights.nbytes
+
+    def search(self, query, k: int):
+        """Returns the positions of the `k` best-matching chunks, best first (only chunks sharing a term).
+
+        `query` is a text (every distinct term counts once) or a {term: weight} mapping.
+        """
+        terms = query if isinstance(query, dict) else dict.fromkeys(tokenize(query), 1.0)
+        rows = [(self.terms[term], weight) for term, weight in terms.items() if term in self.terms and weight > 0]
+        if not rows or k <= 0:
+            return []
+        scores = np.zeros(self.size, dtype=np.float32)
+        for row, weight in rows:
+            start, end = self.offsets[row], self.offsets[row + 1]
+            # Positions are unique within a posting list, so fancy-index addition is safe.
+            scores[self.positions[start:end]] += weight * self.weights[start:end]
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [int(i) for i in top if scores[i] > 0]
+
+    def rarest_terms(self, text: str, n: int):
+        """Returns the `n` terms of `text` found in the fewest chunks (terms not in the index are skipped)."""
+        rows = {term: self.terms[term] for term in set(tokenize(text)) if term in self.terms}
+        frequency = lambda term: self.offsets[rows[term] + 1] - self.offsets[rows[term]]
+        return sorted(rows, key=lambda term: (frequency(term), term))[:max(0, n)]
+
+    def save(self, path: str):
+        with open(os.path.join(path, LEXICAL_INDEX_FILE), "wb") as f:
+            pickle.dump({"version": LEXICAL_INDEX_VERSION, "terms": self.terms, "offsets": self.offsets,
+                         "positions": self.positions, "weights": self.weights, "size": self.size}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads the index saved in directory `path`, or returns None if it is missing, outdated or unreadable."""
+        try:
+            with open(os.path.join(path, LEXICAL_INDEX_FILE), "rb") as f:
+                data = pickle.load(f)
+        except OSError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, ValueError) as e:
+            # Truncated or written by an incompatible version; `lexical_index_of` rebuilds it from the chunks.
+            logger.warning(f"Could not read the lexical index in {path} ({e!r}); rebuilding it on first use.")
+            return None
+        if not isinstance(data, dict) or data.get("version") != LEXICAL_INDEX_VERSION:
+            return None
+        return cls(data["terms"], data["offsets"], data["positions"], data["weights"], data["size"])
+
+# --- Knowledge Base Integration ---
+def chunk_texts(knowledge_base):
+    """Returns the chunk texts of a FAISS store in index order."""
+    ids = knowledge_base.index_to_docstore_id
+    return [knowledge_base.docstore.search(ids[i]).page_content for i in range(len(ids))]
+
+def lexical_index_of(knowledge_base) -> LexicalIndex:
+    """Returns the lexical index attached to a FAISS store, building and attaching it if missing.
+
+    `kb_store` attaches the persisted index when it builds or loads a corpus; stores created
+    elsewhere get one built on first use.
+    """
+    index = getattr(knowledge_base, "lexical_index", None)
+    if index is None or index.size != knowledge_base.index.ntotal:
+        index = LexicalIndex.from_texts(chunk_texts(knowledge_base))
+        knowledge_base.lexical_index = index
+    return index
+
+def section_query(index: LexicalIndex, section, requirements: str, title_weight: float = RETRIEVAL_LEXICAL_TITLE_WEIGHT,
+                  requirement_terms: int = RETRIEVAL_LEXICAL_REQUIREMENT_TERMS,
+                  requirement_weight: float = RETRIEVAL_LEXICAL_REQUIREMENT_WEIGHT):
+    """Returns the weighted BM25 query {term: weight} of a template section.
+
+    Every section is generated from the same requirements, so querying with the whole text
+    would give every section the same chunks. The title and template body carry the query;
+    the requirements add only their rarest terms (product codes, clause numbers) at a low weight.
+    """
+    terms = dict.fromkeys(index.rarest_terms(requirements or "", requirement_terms), requirement_weight)
+    terms.update(dict.fromkeys(tokenize(section.get("content", "")), 1.0))
+    terms.update(dict.fromkeys(tokenize(section["title"]), title_weight))
+    return terms
+
+def reciprocal_rank_fusion(rankings, k: int = RETRIEVAL_RRF_K):
+    """Merges ranked lists of positions by reciprocal-rank fusion: score = sum of 1 / (k + rank).
+
+    Only ranks are used, so dense distances and BM25 scores need no common scale.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking, start=1):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda position: -scores[position])
@@ -1,49 +1,210 @@
 # llm_utils.py
 
-import streamlit as st
+import time
+import random
+import logging
+import numpy as np
 import regex as re
+from array import array
 from typing import List
-from openai import OpenAI
-from langchain_core.embeddings import Embeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter # CORRECTED
-from langchain_community.vectorstores import FAISS
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from prompts import WORKFLOW_PROMPT, SECTION_PROMPT
+from config import (
+    EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_MAX_RETRIES, EMBEDDING_RETRY_BASE_DELAY,
+    GENERATION_MAX_CONCURRENCY, RETRIEVAL_K, RETRIEVAL_USE_MMR, RETRIEVAL_MMR_FETCH_K, RETRIEVAL_MMR_LAMBDA,
+    RETRIEVAL_MODE, RETRIEVAL_MODES, RETRIEVAL_FUSION_FETCH_K, LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS
+)
+from cache_utils import SQLiteCache, normalize_text, content_hash
+from metrics import get_metrics, token_usage
+from prompt_utils import model_name, prompt_budgets, pack_context, truncate_to_tokens, get_requirements_digester
+from lexical_index import lexical_index_of, section_query, reciprocal_rank_fusion
+from api_scheduler import INTERACTIVE, request_priority, with_request_context
 
-# --- Custom Nebius Embeddings Class ---
-class NebiusEmbeddings(Embeddings):
-    """A custom embeddings class that uses the Nebius API directly."""
-    def __init__(self, model: str, api_key: str, base_url: str):
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
-        self.model = model
+logger = logging.getLogger(__name__)
 
-    def _get_embeddings(self, texts: List[str]) -> List[List[float]]:
-        if not texts: return []
-        response = self.client.embeddings.create(model=self.model, input=texts)
-        return [item.embedding for item in response.data]
+# LangChain, the OpenAI SDK and FAISS take seconds to import, and most app reruns need none of
+# them, so they are imported where they are used. `NebiusEmbeddings` lives in nebius_embeddings
+# and is resolved on first access (PEP 562), keeping `from llm_utils import NebiusEmbeddings` working.
+def __getattr__(name):
+    if name == "NebiusEmbeddings":
+        from nebius_embeddings import NebiusEmbeddings
+        return NebiusEmbeddings
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return self._get_embeddings(texts)
+# --- Embedding Cache ---
+class EmbeddingCache:
+    """A persistent, content-addressed embedding store keyed by (model, normalized text hash)."""
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.store = SQLiteCache(path, max_entries=max_entries)
 
-    def embed_query(self, text: str) -> List[float]:
-        embeddings = self._get_embeddings([text])
-        if not embeddings:
-            raise ValueError(f"Could not generate embedding for the text: {text}")
-        return embeddings[0]
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return content_hash(model, normalize_text(text))
+
+    def get_many(self, model: str, texts: List[str]) -> dict:
+        """Returns {text: embedding} for the texts that are already cached."""
+        keys = {self.key(model, text): text for text in texts}
+        found = self.store.get_many(keys)
+        return {keys[key]: array("f", value).tolist() for key, value in found.items()}
+
+    def set_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        self.store.set_many(
+            (self.key(model, text), array("f", embedding).tobytes())
+            for text, embedding in zip(texts, embeddings)
+        )
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+_default_embedding_cache = None
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Returns the process-wide embedding cache shared by all sessions."""
+    global _default_embedding_cache
+    if _default_embedding_cache is None:
+        _default_embedding_cache = EmbeddingCache()
+    return _default_embedding_cache
+
+# --- LLM Response Cache ---
+class LLMResponseCache:
+    """A persistent cache of generated texts keyed by (model, temperature, prompt hash, context hash).
+
+    The rendered prompt already contains the context; hashing the context separately keeps the
+    key explicit about the retrieval result it depends on.
+    """
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.store = SQLiteCache(path, max_entries=max_entries, ttl_seconds=ttl_seconds)
+
+    @staticmethod
+    def key(llm, prompt_text: str, context: str = "") -> str:
+        return content_hash(
+            model_name(llm) or "", str(getattr(llm, "temperature", "")), content_hash(prompt_text), content_hash(context)
+        )
+
+    def get(self, key: str):
+        value = self.store.get(key)
+        return None if value is None else value.decode("utf-8")
+
+    def set(self, key: str, text: str):
+        self.store.set(key, text.encode("utf-8"))
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+_default_llm_cache = None
+
+def get_llm_response_cache() -> LLMResponseCache:
+    """Returns the process-wide LLM response cache shared by all sessions."""
+    global _default_llm_cache
+    if _default_llm_cache is None:
+        _default_llm_cache = LLMResponseCache()
+    return _default_llm_cache
+
+# --- Embedding Batching ---
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: one token per CJK character, ~4 characters per token otherwise."""
+    cjk = len(re.findall(r"\p{Han}|\p{Hiragana}|\p{Katakana}|\p{Hangul}", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def make_batches(texts: List[str], max_size: int, max_tokens: int) -> List[List[int]]:
+    """Splits texts into batches of indices bounded by item count and estimated tokens."""
+    batches, current, current_tokens = [], [], 0
+    for index, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_size or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current: batches.append(current)
+    return batches
+
+def is_retryable_error(error: Exception) -> bool:
+    """Rate limits, server errors, timeouts and dropped connections are worth retrying."""
+    from openai import APIStatusError, APIConnectionError, APITimeoutError
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+def call_with_retry(fn, max_retries: int = EMBEDDING_MAX_RETRIES, base_delay: float = EMBEDDING_RETRY_BASE_DELAY,
+                    on_retry=None):
+    """Calls `fn`, retrying retryable API errors with exponential backoff and jitter.
+
+    `on_retry(error)` is called before each retry, e.g. to count retries in a metrics stage.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_error(e):
+                raise
+            delay = base_delay * (2 ** attempt) * (0.5 + random.random())
+            retry_after = getattr(getattr(e, "response", None), "headers", {}).get("retry-after")
+            if retry_after:
+                try: delay = max(delay, float(retry_after))
+                except ValueError: pass
+            get_metrics().increment("proposal_api_retries_total", status=getattr(e, "status_code", None) or type(e).__name__)
+            if on_retry:
+                on_retry(e)
+            time.sleep(delay)
 
 # --- Knowledge Base and Content Generation ---
-def create_kb_from_texts(texts, embedding_model_name, api_key, base_url):
-    """Creates a knowledge base from texts using the custom NebiusEmbeddings class."""
-    if not texts: return None
-    
-    combined_text = "\n\n".join(texts)
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-    chunks = text_splitter.split_text(combined_text)
-    if not chunks: return None
+def create_kb_from_documents(documents, embedding_model_name, api_key, base_url, index_factory=None, progress=None):
+    """Creates a knowledge base from {"name", "text", "pages"?} documents using NebiusEmbeddings.
+
+    Documents are chunked one at a time (page by page when "pages" from `extract_file` are given)
+    and embedded in batches; the resulting FAISS index is persisted in the shared knowledge-base
+    store, so unchanged documents are never re-embedded. Chunk metadata records the source name,
+    page and character offset. `index_factory` selects the index backend (default KB_INDEX_FACTORY).
+    `documents` may be a generator (e.g. over `file_utils.extract_files`), so embedding starts while
+    later files are still being extracted; `progress` receives the build events of `KnowledgeBaseStore.build`.
+    """
+    from kb_store import get_kb_store
+    from nebius_embeddings import NebiusEmbeddings
+    embeddings = NebiusEmbeddings(model=embedding_model_name, base_url=base_url, api_key=api_key)
+    with get_metrics().stage("build_kb", model=embedding_model_name) as info:
+        def counted(documents):
+            info["bytes"] = 0
+            for doc in documents:
+                if doc["text"]:
+                    info["bytes"] += len(doc["text"].encode("utf-8"))
+                    yield doc
+        knowledge_base = get_kb_store().build(counted(documents), embeddings, index_factory=index_factory, progress=progress)
+        if knowledge_base:
+            info["chunks"] = len(knowledge_base.index_to_docstore_id)
+    return knowledge_base
+
+def knowledge_base_id(documents, embedding_model_name, index_factory=None):
+    """Returns the corpus id `create_kb_from_documents` would build for `documents`, without building."""
+    from kb_store import get_kb_store
+    return get_kb_store().corpus_for([doc for doc in documents if doc["text"]], embedding_model_name, index_factory)
+
+def load_knowledge_base(corpus, embedding_model_name, api_key, base_url):
+    """Loads a persisted knowledge base by corpus id."""
+    from kb_store import get_kb_store
+    from nebius_embeddings import NebiusEmbeddings
+    embeddings = NebiusEmbeddings(model=embedding_model_name, base_url=base_url, api_key=api_key)
+    return get_kb_store().load(corpus, embeddings)
+
+def with_query_embeddings(knowledge_base, embedding_model_name, api_key, base_url):
+    """Returns a view of a shared knowledge base that embeds queries with the caller's API key.
 
+    The view shares the index, docstore and lexical index instead of copying them.
+    """
+    from langchain_community.vectorstores import FAISS
+    from nebius_embeddings import NebiusEmbeddings
     embeddings = NebiusEmbeddings(model=embedding_model_name, base_url=base_url, api_key=api_key)
-    return FAISS.from_texts(chunks, embeddings)
+    view = FAISS(embeddings, knowledge_base.index, knowledge_base.docstore, knowledge_base.index_to_docstore_id)
+    view.lexical_index = lexical_index_of(knowledge_base)
+    return view
+
+def create_kb_from_texts(texts, embedding_model_name, api_key, base_url, names=None):
+    """Creates a knowledge base from plain texts; see `create_kb_from_documents`."""
+    if not texts: return None
+    names = names or [f"文档 {i + 1}" for i in range(len(texts))]
+    documents = [{"name": name, "text": text} for name, text in zip(names, texts)]
+    return create_kb_from_documents(documents, embedding_model_name, api_key, base_url)
 
 def parse_template_sections(template):
     """Parses the proposal template into a list of sections."""
@@ -58,47 +219,274 @@ def parse_template_sections(template):
     if current_section: sections.append(current_section)
     return sections
 
-def generate_custom_workflow_mermaid(requirements, llm):
-    """Generates a custom mermaid workflow diagram."""
+def generate_custom_workflow_mermaid(requirements, llm, use_cache=True):
+    """Generates a custom mermaid workflow diagram.
+
+    Results are cached per prompt; `use_cache=False` forces a fresh call (and refreshes the cache).
+    """
+    from langchain_core.prompts import ChatPromptTemplate
     prompt = ChatPromptTemplate.from_template(WORKFLOW_PROMPT)
     chain = prompt | llm
-    result = chain.invoke({"requirements": requirements})
+    inputs = {"requirements": get_requirements_digester().digest(requirements, llm)}
+    cache = get_llm_response_cache()
+    cache_key = cache.key(llm, prompt.format(**inputs))
+    with get_metrics().stage("generate_workflow", model=model_name(llm)) as info:
+        cached = cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            info["cache_hits"] = 1
+            return cached
+        info["cache_misses"] = 1
+        result = chain.invoke(inputs)
+        info["prompt_tokens"], info["completion_tokens"] = token_usage(result)
     
     result_content = result.content.strip()
     result_content = re.sub(r"<think>.*?</think>", "", result_content, flags=re.DOTALL)
-    return "graph TD\n" + result_content if not result_content.startswith("graph TD") else result_content
+    workflow = "graph TD\n" + result_content if not result_content.startswith("graph TD") else result_content
+    cache.set(cache_key, workflow)
+    return workflow
 
-def generate_section_content(section, requirements, context, llm):
-    """Generates content for a specific proposal section."""
-    section_title = section["title"]
+class ThinkTagFilter:
+    """Incrementally removes <think>...</think> spans from a token stream.
+
+    Tags may be split across chunks, so a trailing fragment that could still become a tag
+    is held back until the next chunk arrives.
+    """
+    OPEN_TAG, CLOSE_TAG = "<think>", "</think>"
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_think = False
+
+    def feed(self, text: str) -> str:
+        """Consumes a chunk and returns the text that is now safe to display."""
+        self.buffer += text
+        visible = []
+        while True:
+            tag = self.CLOSE_TAG if self.in_think else self.OPEN_TAG
+            pos = self.buffer.find(tag)
+            if pos < 0:
+                break
+            if not self.in_think:
+                visible.append(self.buffer[:pos])
+            self.buffer = self.buffer[pos + len(tag):]
+            self.in_think = not self.in_think
+
+        held = 0
+        for size in range(min(len(tag) - 1, len(self.buffer)), 0, -1):
+            if tag.startswith(self.buffer[-size:]):
+                held = size
+                break
+        if not self.in_think:
+            visible.append(self.buffer[:len(self.buffer) - held])
+        self.buffer = self.buffer[len(self.buffer) - held:]
+        return "".join(visible)
+
+    def flush(self) -> str:
+        """Returns any held-back text once the stream has ended."""
+        rest = "" if self.in_think else self.buffer
+        self.buffer = ""
+        return rest
+
+def _section_prompt_inputs(section, requirements, context, llm):
+    """Splits a template section into its title line and the SECTION_PROMPT inputs.
+
+    Long requirements are replaced by their cached digest and the context is capped to the
+    model's context budget, so every section prompt fits the model's window.
+    """
     original_lines = section["content"].strip().split('\n')
     title_line = original_lines[0]
-    body_placeholder = '\n'.join(original_lines[1:])
+    model = model_name(llm)
+    return title_line, {
+        "section_title": section["title"],
+        "body_placeholder": '\n'.join(original_lines[1:]),
+        "requirements": get_requirements_digester().digest(requirements, llm),
+        "context": truncate_to_tokens(context, prompt_budgets(model)[1], model)
+    }
+
+def generate_section_content(section, requirements, context, llm, use_cache=True):
+    """Generates content for a specific proposal section.
+
+    Results are cached per (model, temperature, prompt, context); pass `use_cache=False` to
+    regenerate, which also replaces the cached result.
+    """
+    section_title = section["title"]
 
     if "Workflow" in section_title:
         try:
-            custom_workflow = generate_custom_workflow_mermaid(requirements, llm)
+            custom_workflow = generate_custom_workflow_mermaid(requirements, llm, use_cache=use_cache)
             return f"## {section_title}\n\n```mermaid\n{custom_workflow}\n```"
         except Exception as e:
-            st.warning(f"Error generating custom workflow: {str(e)}. Using default.")
+            logger.warning(f"Error generating custom workflow: {str(e)}. Using default.")
             return section["content"]
 
+    from langchain_core.prompts import ChatPromptTemplate
+    title_line, inputs = _section_prompt_inputs(section, requirements, context, llm)
     prompt = ChatPromptTemplate.from_template(SECTION_PROMPT)
     chain = prompt | llm
-    result = chain.invoke({
-        "section_title": section_title,
-        "body_placeholder": body_placeholder,
-        "requirements": requirements,
-        "context": context
-    })
+    cache = get_llm_response_cache()
+    cache_key = cache.key(llm, prompt.format(**inputs), inputs["context"])
+    with get_metrics().stage("generate_section", model=model_name(llm)) as info:
+        cached = cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            info["cache_hits"] = 1
+            return cached
+        info["cache_misses"] = 1
+        result = chain.invoke(inputs)
+        info["prompt_tokens"], info["completion_tokens"] = token_usage(result)
     
     result_content = result.content.strip()
     result_content = re.sub(r"<think>.*?</think>", "", result_content, flags=re.DOTALL)
-    return f"{title_line}\n\n{result_content}"
+    content = f"{title_line}\n\n{result_content}"
+    cache.set(cache_key, content)
+    return content
+
+def stream_section_content(section, requirements, context, llm, use_cache=True):
+    """Streaming variant of `generate_section_content` that yields the section text as it grows.
+
+    Each yielded value is the full section so far; <think> spans are dropped as they stream in.
+    The last yielded value equals what `generate_section_content` would return. Both share the
+    response cache: a cached section is yielded at once, and only a fully streamed one is cached.
+    """
+    if "Workflow" in section["title"]:
+        yield generate_section_content(section, requirements, context, llm, use_cache=use_cache)
+        return
+
+    from langchain_core.prompts import ChatPromptTemplate
+    title_line, inputs = _section_prompt_inputs(section, requirements, context, llm)
+    prompt = ChatPromptTemplate.from_template(SECTION_PROMPT)
+    chain = prompt | llm
+    cache = get_llm_response_cache()
+    cache_key = cache.key(llm, prompt.format(**inputs), inputs["context"])
+    think_filter = ThinkTagFilter()
+    body = ""
+    with get_metrics().stage("stream_section", model=model_name(llm)) as info:
+        cached = cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            info["cache_hits"] = 1
+            yield cached
+            return
+        info["cache_misses"] = 1
+        for chunk in chain.stream(inputs):
+            info["chunks"] = info.get("chunks", 0) + 1
+            if chunk.usage_metadata:
+                info["prompt_tokens"], info["completion_tokens"] = token_usage(chunk)
+            delta = think_filter.feed(chunk.content)
+            if delta:
+                body = (body + delta).lstrip()
+                if body:
+                    yield f"{title_line}\n\n{body}"
+    body = (body + think_filter.flush()).strip()
+    content = f"{title_line}\n\n{body}"
+    cache.set(cache_key, content)
+    yield content
+
+def retrieve_section_contexts(knowledge_base, sections, requirements, k=RETRIEVAL_K, use_mmr=RETRIEVAL_USE_MMR,
+                              fetch_k=RETRIEVAL_MMR_FETCH_K, lambda_mult=RETRIEVAL_MMR_LAMBDA, model=None, max_tokens=None,
+                              mode=RETRIEVAL_MODE):
+    """Retrieves the knowledge-base context for several sections at once.
+
+    `mode` selects the search (see RETRIEVAL_MODE). "dense" embeds all section queries (title +
+    requirements) in one batch, going through the embedding cache, and searches FAISS once;
+    "lexical" ranks chunks with the knowledge base's BM25 index, queried by the section's title
+    and template body plus the rarest requirement terms, and makes no API call; "hybrid" runs
+    both and merges the rankings by reciprocal-rank fusion. With `use_mmr`, `fetch_k`
+    candidates per section are re-ranked by maximal marginal relevance so near-duplicate chunks
+    are dropped (not in "lexical" mode, which has no query vectors).
+    The chunks are packed by relevance into `max_tokens` (default: the context budget of `model`).
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {RETRIEVAL_MODES}")
+    if not knowledge_base or not sections:
+        return ["" for _ in sections]
+    queries = [f"{section['title']} {requirements}" for section in sections]
+    max_tokens = max_tokens or prompt_budgets(model)[1]
+    search_k = k
+    if use_mmr:
+        search_k = max(search_k, fetch_k)
+    if mode == "hybrid":
+        search_k = max(search_k, RETRIEVAL_FUSION_FETCH_K)
+    search_k = min(search_k, knowledge_base.index.ntotal)
+
+    rankings = [[] for _ in queries]
+    query_vectors = None
+    if mode != "lexical":
+        # Query embeddings block a user waiting for a section, so they go ahead of bulk KB embedding.
+        with request_priority(INTERACTIVE):
+            query_vectors = np.array(knowledge_base.embedding_function.embed_documents(queries), dtype=np.float32)
+        if knowledge_base._normalize_L2:
+            import faiss
+            faiss.normalize_L2(query_vectors)
+        _, indices = knowledge_base.index.search(query_vectors, search_k)
+        for ranking, row in zip(rankings, indices):
+            ranking.append([int(i) for i in row if i != -1])
+    if mode != "dense":
+        lexical_index = lexical_index_of(knowledge_base)
+        for ranking, section in zip(rankings, sections):
+            ranking.append(lexical_index.search(section_query(lexical_index, section, requirements), search_k))
+
+    contexts = []
+    for i, ranking in enumerate(rankings):
+        positions = reciprocal_rank_fusion(ranking) if len(ranking) > 1 else ranking[0]
+        if use_mmr and query_vectors is not None and len(positions) > k:
+            from langchain_community.vectorstores.utils import maximal_marginal_relevance
+            from kb_store import supports_reconstruct
+            if supports_reconstruct(knowledge_base.index):
+                candidates = np.array([knowledge_base.index.reconstruct(p) for p in positions])
+            else:
+                # Fast-scan indexes cannot decode their vectors; the chunks' embeddings come from the
+                # embedding cache instead (they were cached when the knowledge base was built).
+                texts = [knowledge_base.docstore.search(knowledge_base.index_to_docstore_id[p]).page_content for p in positions]
+                with request_priority(INTERACTIVE):
+                    candidates = np.array(knowledge_base.embedding_function.embed_documents(texts), dtype=np.float32)
+                if knowledge_base._normalize_L2:
+                    import faiss
+                    faiss.normalize_L2(candidates)
+            positions = [positions[j] for j in maximal_marginal_relevance(query_vectors[i], candidates, lambda_mult=lambda_mult, k=k)]
+        docs = [knowledge_base.docstore.search(knowledge_base.index_to_docstore_id[p]) for p in positions[:k]]
+        contexts.append(pack_context([doc.page_content for doc in docs], max_tokens, model))
+    return contexts
+
+def retrieve_context(knowledge_base, section, requirements, k=RETRIEVAL_K, use_mmr=RETRIEVAL_USE_MMR, model=None,
+                     mode=RETRIEVAL_MODE):
+    """Retrieves the knowledge-base context for a section, queried by its title and the requirements."""
+    return retrieve_section_contexts(knowledge_base, [section], requirements, k=k, use_mmr=use_mmr, model=model, mode=mode)[0]
+
+def generate_all_sections(sections, requirements, llm, knowledge_base=None, max_workers=GENERATION_MAX_CONCURRENCY,
+                          use_mmr=RETRIEVAL_USE_MMR, use_cache=True, contexts=None, retrieval_mode=RETRIEVAL_MODE):
+    """Generates all sections concurrently on a bounded thread pool.
+
+    Context for every section is retrieved up front in one batched search, unless `contexts`
+    (one per section) are given. Returns
+    (generated_sections, errors): the contents in template order, and a dict mapping
+    the index of each failed section to its error. A failed section keeps its template
+    content so that one failure never aborts the others.
+    """
+    if contexts is None:
+        contexts = retrieve_section_contexts(knowledge_base, sections, requirements, use_mmr=use_mmr, model=model_name(llm),
+                                             mode=retrieval_mode)
+    if sections:
+        # Condense long requirements once up front rather than in the first worker of each section.
+        get_requirements_digester().digest(requirements, llm)
+
+    def generate(section, context):
+        return generate_section_content(section, requirements, context, llm, use_cache=use_cache)
+
+    generated_sections = [section["content"] for section in sections]
+    errors = {}
+    if not sections:
+        return generated_sections, errors
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sections)))) as executor:
+        futures = {executor.submit(with_request_context(generate), section, context): i for i, (section, context) in enumerate(zip(sections, contexts))}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                generated_sections[i] = future.result()
+            except Exception as e:
+                errors[i] = e
+    return generated_sections, errors
 
-def get_complete_proposal():
+def get_complete_proposal(generated_sections):
     """Combines all generated sections into a complete proposal string."""
-    generated_sections = st.session_state.section_generation["generated_sections"]
     if not generated_sections:
         return ""
-    return "# Proposal\n\n" + "\n\n".join(generated_sections)
\ No newline at end of file
+    return "# Proposal\n\n" + "\n\n".join(generated_sections)
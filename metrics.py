@@ -0,0 +1,245 @@
+# metrics.py
+
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config import METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL_SECONDS, METRICS_HOST, MODEL_PRICES_PER_MILLION_TOKENS
+
+logger = logging.getLogger("proposal.metrics")
+
+# Fields a stage may report besides its wall time; each becomes a Prometheus counter.
+STAGE_FIELDS = ("bytes", "chunks", "prompt_tokens", "completion_tokens", "retries", "cache_hits", "cache_misses")
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class MetricsRegistry:
+    """Per-stage wall time, volume, token and retry metrics for the proposal pipeline.
+
+    Every finished stage is logged as one JSON line on the `proposal.metrics` logger and
+    aggregated into Prometheus-style counters and latency histograms.
+    """
+    def __init__(self, dump_path: str = METRICS_DUMP_PATH, dump_interval: float = METRICS_DUMP_INTERVAL_SECONDS,
+                 recent_samples: int = 200):
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self._lock = threading.Lock()
+        self._calls = defaultdict(int)
+        self._errors = defaultdict(int)
+        self._seconds = defaultdict(float)
+        self._buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self._fields = defaultdict(float)
+        self._tokens = defaultdict(float)
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._recent = defaultdict(lambda: deque(maxlen=recent_samples))
+        self._last_dump = 0.0
+
+    def record(self, stage: str, seconds: float, error: Exception = None, **fields):
+        """Records one completed stage run."""
+        model = fields.pop("model", None)
+        with self._lock:
+            self._calls[stage] += 1
+            if error is not None:
+                self._errors[stage] += 1
+            self._seconds[stage] += seconds
+            self._recent[stage].append(seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self._buckets[stage][i] += 1
+            for name in STAGE_FIELDS:
+                if fields.get(name):
+                    self._fields[(stage, name)] += fields[name]
+            if model:
+                for kind in ("prompt_tokens", "completion_tokens"):
+                    if fields.get(kind):
+                        self._tokens[(model, kind)] += fields[kind]
+        entry = {"stage": stage, "seconds": round(seconds, 4), "status": "error" if error else "ok", **fields}
+        if model:
+            entry["model"] = model
+        if error is not None:
+            entry["error"] = str(error)
+        logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+        self._dump_if_due()
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Increments a free-form counter, e.g. retries observed inside a stage."""
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @contextmanager
+    def stage(self, stage: str, **fields):
+        """Times the enclosed block; the yielded dict can be filled with STAGE_FIELDS or `model`."""
+        info = dict(fields)
+        start = time.perf_counter()
+        error = None
+        try:
+            yield info
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Also runs when a generator holding the stage is closed early.
+            self.record(stage, time.perf_counter() - start, error=error, **info)
+
+    def summary(self):
+        """Returns one row per stage for display: calls, errors, latency and accumulated fields."""
+        with self._lock:
+            rows = []
+            for stage in sorted(self._calls):
+                recent = sorted(self._recent[stage])
+                row = {
+                    "stage": stage,
+                    "calls": self._calls[stage],
+                    "errors": self._errors[stage],
+                    "avg_s": round(self._seconds[stage] / self._calls[stage], 3),
+                    "p95_s": round(recent[max(0, int(len(recent) * 0.95 + 0.5) - 1)], 3) if recent else 0.0,
+                    "total_s": round(self._seconds[stage], 2),
+                }
+                for name in STAGE_FIELDS:
+                    row[name] = int(self._fields.get((stage, name), 0))
+                rows.append(row)
+            return rows
+
+    def estimated_cost(self):
+        """Returns {model: USD} for models with a price in MODEL_PRICES_PER_MILLION_TOKENS."""
+        with self._lock:
+            costs = defaultdict(float)
+            for (model, kind), tokens in self._tokens.items():
+                prices = MODEL_PRICES_PER_MILLION_TOKENS.get(model)
+                if prices:
+                    costs[model] += tokens / 1_000_000 * prices[0 if kind == "prompt_tokens" else 1]
+            return dict(costs)
+
+    def render_prometheus(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines += ["# HELP proposal_stage_seconds Wall time of pipeline stages.", "# TYPE proposal_stage_seconds histogram"]
+            for stage in sorted(self._calls):
+                for bound, count in zip(LATENCY_BUCKETS, self._buckets[stage]):
+                    lines.append(f'proposal_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'proposal_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {self._calls[stage]}')
+                lines.append(f'proposal_stage_seconds_sum{{stage="{stage}"}} {self._seconds[stage]:.6f}')
+                lines.append(f'proposal_stage_seconds_count{{stage="{stage}"}} {self._calls[stage]}')
+            lines += ["# TYPE proposal_stage_errors_total counter"]
+            lines += [f'proposal_stage_errors_total{{stage="{stage}"}} {count}' for stage, count in sorted(self._errors.items())]
+            for name in STAGE_FIELDS:
+                lines.append(f"# TYPE proposal_stage_{name}_total counter")
+                lines += [
+                    f'proposal_stage_{name}_total{{stage="{stage}"}} {value:g}'
+                    for (stage, field), value in sorted(self._fields.items()) if field == name
+                ]
+            lines.append("# TYPE proposal_llm_tokens_total counter")
+            lines += [
+                f'proposal_llm_tokens_total{{model="{model}",kind="{kind}"}} {value:g}'
+                for (model, kind), value in sorted(self._tokens.items())
+            ]
+            for kind, series in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric, labels), value in sorted(series.items()):
+                        if metric == name:
+                            label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+                            lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str = None):
+        """Writes the Prometheus text format to a file (atomically), e.g. for a node-exporter textfile collector."""
+        path = path or self.dump_path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def _dump_if_due(self):
+        if not self.dump_path:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._last_dump < self.dump_interval:
+                return
+            self._last_dump = now
+        try:
+            self.dump()
+        except OSError as e:
+            logger.warning(f"Could not write metrics dump: {e}")
+
+_default_metrics = None
+
+def get_metrics() -> MetricsRegistry:
+    """Returns the process-wide metrics registry."""
+    global _default_metrics
+    if _default_metrics is None:
+        _default_metrics = MetricsRegistry()
+    return _default_metrics
+
+def instrumented(stage: str):
+    """Decorator that records the wrapped function's wall time and errors as `stage`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_metrics().stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def token_usage(message):
+    """Extracts (prompt_tokens, completion_tokens) from a LangChain chat message, if reported."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    usage = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+_server = None
+_server_started = False
+_server_lock = threading.Lock()
+
+def start_metrics_server(port: int, host: str = METRICS_HOST):
+    """Serves `GET /metrics` in a daemon thread, once per process; later calls are no-ops.
+
+    Returns the server, or None if the address could not be bound (e.g. the port is taken by
+    another app process), which is logged instead of raised.
+    """
+    global _server, _server_started
+    with _server_lock:
+        if _server_started:
+            return _server
+        _server_started = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = get_metrics().render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logger.warning(f"Could not serve metrics on {host}:{port}: {e}")
+            return None
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        _server = server
+        return _server
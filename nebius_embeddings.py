@@ -0,0 +1,105 @@
+# nebius_embeddings.py
+
+import threading
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import Embeddings
+from config import EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_MAX_TOKENS, EMBEDDING_MAX_WORKERS, EMBEDDING_MAX_RETRIES
+from metrics import get_metrics
+from client_registry import get_client_registry
+from api_scheduler import with_request_context
+from llm_utils import get_embedding_cache, make_batches, call_with_retry
+
+class NebiusEmbeddings(Embeddings):
+    """A custom embeddings class that uses the Nebius API directly.
+
+    Embeddings are looked up in a persistent cache first; only cache misses are sent to the API.
+    Pass `cache=False` to disable caching. Misses are split into size- and token-bounded batches
+    that run on a bounded thread pool and are retried with backoff on 429/5xx responses.
+    """
+    def __init__(self, model: str, api_key: str, base_url: str, cache=None,
+                 batch_size: int = EMBEDDING_BATCH_SIZE, max_batch_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                 max_workers: int = EMBEDDING_MAX_WORKERS, max_retries: int = EMBEDDING_MAX_RETRIES):
+        # Retries are handled per batch in `call_with_retry`, so the client itself should not retry.
+        # The client (and its keep-alive connection pool) is shared across instances and sessions.
+        self.client = get_client_registry().openai_client(base_url, api_key, max_retries=0)
+        self.model = model
+        self.cache = get_embedding_cache() if cache is None else (cache or None)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+
+    def _get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        if not texts: return []
+        with get_metrics().stage("embed", model=self.model) as info:
+            cached = self.cache.get_many(self.model, texts) if self.cache else {}
+            missing = list(dict.fromkeys(text for text in texts if text not in cached))
+            info.update(chunks=len(texts), bytes=sum(len(text.encode("utf-8")) for text in texts),
+                        cache_hits=len(texts) - len(missing), cache_misses=len(missing))
+            if missing:
+                cached.update(zip(missing, self._fetch_embeddings(missing, info)))
+            return [cached[text] for text in texts]
+
+    def _fetch_embeddings(self, texts: List[str], info=None) -> List[List[float]]:
+        """Embeds texts batch by batch; the result preserves the input order.
+
+        Prompt tokens and retries are added to the metrics stage `info` when given.
+        """
+        batches = make_batches(texts, self.batch_size, self.max_batch_tokens)
+        results = [None] * len(texts)
+        info = {} if info is None else info
+        info_lock = threading.Lock()
+
+        def count(name, value):
+            with info_lock:
+                info[name] = info.get(name, 0) + value
+
+        def run_batch(indices):
+            batch = [texts[i] for i in indices]
+            embeddings, prompt_tokens = call_with_retry(
+                lambda: self._embed_batch(batch), max_retries=self.max_retries, on_retry=lambda e: count("retries", 1)
+            )
+            count("prompt_tokens", prompt_tokens)
+            # Cache each batch as it lands so a later failure does not discard finished work.
+            if self.cache:
+                self.cache.set_many(self.model, batch, embeddings)
+            for i, embedding in zip(indices, embeddings):
+                results[i] = embedding
+
+        if len(batches) == 1 or self.max_workers <= 1:
+            for indices in batches: run_batch(indices)
+            return results
+
+        # Backpressure: never keep more than 2x max_workers batches queued on the pool.
+        slots = threading.BoundedSemaphore(self.max_workers * 2)
+        def release_slot(_):
+            slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = []
+            for indices in batches:
+                slots.acquire()
+                future = executor.submit(with_request_context(run_batch), indices)
+                future.add_done_callback(release_slot)
+                futures.append(future)
+                if future.done() and future.exception():
+                    break
+            for future in futures:
+                future.result()
+        return results
+
+    def _embed_batch(self, texts: List[str]):
+        """Returns the batch's embeddings in input order and the prompt tokens the API reported."""
+        response = self.client.embeddings.create(model=self.model, input=texts)
+        prompt_tokens = getattr(response.usage, "prompt_tokens", 0) if response.usage else 0
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)], prompt_tokens
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._get_embeddings(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        embeddings = self._get_embeddings([text])
+        if not embeddings:
+            raise ValueError(f"Could not generate embedding for the text: {text}")
+        return embeddings[0]
@@ -0,0 +1,88 @@
+# pdf_extraction.py
+
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import fitz  # PyMuPDF
+from config import PDF_EXTRACTION_MAX_WORKERS, PDF_PAGES_PER_TASK
+from cache_utils import content_hash
+
+# Kept free of Streamlit/LangChain imports so that spawned worker processes start quickly.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool(max_workers):
+    """Returns a shared process pool; workers are spawned, which is safe from threaded servers."""
+    global _pool
+    if _pool is None:
+        # Files are extracted from several threads and sessions at once; only one may create the pool.
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def _discard_pool(pool):
+    """Drops a broken pool, unless another thread has already replaced it."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def extract_pdf_page_range(file_path, start, end):
+    """Extracts text and image references for pages [start, end) in a single open of the document.
+
+    Returns a list of {"page", "text", "images", "errors"} dicts with 1-based page numbers.
+    Image bytes are hashed but not written; each xref is reported once, on the first page using it.
+    """
+    pages = []
+    seen_xrefs = set()
+    with fitz.open(file_path) as pdf_document:
+        for page_index in range(start, end):
+            page = pdf_document[page_index]
+            image_refs, errors = [], []
+            for img in page.get_images(full=True):
+                xref = img[0]
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                try:
+                    base_image = pdf_document.extract_image(xref)
+                    image_refs.append({
+                        "digest": content_hash(base_image["image"]),
+                        "ext": base_image["ext"],
+                        "xref": xref,
+                        "width": base_image["width"],
+                        "height": base_image["height"],
+                    })
+                except Exception as e:
+                    errors.append(str(e))
+            pages.append({"page": page_index + 1, "text": page.get_text(), "images": image_refs, "errors": errors})
+    return pages
+
+def extract_pdf_pages(file_path, max_workers=PDF_EXTRACTION_MAX_WORKERS, pages_per_task=PDF_PAGES_PER_TASK,
+                      min_pool_tasks=2):
+    """Extracts per-page text and image references with PyMuPDF, splitting large documents across processes.
+
+    Documents split into fewer than `min_pool_tasks` page ranges are extracted in-process; with 1,
+    short documents go to the pool too, so several files extracted at once parse in parallel.
+    """
+    with fitz.open(file_path) as pdf_document:
+        page_count = pdf_document.page_count
+    ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    if len(ranges) < min_pool_tasks or max_workers <= 1:
+        return [page for start, end in ranges for page in extract_pdf_page_range(file_path, start, end)]
+
+    pool = _get_pool(max_workers)
+    try:
+        futures = [pool.submit(extract_pdf_page_range, file_path, start, end) for start, end in ranges]
+        pages = []
+        for future in futures:
+            pages.extend(future.result())
+        return pages
+    except BrokenProcessPool:
+        # A crashed worker poisons the pool; drop it and finish this document in-process.
+        _discard_pool(pool)
+        return [page for start, end in ranges for page in extract_pdf_page_range(file_path, start, end)]
@@ -0,0 +1,149 @@
+# prompt_utils.py
+
+import logging
+import threading
+import regex as re
+from config import (
+    TEXT_MODEL_PROFILES, DEFAULT_TEXT_MODEL_PROFILE, PROMPT_REQUIREMENTS_TOKEN_BUDGET,
+    PROMPT_CONTEXT_TOKEN_BUDGET, PROMPT_RESERVED_TOKENS, DIGEST_CACHE_PATH, DIGEST_CACHE_MAX_ENTRIES
+)
+from prompts import REQUIREMENTS_DIGEST_PROMPT
+from cache_utils import SQLiteCache, normalize_text, content_hash
+from metrics import get_metrics, token_usage
+
+logger = logging.getLogger(__name__)
+
+CJK_PATTERN = re.compile(r"\p{Han}|\p{Hiragana}|\p{Katakana}|\p{Hangul}")
+
+# Bumped whenever REQUIREMENTS_DIGEST_PROMPT or the digest procedure changes, so stale digests are not reused.
+DIGEST_VERSION = "1"
+
+# --- Token Counting ---
+def model_name(llm):
+    """Returns the model name of a LangChain chat model, or None."""
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None)
+
+def model_profile(model):
+    return TEXT_MODEL_PROFILES.get(model, DEFAULT_TEXT_MODEL_PROFILE)
+
+def count_tokens(text: str, model: str = None) -> int:
+    """Estimates the prompt tokens of `text` for a model in TEXT_MODEL_PROFILES."""
+    profile = model_profile(model)
+    cjk = len(CJK_PATTERN.findall(text))
+    return int(cjk * profile["tokens_per_cjk_char"] + (len(text) - cjk) / profile["chars_per_token"] + 0.999)
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = None) -> str:
+    """Cuts `text` to at most `max_tokens`, preferring to end at a line or sentence boundary."""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid], model) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    cut = text[:low]
+    boundary = max(cut.rfind("\n"), cut.rfind("。"), cut.rfind(". "))
+    if boundary > low // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip()
+
+def prompt_budgets(model: str = None):
+    """Returns (requirements_tokens, context_tokens), scaled down if the model's window is too small."""
+    requirements_tokens, context_tokens = PROMPT_REQUIREMENTS_TOKEN_BUDGET, PROMPT_CONTEXT_TOKEN_BUDGET
+    available = model_profile(model)["context_window"] - PROMPT_RESERVED_TOKENS
+    scale = min(1.0, max(available, 0) / (requirements_tokens + context_tokens))
+    return int(requirements_tokens * scale), int(context_tokens * scale)
+
+# --- Prompt Packing ---
+def pack_context(chunks, max_tokens: int, model: str = None) -> str:
+    """Joins retrieved chunks, most relevant first, until the token budget is used up.
+
+    Duplicate chunks are skipped, and a chunk that does not fit is skipped in favour of
+    smaller, less relevant ones. If not even the top chunk fits, it is truncated.
+    """
+    packed, seen, used = [], set(), 0
+    separator_tokens = count_tokens("\n\n", model)
+    for chunk in chunks:
+        chunk = chunk.strip()
+        if not chunk or chunk in seen:
+            continue
+        seen.add(chunk)
+        tokens = count_tokens(chunk, model) + (separator_tokens if packed else 0)
+        if used + tokens <= max_tokens:
+            packed.append(chunk)
+            used += tokens
+    if not packed and seen:
+        packed.append(truncate_to_tokens(next(iter(seen)), max_tokens, model))
+    return "\n\n".join(packed)
+
+class RequirementsDigester:
+    """Condenses long requirements once into a digest that every section prompt reuses.
+
+    Requirements within the token budget are used verbatim. Longer ones are summarized by the
+    generation model; digests are cached on disk by (model, budget, normalized text), and
+    concurrent requests for the same digest wait for a single LLM call.
+    """
+    def __init__(self, path: str = DIGEST_CACHE_PATH, max_entries: int = DIGEST_CACHE_MAX_ENTRIES):
+        self.store = SQLiteCache(path, max_entries=max_entries)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def key(model: str, max_tokens: int, requirements: str) -> str:
+        return content_hash(DIGEST_VERSION, model or "", str(max_tokens), normalize_text(requirements))
+
+    def digest(self, requirements: str, llm, max_tokens: int = None) -> str:
+        """Returns `requirements` itself if it fits `max_tokens`, otherwise its cached digest."""
+        model = model_name(llm)
+        max_tokens = max_tokens or prompt_budgets(model)[0]
+        if count_tokens(requirements, model) <= max_tokens:
+            return requirements
+        key = self.key(model, max_tokens, requirements)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                cached = self.store.get(key)
+                if cached is not None:
+                    return cached.decode("utf-8")
+                try:
+                    digest = truncate_to_tokens(self._summarize(requirements, llm, model, max_tokens), max_tokens, model)
+                except Exception as e:
+                    logger.warning(f"Could not condense the requirements: {e}. Truncating instead.")
+                    return truncate_to_tokens(requirements, max_tokens, model)
+                self.store.set(key, digest.encode("utf-8"))
+                return digest
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+
+    def _summarize(self, requirements, llm, model, max_tokens):
+        """Summarizes the requirements, in pieces if they exceed what the model can read at once."""
+        from langchain_core.prompts import ChatPromptTemplate
+        piece_tokens = model_profile(model)["context_window"] - PROMPT_RESERVED_TOKENS
+        pieces = [requirements]
+        if count_tokens(requirements, model) > piece_tokens:
+            pieces, rest = [], requirements
+            while rest:
+                piece = truncate_to_tokens(rest, piece_tokens, model) or rest[:piece_tokens]
+                pieces.append(piece)
+                rest = rest[len(piece):].lstrip()
+        chain = ChatPromptTemplate.from_template(REQUIREMENTS_DIGEST_PROMPT) | llm
+        digests = []
+        for piece in pieces:
+            with get_metrics().stage("digest_requirements", model=model) as info:
+                result = chain.invoke({"requirements": piece, "max_tokens": max_tokens // len(pieces)})
+                info["prompt_tokens"], info["completion_tokens"] = token_usage(result)
+            digests.append(re.sub(r"<think>.*?</think>", "", result.content, flags=re.DOTALL).strip())
+        return "\n".join(digests)
+
+_default_digester = None
+
+def get_requirements_digester() -> RequirementsDigester:
+    """Returns the process-wide requirements digester."""
+    global _default_digester
+    if _default_digester is None:
+        _default_digester = RequirementsDigester()
+    return _default_digester
@@ -26,9 +26,23 @@ graph TD
 The workflow must be specifically tailored to the requirements provided and reflect a realistic project execution approach.
 """
 
-# Prompt for generating the content of a single proposal section
+# Prompt for generating the content of a single proposal section.
+# The requirements come first so every section of a proposal shares the same prompt prefix,
+# which lets providers reuse their prompt cache; section-specific parts come last.
 SECTION_PROMPT = """
-You are tasked with generating the body content for a specific section of a document.
+You are tasked with generating the body content for one section of a proposal document.
+
+# DOCUMENT REQUIREMENTS
+{requirements}
+
+Instructions:
+1. Generate ONLY the body content for the section named under SECTION TITLE below.
+2. DO NOT include the section header itself in your output.
+3. Replace the placeholder text with concrete, specific content.
+4. Maintain a formal and professional tone.
+
+# RELEVANT CONTEXT
+{context}
 
 # SECTION TITLE
 {section_title}
@@ -36,17 +50,19 @@ You are tasked with generating the body content for a specific section of a docu
 # CONTENT TO GENERATE (replace the placeholder text below)
 {body_placeholder}
 
-# DOCUMENT REQUIREMENTS
-{requirements}
+IMPORTANT: Generate ONLY the body content for the section titled "{section_title}", without the "## {section_title}" header.
+"""
 
-# RELEVANT CONTEXT
-{context}
+# Prompt for condensing long requirements into a digest that is shared by every section prompt
+REQUIREMENTS_DIGEST_PROMPT = """
+You are preparing a requirements brief for a proposal writer. Condense the project requirements below into a digest of at most {max_tokens} tokens.
 
 Instructions:
-1. Generate ONLY the body content for the section titled "{section_title}".
-2. DO NOT include the section header (e.g., "## {section_title}") in your output.
-3. Replace the placeholder text with concrete, specific content.
-4. Maintain a formal and professional tone.
+1. Keep every concrete fact the proposal must address: objectives, scope, deliverables, technical requirements, constraints, schedules, budgets, evaluation criteria, and named standards or systems.
+2. Drop boilerplate, repetition, and formatting noise.
+3. Write the digest in the same language as the requirements, as concise bullet points.
+4. Return ONLY the digest, nothing else.
 
-IMPORTANT: Generate ONLY the body content for the section.
-"""
\ No newline at end of file
+# PROJECT REQUIREMENTS:
+{requirements}
+"""
@@ -0,0 +1,166 @@
+# section_state.py
+
+import numpy as np
+import regex as re
+from config import (
+    GENERATION_MAX_CONCURRENCY, RETRIEVAL_USE_MMR, RETRIEVAL_MODE, SECTION_REQUIREMENT_DEPENDENCIES
+)
+from cache_utils import normalize_text, content_hash
+from prompt_utils import model_name
+from llm_utils import parse_template_sections, generate_all_sections
+from api_scheduler import INTERACTIVE, request_priority
+
+class SectionGenerationState:
+    """Generated proposal sections together with hashes of the inputs each one was generated from.
+
+    A record is kept per template section (keyed by title and occurrence) as
+        {"content": current text, "generated": text as generated, "inputs": input hashes}
+    so changing the template keeps the sections whose titles survive, and a record whose
+    `content` differs from `generated` has been edited by the user.
+    """
+    def __init__(self, template: str = ""):
+        self.template = ""
+        self.sections = []
+        self.records = {}
+        self.set_template(template)
+
+    def set_template(self, template: str):
+        """Switches to a new template, dropping only the records of sections that no longer exist."""
+        self.template = template
+        self.sections = parse_template_sections(template) if template else []
+        keys = set(self.keys())
+        self.records = {key: record for key, record in self.records.items() if key in keys}
+
+    def keys(self):
+        seen = {}
+        for section in self.sections:
+            seen[section["title"]] = seen.get(section["title"], 0) + 1
+            yield f"{section['title']}#{seen[section['title']]}"
+
+    def record_for(self, index: int):
+        return self.records.get(list(self.keys())[index])
+
+    @property
+    def current_index(self) -> int:
+        """Index of the first section that has not been generated yet (len(sections) when all are)."""
+        for i, key in enumerate(self.keys()):
+            if key not in self.records:
+                return i
+        return len(self.sections)
+
+    def pending_indices(self):
+        return [i for i, key in enumerate(self.keys()) if key not in self.records]
+
+    def generated_sections(self):
+        """Contents of the sections generated so far, in template order, up to the first gap."""
+        keys = list(self.keys())[:self.current_index]
+        return [self.records[key]["content"] for key in keys]
+
+    def record(self, index: int, content: str, inputs: dict):
+        self.records[list(self.keys())[index]] = {"content": content, "generated": content, "inputs": inputs}
+
+    def edit(self, index: int, content: str):
+        """Stores a user edit; the record keeps the generated text to tell edits apart."""
+        record = self.record_for(index)
+        if record is not None:
+            record["content"] = content
+
+    def is_edited(self, index: int) -> bool:
+        record = self.record_for(index)
+        return record is not None and record["content"] != record["generated"]
+
+    def stale_indices(self, inputs):
+        """Indices of generated sections whose recorded inputs differ from `inputs` (one dict per section)."""
+        return [
+            i for i, (key, section_inputs) in enumerate(zip(self.keys(), inputs))
+            if key in self.records and self.records[key]["inputs"] != section_inputs
+        ]
+
+    def reset(self):
+        self.records = {}
+
+# --- Input Hashes ---
+def split_paragraphs(text: str):
+    """Splits requirements into paragraphs (blank-line separated, or lines if there are no blank lines)."""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    if len(paragraphs) < 2:
+        paragraphs = [line.strip() for line in text.splitlines() if line.strip()]
+    return paragraphs
+
+def requirement_dependencies(requirements: str, sections, embeddings=None, top_n: int = SECTION_REQUIREMENT_DEPENDENCIES):
+    """Returns, per section, a hash of the requirement paragraphs the section depends on.
+
+    With `embeddings`, a section depends on its `top_n` most similar paragraphs, so editing a
+    paragraph only affects the sections it is relevant to. Without, every section depends on
+    the whole requirements text.
+    """
+    paragraphs = split_paragraphs(requirements)
+    if embeddings is None or len(paragraphs) <= top_n:
+        whole = content_hash(normalize_text(requirements))
+        return [whole for _ in sections]
+    queries = [section["content"] for section in sections]
+    with request_priority(INTERACTIVE):
+        vectors = np.array(embeddings.embed_documents(queries + paragraphs), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    similarity = vectors[:len(queries)] @ vectors[len(queries):].T
+    paragraph_hashes = [content_hash(normalize_text(p)) for p in paragraphs]
+    return [
+        content_hash(*sorted(paragraph_hashes[j] for j in np.argsort(-row)[:top_n]))
+        for row in similarity
+    ]
+
+def context_source(knowledge_base, retrieval_mode: str = RETRIEVAL_MODE, use_mmr: bool = RETRIEVAL_USE_MMR) -> str:
+    """Returns a hash of the knowledge-base chunks and retrieval settings that section contexts come from.
+
+    The retrieved chunks themselves are not hashed: retrieval queries include the requirements, so
+    editing any paragraph would change every section's context. Requirement edits reach a section
+    through its requirement dependencies, and a regenerated section retrieves a fresh context.
+    """
+    if not knowledge_base:
+        return content_hash("")
+    return content_hash(retrieval_mode, str(bool(use_mmr)), *sorted(knowledge_base.index_to_docstore_id.values()))
+
+def section_inputs(sections, requirements, llm, embeddings=None, knowledge_base=None, retrieval_mode=RETRIEVAL_MODE,
+                   use_mmr=RETRIEVAL_USE_MMR):
+    """Returns the input hashes of each section: template body, requirements, context source and model.
+
+    Each section's hashes are independent of the others, so a single section can be passed alone.
+    """
+    dependencies = requirement_dependencies(requirements, sections, embeddings)
+    context = context_source(knowledge_base, retrieval_mode, use_mmr)
+    model = model_name(llm)
+    return [
+        {
+            "template": content_hash(normalize_text(section["content"])),
+            "requirements": dependency,
+            "context": context,
+            "model": model,
+        }
+        for section, dependency in zip(sections, dependencies)
+    ]
+
+# --- Incremental Generation ---
+def generate_pending_sections(state: SectionGenerationState, requirements, llm, knowledge_base=None, embeddings=None,
+                              refresh_stale=True, max_workers=GENERATION_MAX_CONCURRENCY, use_mmr=RETRIEVAL_USE_MMR,
+                              retrieval_mode=RETRIEVAL_MODE):
+    """Generates the sections that have no record and, with `refresh_stale`, those whose inputs changed.
+
+    Edited sections are never overwritten; stale edited sections are reported instead.
+    Returns {"generated": [indices], "kept_edits": [indices], "errors": {index: error}}.
+    """
+    sections = state.sections
+    inputs = section_inputs(sections, requirements, llm, embeddings, knowledge_base, retrieval_mode, use_mmr)
+    stale = state.stale_indices(inputs) if refresh_stale else []
+    kept_edits = [i for i in stale if state.is_edited(i)]
+    targets = sorted(set(state.pending_indices()) | (set(stale) - set(kept_edits)))
+
+    # Context is retrieved only for the sections being generated.
+    contents, errors = generate_all_sections(
+        [sections[i] for i in targets], requirements, llm, knowledge_base=knowledge_base, max_workers=max_workers,
+        use_mmr=use_mmr, retrieval_mode=retrieval_mode
+    )
+    failed = {targets[j]: e for j, e in errors.items()}
+    for j, i in enumerate(targets):
+        if i not in failed:
+            state.record(i, contents[j], inputs[i])
+    return {"generated": [i for i in targets if i not in failed], "kept_edits": kept_edits, "errors": failed}
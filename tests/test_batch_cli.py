@@ -0,0 +1,32 @@
+# test_batch_cli.py
+
+import os
+import fitz  # PyMuPDF
+from docx import Document
+import batch_cli
+
+def write_pdf(path, text):
+    pdf = fitz.open()
+    pdf.new_page().insert_text((72, 72), text)
+    pdf.save(path)
+    pdf.close()
+
+def write_docx(path, text):
+    document = Document()
+    document.add_paragraph(text)
+    document.save(path)
+
+def test_upper_case_extensions_are_listed_and_extracted(tmp_path, monkeypatch):
+    # Extraction caches and stored sources live under the working directory.
+    monkeypatch.chdir(tmp_path)
+    requirements_dir = tmp_path / "rfps"
+    requirements_dir.mkdir()
+    write_pdf(str(requirements_dir / "RFP.PDF"), "Budget and timeline for the PDF request")
+    write_docx(str(requirements_dir / "Scope.DOCX"), "Scope of work for the DOCX request")
+    (requirements_dir / "notes.TXT").write_text("not a requirements file")
+
+    paths = batch_cli.list_documents(str(requirements_dir))
+    assert [os.path.basename(path) for path in paths] == ["RFP.PDF", "Scope.DOCX"]
+    texts = [batch_cli.extract_path(path)["text"] for path in paths]
+    assert "PDF request" in texts[0]
+    assert "DOCX request" in texts[1]
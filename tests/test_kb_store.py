@@ -0,0 +1,65 @@
+# test_kb_store.py
+
+import os
+import random
+import zlib
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+from config import DEFAULT_PROPOSAL_TEMPLATE, KB_INDEX_OPTIONS
+from kb_store import KnowledgeBaseStore, resolve_index_factory
+from lexical_index import LEXICAL_INDEX_FILE
+from llm_utils import parse_template_sections, retrieve_section_contexts
+
+# Above the output dimension of "PCA1024,..." so every option in KB_INDEX_OPTIONS can train.
+DIM = 1088
+WORDS = ["交付", "验收", "平台", "数据", "安全", "运维", "接口", "培训", "budget", "timeline", "scope", "risk"]
+
+class HashEmbeddings(Embeddings):
+    """Deterministic random vectors keyed by text, so a chunk always gets the same embedding."""
+    model = "test/hash-embeddings"
+
+    def embed_documents(self, texts):
+        return [np.random.RandomState(zlib.crc32(text.encode("utf-8"))).randn(DIM).astype(np.float32).tolist()
+                for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def synthetic_documents(count=12, paragraphs=100, seed=0):
+    rng = random.Random(seed)
+    return [{"name": f"doc{d}.pdf", "text": "\n\n".join(" ".join(rng.choice(WORDS) for _ in range(30))
+                                                         for _ in range(paragraphs))}
+            for d in range(count)]
+
+@pytest.mark.parametrize("factory", KB_INDEX_OPTIONS)
+def test_reloaded_index_supports_mmr(tmp_path, factory):
+    documents = synthetic_documents()
+    embeddings = HashEmbeddings()
+    store = KnowledgeBaseStore(root=str(tmp_path), chunk_size=200, chunk_overlap=0, index_factory=factory)
+    built = store.build(documents, embeddings)
+    corpus = store.corpus_for(documents, embeddings.model, factory)
+    # Enough chunks that no option falls back to a simpler index.
+    assert store.manifest(corpus)["index"] == resolve_index_factory(factory, DIM, built.index.ntotal)
+
+    loaded = store.load(corpus, embeddings)
+    assert loaded.index.ntotal == built.index.ntotal
+    sections = parse_template_sections(DEFAULT_PROPOSAL_TEMPLATE)
+    for mode in ("dense", "hybrid"):
+        contexts = retrieve_section_contexts(loaded, sections, "budget timeline 交付", use_mmr=True, mode=mode)
+        assert len(contexts) == len(sections) and all(contexts)
+
+@pytest.mark.parametrize("damage", [b"", b"\x80\x05\x95", b"not a pickle"])
+def test_unreadable_lexical_index_is_rebuilt(tmp_path, damage):
+    documents = synthetic_documents(count=2, paragraphs=10)
+    embeddings = HashEmbeddings()
+    store = KnowledgeBaseStore(root=str(tmp_path), chunk_size=200, chunk_overlap=0)
+    store.build(documents, embeddings)
+    corpus = store.corpus_for(documents, embeddings.model, "Flat")
+    with open(os.path.join(str(tmp_path), corpus, LEXICAL_INDEX_FILE), "wb") as f:
+        f.write(damage)
+
+    loaded = store.load(corpus, embeddings)
+    assert loaded.lexical_index is None
+    sections = parse_template_sections(DEFAULT_PROPOSAL_TEMPLATE)
+    assert all(retrieve_section_contexts(loaded, sections, "budget timeline 交付", mode="lexical"))